@@ -1,24 +1,84 @@
 from typing import List, Dict
+import threading
+import time
+from contextlib import contextmanager
 
-import torch
+import numpy as np
 from PIL import Image
-from util.utils import (
-    check_ocr_box,
-    get_yolo_model,
-    get_caption_model_processor,
-    get_som_labeled_img,
-)
-
-# ─── weights are loaded once at import ───────────────────────────────
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-yolo_model = get_yolo_model(model_path="weights/icon_detect/model.pt")
-caption_model_processor = get_caption_model_processor(
-    model_name="florence2",
-    model_name_or_path="weights/icon_caption_florence"
-)
-# caption_model_processor = get_caption_model_processor(
-#     model_name="blip2", model_name_or_path="weights/icon_caption_blip2"
-# )
+
+
+# ─── weights are loaded on first use (or by the background warm-up) ─
+class LazyVisionModels:
+    """
+    Holds the YOLO detector, the Florence-2 caption model and the icon caption cache.
+    Nothing heavy (torch, weights, OCR) is imported until the first get(), so
+    ChatBrain can greet the user right away. The models are not thread safe: every
+    forward pass (warm-up included) runs inside inference(), one at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inference_lock = threading.Lock()
+        self._models = None
+        self._warmup_thread = None
+
+    def get(self) -> Dict:
+        with self._lock:
+            if self._models is None:
+                start = time.time()
+                from util.utils import get_yolo_model, get_caption_model_processor, get_ocr_engine
+                from util.caption_cache import CaptionCache
+                self._models = {
+                    "yolo_model": get_yolo_model(model_path="weights/icon_detect/model.pt"),
+                    "caption_model_processor": get_caption_model_processor(
+                        model_name="florence2",
+                        model_name_or_path="weights/icon_caption_florence"
+                    ),
+                    # caption_model_processor = get_caption_model_processor(
+                    #     model_name="blip2", model_name_or_path="weights/icon_caption_blip2"
+                    # )
+                    # icons repeat between screenshots, only caption the ones we have not seen
+                    "caption_cache": CaptionCache(db_path="weights/icon_caption_cache.sqlite"),
+                }
+                get_ocr_engine("paddleocr")
+                print(f"vision models loaded in {time.time() - start:.2f}s")
+            return self._models
+
+    @contextmanager
+    def inference(self):
+        """ the models, used by nobody else (not even the warm-up) until the block exits """
+        models = self.get()
+        with self._inference_lock:
+            yield models
+
+    def warmup(self):
+        """ load the weights and run one dummy forward pass of each model (kernel / JIT init) """
+        from util.utils import predict_yolo, caption_icon_crops
+        with self.inference() as models:
+            start = time.time()
+            blank = Image.new("RGB", (640, 640), "white")
+            predict_yolo(models["yolo_model"], blank, box_threshold=0.1, imgsz=640, scale_img=True)
+            caption_icon_crops([np.zeros((64, 64, 3), dtype=np.uint8)], models["caption_model_processor"])
+            print(f"vision models warmed up in {time.time() - start:.2f}s")
+
+    def start_warmup(self):
+        if self._warmup_thread is None:
+            self._warmup_thread = threading.Thread(target=self._safe_warmup, daemon=True)
+            self._warmup_thread.start()
+
+    def _safe_warmup(self):
+        try:
+            self.warmup()
+        except Exception as e:
+            # the first process_image call will load (and report) the models again
+            print("vision warm-up failed:", e)
+
+
+vision_models = LazyVisionModels()
+
+
+def start_warmup():
+    vision_models.start_warmup()
 
 
 # ─── helper: ensure bbox is pixels, then add center_px ──────────────
@@ -63,10 +123,22 @@ def postprocess_elements(elems: List[Dict], w: int, h: int) -> List[Dict]:
     return cleaned
 
 
+def load_image(image) -> Image.Image:
+    if hasattr(image, "to_pil"):
+        return image.to_pil()
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image)
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    return Image.open(image).convert("RGB")
+
+
 # ─── main entry called by ChatBrain ─────────────────────────────────
-def process_image(image_path: str):
+def process_image(image):
+    """ image: a gui_tools.ScreenFrame (parsed straight from memory), an RGB np.ndarray, a PIL image or a file path """
+    from util.utils import detect_and_ocr, get_som_labeled_img
 
-    img = Image.open(image_path)
+    img = load_image(image)
     W, H = img.size
 
     # OmniParser config
@@ -78,26 +150,42 @@ def process_image(image_path: str):
         "thickness": max(int(3 * box_overlay_ratio), 1),
     }
 
-    ocr_bbox_rslt, _ = check_ocr_box(
-        img, display_img=False, output_bb_format="xyxy",
-        easyocr_args={"paragraph": False, "text_threshold": 0.9},
-        use_paddleocr=True
-    )
-    ocr_text, ocr_bbox = ocr_bbox_rslt
-
-    # NOTE: output_coord_in_ratio=False ⇒ YOLO returns pixel coords already
-    overlay_b64, label_coords, elements = get_som_labeled_img(
-        img,
-        yolo_model,
-        BOX_TRESHOLD=0.1,
-        output_coord_in_ratio=False,
-        ocr_bbox=ocr_bbox,
-        draw_bbox_config=draw_cfg,
-        caption_model_processor=caption_model_processor,
-        ocr_text=ocr_text,
-        iou_threshold=0.01,
-        imgsz=1920,
-    )
+    timings = {}
+    # waits for a running warm-up pass instead of sharing the models with it
+    with vision_models.inference() as models:
+        # OCR and icon detection run concurrently, they only meet at the overlap removal
+        ocr_bbox_rslt, detections = detect_and_ocr(
+            img,
+            models["yolo_model"],
+            BOX_TRESHOLD=0.1,
+            ocr_args={
+                "easyocr_args": {"paragraph": False, "text_threshold": 0.9},
+                "ocr_engine": "paddleocr",
+                "tile_size": 2560,     # 4K / ultra-wide captures are ocr-ed in tiles
+            },
+            imgsz=1920,
+            timings=timings,
+        )
+        ocr_text, ocr_bbox = ocr_bbox_rslt
+
+        # NOTE: output_coord_in_ratio=False ⇒ YOLO returns pixel coords already
+        overlay_b64, label_coords, elements = get_som_labeled_img(
+            img,
+            models["yolo_model"],
+            BOX_TRESHOLD=0.1,
+            output_coord_in_ratio=False,
+            ocr_bbox=ocr_bbox,
+            draw_bbox_config=draw_cfg,
+            caption_model_processor=models["caption_model_processor"],
+            caption_cache=models["caption_cache"],
+            ocr_text=ocr_text,
+            iou_threshold=0.01,
+            imgsz=1920,
+            render_overlay=False,   # the overlay is never shown, use draw_som_overlay if it is needed
+            detections=detections,
+            timings=timings,
+        )
+    print("parse stage timings:", {k: round(v, 3) for k, v in timings.items()})
     # post-process boxes
     elements_pp = postprocess_elements(elements, W, H)
 
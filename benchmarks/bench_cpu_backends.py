@@ -0,0 +1,77 @@
+'''
+Parse latency and peak RSS of the cpu backends against the default path, each backend in a fresh process
+
+    default: ultralytics PyTorch icon detector + Florence-2 float32
+    int8:    ultralytics PyTorch icon detector + Florence-2 int8 (torch dynamic quantization)
+    onnx:    ONNX Runtime icon detector + Florence-2 int8
+
+python benchmarks/bench_cpu_backends.py --image images/macos.jpg --repeat 5
+'''
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
+
+BACKENDS = {
+    'default': {'som_model_backend': 'torch', 'caption_model_name': 'florence2'},
+    'int8': {'som_model_backend': 'torch', 'caption_model_name': 'florence2_int8'},
+    'onnx': {'som_model_backend': 'onnx', 'caption_model_name': 'florence2_int8'},
+}
+
+
+def peak_rss_mb():
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
+
+
+def run_backend(args):
+    """ child process: load one backend, parse the screenshot, print the measurements as json """
+    from PIL import Image
+    from util.omniparser import Omniparser
+    config = {'som_model_path': args.som_model_path, 'caption_model_path': args.caption_model_path, 'device': 'cpu',
+              # no cached captions: every parse runs the caption model
+              'BOX_TRESHOLD': 0.05, 'caption_cache_size': 0, **BACKENDS[args.backend]}
+    start = time.perf_counter()
+    omniparser = Omniparser(config)
+    load_seconds = time.perf_counter() - start
+    image = Image.open(args.image).convert('RGB')
+    omniparser.parse(image, render_overlay=False)  # warm-up
+    latencies, timings = [], {}
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        _, parsed_content_list = omniparser.parse(image, render_overlay=False, timings=timings)
+        latencies.append(time.perf_counter() - start)
+    print(json.dumps({'load_s': load_seconds, 'parse_s': sorted(latencies)[len(latencies) // 2], 'elements': len(parsed_content_list),
+                      'caption_s': timings.get('caption', 0) / args.repeat, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the cpu backends of Omniparser')
+    parser.add_argument('--image', type=str, default=os.path.join(root_dir, 'images', 'macos.jpg'))
+    parser.add_argument('--som_model_path', type=str, default=os.path.join(root_dir, 'weights', 'icon_detect', 'model.pt'))
+    parser.add_argument('--caption_model_path', type=str, default=os.path.join(root_dir, 'weights', 'icon_caption_florence'))
+    parser.add_argument('--backends', type=str, nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--backend', type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.backend:
+        return run_backend(args)
+
+    print(f'{"backend":8s} {"load s":>8s} {"parse s":>8s} {"caption s":>10s} {"elements":>9s} {"peak RSS MB":>12s}')
+    for backend in args.backends:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--backend', backend, '--image', args.image, '--repeat', str(args.repeat),
+                              '--som_model_path', args.som_model_path, '--caption_model_path', args.caption_model_path],
+                             capture_output=True, text=True, check=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        print(f'{backend:8s} {result["load_s"]:8.2f} {result["parse_s"]:8.2f} {result["caption_s"]:10.2f} {result["elements"]:9d} {result["peak_rss_mb"]:12.0f}')
+
+
+if __name__ == '__main__':
+    main()
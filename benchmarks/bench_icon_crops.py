@@ -0,0 +1,82 @@
+'''
+Crops/sec of the icon caption input: screenshot + boxes -> normalized N x 3 x 768 x 768 pixel_values (the CPU path),
+one caption batch of pixel_values at a time like caption_icon_crops
+
+    per-crop: cv2.resize of every crop, ToPILImage, the Florence-2 image processor (what get_parsed_content_icon did)
+    batched:  crop_icon_images (one roi_align) + icon_pixel_values (one antialiased interpolate of the batch)
+
+python benchmarks/bench_icon_crops.py --icons 50 200 500
+'''
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+from torchvision.transforms import ToPILImage
+from transformers import CLIPImageProcessor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util.utils import crop_icon_images, icon_pixel_values
+
+
+def florence2_image_processor():
+    # microsoft/Florence-2-base's preprocessor_config.json, built locally so the benchmark needs no download
+    return CLIPImageProcessor(size={'height': 768, 'width': 768}, do_center_crop=False, resample=3, do_convert_rgb=False,
+                              image_mean=[0.485, 0.456, 0.406], image_std=[0.229, 0.224, 0.225])
+
+
+def per_crop(boxes, image_source, image_processor, batch_size):
+    to_pil = ToPILImage()
+    h, w = image_source.shape[:2]
+    croped_pil_image = []
+    for coord in boxes:
+        xmin, xmax = int(coord[0] * w), int(coord[2] * w)
+        ymin, ymax = int(coord[1] * h), int(coord[3] * h)
+        cropped_image = cv2.resize(image_source[ymin:ymax, xmin:xmax, :], (64, 64))
+        croped_pil_image.append(to_pil(cropped_image))
+    for i in range(0, len(croped_pil_image), batch_size):
+        image_processor(croped_pil_image[i:i+batch_size], return_tensors='pt')['pixel_values']
+
+
+def batched(boxes, image_source, image_processor, batch_size):
+    crops = crop_icon_images(boxes, image_source)
+    for i in range(0, len(crops), batch_size):
+        icon_pixel_values(crops[i:i+batch_size], image_processor)
+
+
+def random_boxes(n, rng):
+    corners = rng.random((n, 2)) * 0.95
+    return np.concatenate([corners, corners + 0.01 + rng.random((n, 2)) * 0.04], axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark icon crop batching')
+    parser.add_argument('--icons', type=int, nargs='+', default=[50, 200, 500])
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image_source = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    image_processor = florence2_image_processor()
+    print(f'screenshot {args.width}x{args.height}, batch size {args.batch_size}, torch threads {torch.get_num_threads()}')
+    for n in args.icons:
+        boxes = random_boxes(n, rng)
+        line = f'{n:5d} icons'
+        for name, fn in [('per-crop', per_crop), ('batched', batched)]:
+            fn(boxes[:2], image_source, image_processor, args.batch_size)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                fn(boxes, image_source, image_processor, args.batch_size)
+            elapsed = (time.perf_counter() - start) / args.repeat
+            line += f'  {name}: {n / elapsed:8.1f} crops/s'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
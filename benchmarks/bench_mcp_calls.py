@@ -0,0 +1,56 @@
+'''
+Per-call overhead of 100 sequential MCP tool calls, on a tool that does nothing (no Gmail involved)
+
+    per-call: asyncio.run + a new Client(FastMCPTransport(server)) per call (the wrappers before MCPClientManager)
+    manager:  MCPClientManager, one event loop thread and one session for every call
+
+python benchmarks/bench_mcp_calls.py --calls 100
+'''
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+from fastmcp import Client, FastMCP
+from fastmcp.client.transports import FastMCPTransport
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# mcp_clients imports gmail_mcp, keep its mirror database out of the user's data directory
+os.environ.setdefault("SOFIA_GMAIL_MIRROR", os.path.join(tempfile.mkdtemp(), "gmail_mirror.sqlite"))
+from mcp_clients import MCPClientManager
+
+server = FastMCP("bench-tools")
+
+
+@server.tool()
+def echo(text: str) -> str:
+    return text
+
+
+def per_call(text):
+    async def call():
+        async with Client(FastMCPTransport(server)) as client:
+            return await client.call_tool("echo", {"text": text})
+    return asyncio.run(call())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark MCP tool call overhead')
+    parser.add_argument('--calls', type=int, default=100)
+    args = parser.parse_args()
+
+    manager = MCPClientManager(server)
+    for name, call in [('per-call', per_call), ('manager', lambda text: manager.call_tool("echo", {"text": text}))]:
+        call("warm-up")
+        start = time.perf_counter()
+        for i in range(args.calls):
+            call(str(i))
+        elapsed = time.perf_counter() - start
+        print(f'{name:8s} {args.calls} calls: {elapsed:7.3f}s total, {elapsed / args.calls * 1000:7.2f} ms/call')
+    manager.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+'''
+Bytes on the wire and end-to-end latency of one parse per transport, against a running omniparserserver
+
+    json:          POST /parse/ with the base64 PNG in JSON, base64 SOM in the answer (decoded by the client)
+    binary-inline: POST /parse/binary/?som=inline with the PNG body, base64 SOM in the answer (one round trip)
+    binary-lazy:   POST /parse/binary/?som=lazy, then GET /som/{id} for the PNG (two round trips)
+    binary-none:   POST /parse/binary/?som=none, elements only (what a caller without the SOM image needs)
+    raw-none:      raw RGB body with X-Image-Width / X-Image-Height, elements only (no PNG encode / decode)
+
+Latency includes the client side encode / decode. Bytes are request + response bodies (HTTP headers left out).
+
+python benchmarks/bench_parse_transport.py --url http://localhost:8000 --image images/macos.jpg --repeat 5
+'''
+import argparse
+import base64
+import io
+import os
+import time
+
+import requests
+from PIL import Image
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def parse_json(url, png, image):
+    body = {"base64_image": base64.b64encode(png).decode("utf-8")}
+    response = requests.post(f"{url}/parse/", json=body)
+    response.raise_for_status()
+    base64.b64decode(response.json()["som_image_base64"])
+    return len(response.request.body) + len(response.content)
+
+
+def parse_binary(som):
+    def parse(url, png, image):
+        response = requests.post(f"{url}/parse/binary/", data=png, params={"som": som}, headers={"Content-Type": "image/png"})
+        response.raise_for_status()
+        sent = len(png) + len(response.content)
+        if som == "inline":
+            base64.b64decode(response.json()["som_image_base64"])
+        elif som == "lazy":
+            som_response = requests.get(f"{url}/som/{response.json()['som_image_id']}")
+            som_response.raise_for_status()
+            sent += len(som_response.content)
+        return sent
+    return parse
+
+
+def parse_raw(url, png, image):
+    pixels = image.tobytes()
+    response = requests.post(f"{url}/parse/binary/", data=pixels, params={"som": "none"},
+                             headers={"Content-Type": "application/octet-stream", "X-Image-Width": str(image.width), "X-Image-Height": str(image.height)})
+    response.raise_for_status()
+    return len(pixels) + len(response.content)
+
+
+TRANSPORTS = {
+    'json': parse_json,
+    'binary-inline': parse_binary('inline'),
+    'binary-lazy': parse_binary('lazy'),
+    'binary-none': parse_binary('none'),
+    'raw-none': parse_raw,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /parse/ transports')
+    parser.add_argument('--url', type=str, default='http://localhost:8000')
+    parser.add_argument('--image', type=str, default=os.path.join(root_dir, 'images', 'macos.jpg'))
+    parser.add_argument('--transports', type=str, nargs='+', default=list(TRANSPORTS), choices=list(TRANSPORTS))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    image = Image.open(args.image).convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    png = buffer.getvalue()
+    print(f'{image.width}x{image.height} screenshot, {len(png) / 2**20:.2f} MB PNG, {args.repeat} parses per transport')
+    print(f'{"transport":14s} {"MB on wire":>10s} {"median s":>9s} {"min s":>7s}')
+    for name in args.transports:
+        TRANSPORTS[name](args.url, png, image)  # warm-up
+        latencies = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            sent = TRANSPORTS[name](args.url, png, image)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print(f'{name:14s} {sent / 2**20:10.2f} {latencies[len(latencies) // 2]:9.3f} {latencies[0]:7.3f}')
+
+
+if __name__ == '__main__':
+    main()
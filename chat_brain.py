@@ -3,10 +3,11 @@ import json
 import os
 import yaml
 from sys_tools import save_file, read_file, execute_command, reset_google_cred
-from mcp_clients import fetch_gmail, gmail_search_emails, send_gmail
-from OP_tool import process_image
+from mcp_clients import fetch_gmail, gmail_search_emails, gmail_search_text, send_gmail, send_gmail_batch
+from OP_tool import process_image, start_warmup
 from gui_tools import (
     take_screenshot,
+    screenshot_store,
     move_mouse,
     click_mouse,
     drag_mouse,
@@ -30,8 +31,10 @@ class ChatBrain:
             "read_file": read_file,
             "execute_command": execute_command,
             "gmail_search_emails": gmail_search_emails,
+            "gmail_search_text": gmail_search_text,
             "gmail_fetch_emails": fetch_gmail,
             "gmail_send_emails": send_gmail,
+            "gmail_send_batch": send_gmail_batch,
             "reset_google_cred": reset_google_cred,
             "take_screenshot": take_screenshot,
             "move_mouse": move_mouse,
@@ -57,6 +60,8 @@ class ChatBrain:
             if func := self.available_functions.get(tool_name):
                 try:
                     output = func(**args)
+                    # the captured frame goes to the parser, not into the chat history
+                    frame = output.pop("frame", None) if tool_name == "take_screenshot" else None
                     print(f"Calling function: {tool_name}")
                     print("Arguments:", args)
                     print("Function output:", output)
@@ -68,7 +73,19 @@ class ChatBrain:
                     executed = True
                     if tool_name == "take_screenshot":
                         path = output.get("path")
-                        if path and os.path.exists(path):
+                        if frame is not None:
+                            print("processing images")
+                            # parse the in-memory frame while the PNG is still being written
+                            image_content = process_image(frame)
+                            path = frame.wait_saved()
+                            # print(image_content)
+                            messages.append({
+                                "role": "assistant",
+                                "content": image_content,
+                                "images": [path] if path else []
+                            })
+                            screenshot_store.retain_referenced(messages)
+                        elif path and os.path.exists(path):
                             print("processing images")
                             image_content = process_image(path)
                             # print(image_content)
@@ -77,6 +94,7 @@ class ChatBrain:
                                 "content": image_content,
                                 "images": [path]
                             })
+                            screenshot_store.retain_referenced(messages)
                 except Exception as e:
                     print("Error calling function:", e)
                     messages.append({
@@ -109,6 +127,8 @@ class ChatBrain:
 
     def initialize_chat(self, messages, tools):
         print("SOFIA: Hi Alex! How can I help you?")
+        # load the vision models while the user types
+        start_warmup()
         while True:
             try:
                 response_text, _ = self.continuous_chat(messages, tools)
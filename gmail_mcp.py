@@ -1,24 +1,48 @@
 import os, sys, json
+import threading
+import time
+import random
+import asyncio
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import re
 import base64, email.utils
 from email.message import EmailMessage
 import dateparser
+import googleapiclient.http
+import google_auth_httplib2
+import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 
-from fastmcp import FastMCP
+from fastmcp import FastMCP, Context
+from gmail_mirror import MailboxMirror
 
 TOKEN_FILE = "token.json"
+# the mirror holds message bodies in plain text: keep it in the user's data directory, not the working tree
+DATA_DIR = os.path.join(os.environ.get("LOCALAPPDATA") or os.environ.get("XDG_DATA_HOME")
+                        or os.path.join(os.path.expanduser("~"), ".local", "share"), "sofia")
+MIRROR_FILE = os.environ.get("SOFIA_GMAIL_MIRROR", os.path.join(DATA_DIR, "gmail_mirror.sqlite"))
 CREDS_FILE = "credentials.json"
 SCOPES = ["https://www.googleapis.com/auth/gmail.modify"]
 
 
-def gmail_service():
-    """Return an authorised Gmail service instance, triggering OAuth if needed."""
+# process-wide service, built once; credentials are refreshed in place shortly before they expire
+_service_lock = threading.Lock()
+_service = None
+_service_creds: Credentials | None = None
+_identity: tuple | None = None   # (credentials, address of that account), see sender_address
+_thread_http = threading.local()
+REFRESH_MARGIN = timedelta(minutes=5)
+
+
+def _load_credentials() -> Credentials:
     creds: Credentials | None = None
     if os.path.exists(TOKEN_FILE):
         creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
@@ -29,10 +53,242 @@ def gmail_service():
         else:
             flow = InstalledAppFlow.from_client_secrets_file(CREDS_FILE, SCOPES)
             creds = flow.run_local_server(port=0)
-        with open(TOKEN_FILE, "w") as f:
-            f.write(creds.to_json())
+        _save_credentials(creds)
+    return creds
+
+
+def _save_credentials(creds: Credentials):
+    with open(TOKEN_FILE, "w") as f:
+        f.write(creds.to_json())
+
+
+def _expires_soon(creds: Credentials) -> bool:
+    # google-auth keeps expiry as a naive UTC datetime
+    return creds.expiry is not None and creds.expiry - datetime.utcnow() < REFRESH_MARGIN
+
+
+def _build_request(http, *args, **kwargs):
+    """ httplib2 is not thread safe: every thread gets its own (kept alive) authorised connection """
+    if getattr(_thread_http, "creds", None) is not _service_creds:
+        _thread_http.http = google_auth_httplib2.AuthorizedHttp(_service_creds, http=httplib2.Http())
+        _thread_http.creds = _service_creds
+    return googleapiclient.http.HttpRequest(_thread_http.http, *args, **kwargs)
+
+
+def gmail_service():
+    """Return the authorised Gmail service shared by all tool calls, triggering OAuth if needed."""
+    global _service, _service_creds, _identity
+    with _service_lock:
+        if _service is not None and not os.path.exists(TOKEN_FILE):
+            # token.json was removed (reset_google_cred): authorise again, maybe as another account
+            _service, _service_creds, _identity = None, None, None
+            mirror.clear()
+        if _service is None:
+            _service_creds = _load_credentials()
+            _service = build("gmail", "v1", credentials=_service_creds, cache_discovery=False, requestBuilder=_build_request)
+        elif _expires_soon(_service_creds) and _service_creds.refresh_token:
+            _service_creds.refresh(Request())
+            _save_credentials(_service_creds)
+        return _service
+
+
+def reset_gmail_service():
+    """ drop the cached service (and sender identity), the next gmail_service() reads token.json again """
+    global _service, _service_creds, _identity
+    with _service_lock:
+        _service, _service_creds, _identity = None, None, None
+
+
+def sender_address(service) -> str:
+    """
+    Email address of the authorised account, asked with users.getProfile once per
+    credential: a new credential (token.json removed by reset_google_cred, another
+    account) misses the cache.
+    """
+    global _identity
+    with _service_lock:
+        creds, identity = _service_creds, _identity
+    if identity is not None and identity[0] is creds:
+        return identity[1]
+    address = service.users().getProfile(userId="me").execute()["emailAddress"]
+    with _service_lock:
+        if creds is _service_creds:
+            _identity = (creds, address)
+    return address
+
+
+BATCH_SIZE = 50   # Gmail accepts up to 100 calls per batch, fewer avoids per-user rate limits
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_GET_RETRIES = 4
+
+
+def get_messages(service, ids: List[str], format: str = "metadata", headers: List[str] | None = None) -> List[dict]:
+    """
+    messages.get for every id through the batch endpoint: one HTTP round trip
+    per BATCH_SIZE messages instead of one per message.
+    Gets that are rate limited (429) or hit a server error (5xx) are retried, in a
+    later batch after an exponential backoff, up to MAX_GET_RETRIES times.
+    Results are in the order of `ids`; the first other failed get is raised.
+    """
+    results: List[dict | None] = [None] * len(ids)
+    errors: List[Exception] = []
+    retry: List[int] = []
+
+    def _collect(request_id, response, exception):
+        if exception is None:
+            results[int(request_id)] = response
+        elif isinstance(exception, HttpError) and exception.resp.status in RETRY_STATUSES and attempt < MAX_GET_RETRIES:
+            retry.append(int(request_id))
+        else:
+            errors.append(exception)
+
+    params = {"metadataHeaders": headers} if format == "metadata" and headers else {}
+    pending, attempt = list(range(len(ids))), 0
+    while pending:
+        for start in range(0, len(pending), BATCH_SIZE):
+            batch = service.new_batch_http_request(callback=_collect)
+            for i in pending[start:start + BATCH_SIZE]:
+                batch.add(service.users().messages().get(
+                    userId="me",
+                    id=ids[i],
+                    format=format,
+                    **params
+                ), request_id=str(i))
+            batch.execute()
+            if errors:
+                raise errors[0]
+        pending, retry = sorted(retry), []
+        if pending:
+            time.sleep(min(2 ** attempt, 32) + random.random())
+            attempt += 1
+    return results
+
+
+def get_messages_metadata(service, ids: List[str], headers: List[str]) -> List[dict]:
+    """ messages.get(format="metadata") of every id, batched, see get_messages """
+    return get_messages(service, ids, "metadata", headers)
+
+
+# metadata (and full-text index) of the recent mail, synced incrementally from Gmail's history
+mirror = MailboxMirror(MIRROR_FILE, fetch_messages=get_messages)
+
+
+def _mirror_query(service, query, max_results: int, since_ms: int | None = None):
+    """
+    Run `query` on the mirror after syncing it. Returns the rows if they are complete:
+    the query is limited to the mirrored time range, or it found max_results rows all
+    inside that range. Otherwise (or if the mirror fails) returns None, ask Gmail.
+    """
+    try:
+        mirror.sync(service)
+        rows = query()
+    except Exception as e:
+        print("mailbox mirror unavailable, querying gmail:", e)
+        return None
+    if mirror.covers(since_ms):
+        return rows
+    if len(rows) >= max_results and (not rows or mirror.covers(rows[-1]["internal_date"])):
+        return rows
+    return None
+
+
+class EmailListing:
+    """
+    One gmail_fetch_emails listing, consumed a page at a time through a cursor.
+
+    Served from the mirror while it holds every matching message; otherwise
+    messages.list is walked lazily (one nextPageToken page when the listed ids
+    run out) and only the ids handed out get their metadata fetched.
+
+    Attributes:
+        clause (str): Gmail query of the listing
+        returned (int): messages handed out so far
+        has_more (bool): the listing may hold more messages
+    """
+
+    def __init__(self, clause: str, mirror_query, since_ms: int | None):
+        self.clause = clause
+        self.mirror_query = mirror_query   # (limit, after) -> mirror rows older than `after`
+        self.since_ms = since_ms
+        self.returned = 0
+        self.has_more = True
+        self._after: tuple | None = None  # (internal_date, id) of the last mirror row handed out
+        self._seen: set = set()
+        self._pending: List[str] = []   # listed, not handed out yet
+        self._page_token: str | None = None
+        self._exhausted = False
+        self._listing = False           # switched from the mirror to messages.list
+        self._lock = threading.Lock()
+
+    def take(self, service, n: int, report=None) -> List[Dict[str, str]]:
+        """ the next n messages; report(done, emails) is called with every batch as it is fetched """
+        with self._lock:
+            emails: List[Dict[str, str]] = []
+            if not self._listing:
+                # keyset page: the rows after the last one handed out, so new, archived or
+                # relabelled mail never shifts the page; one row more than asked tells if there are more
+                rows = _mirror_query(service, lambda: self.mirror_query(n + 1, self._after), n + 1, self.since_ms)
+                if rows is not None:
+                    rows = [r for r in rows if r["id"] not in self._seen]
+                    page = rows[:n]
+                    emails = [{"id": r["id"], "snippet": r["snippet"], "subject": r["subject"], "from": r["sender"],
+                               "date": r["date"]} for r in page]
+                    if page:
+                        self._after = (page[-1]["internal_date"], page[-1]["id"])
+                    self._hand_out(emails, report, n)
+                    self.has_more = len(rows) > n
+                    return emails
+                self._listing = True
+
+            while len(emails) < n:
+                if not self._pending and not self._list_page(service, n - len(emails)):
+                    break
+                ids = self._pending[:min(n - len(emails), BATCH_SIZE)]
+                del self._pending[:len(ids)]
+                msgs = get_messages_metadata(service, ids, ["Subject", "From", "Date"])
+                batch = []
+                for msg_id, msg in zip(ids, msgs):
+                    hdr = {h["name"]: h["value"] for h in msg["payload"]["headers"]}
+                    batch.append({
+                        "id":       msg_id,
+                        "snippet":  msg.get("snippet", ""),
+                        "subject":  hdr.get("Subject", ""),
+                        "from":     hdr.get("From", ""),
+                        "date":     hdr.get("Date", "")
+                    })
+                emails.extend(batch)
+                self._hand_out(batch, report, len(emails))
+            self.has_more = bool(self._pending) or not self._exhausted
+            return emails
+
+    def _list_page(self, service, wanted: int) -> bool:
+        """ list the next page of ids, False once the listing is exhausted """
+        while not self._exhausted:
+            resp = service.users().messages().list(
+                userId="me",
+                q=self.clause,
+                maxResults=min(max(wanted, 20), 500),
+                pageToken=self._page_token
+            ).execute()
+            self._page_token = resp.get("nextPageToken")
+            self._exhausted = self._page_token is None
+            # the mirror may already have handed out the newest ones
+            self._pending = [m["id"] for m in resp.get("messages", []) if m["id"] not in self._seen]
+            if self._pending:
+                return True
+        return False
+
+    def _hand_out(self, emails: List[Dict[str, str]], report, done: int):
+        self._seen.update(e["id"] for e in emails)
+        self.returned += len(emails)
+        if report is not None and emails:
+            report(done, emails)
+
+
+MAX_CURSORS = 32   # open fetch listings kept, oldest dropped first
+_cursors: "OrderedDict[str, EmailListing]" = OrderedDict()
+_cursor_lock = threading.Lock()
 
-    return build("gmail", "v1", credentials=creds, cache_discovery=False)
 
 server = FastMCP("gmail-tools")   # arbitrary server id
 
@@ -61,6 +317,11 @@ def gmail_search_emails(
     """
     service = gmail_service()
 
+    rows = _mirror_query(service, lambda: mirror.search(sender, subject, max_results), max_results)
+    if rows is not None:
+        return [{"id": r["id"], "threadId": r["thread_id"], "snippet": r["snippet"], "from": r["sender"],
+                 "subject": r["subject"], "date": r["date"]} for r in rows]
+
     # build the Gmail 'q=' query string
     q_parts = []
     if sender:
@@ -77,15 +338,10 @@ def gmail_search_emails(
     ).execute()
 
     results = []
-    for msg_meta in resp.get("messages", []):
-        # fetch headers & snippet
-        msg = service.users().messages().get(
-            userId="me",
-            id=msg_meta["id"],
-            format="metadata",
-            metadataHeaders=["From", "Subject", "Date"]
-        ).execute()
-
+    metas = resp.get("messages", [])
+    # fetch headers & snippet
+    msgs = get_messages_metadata(service, [m["id"] for m in metas], ["From", "Subject", "Date"])
+    for msg_meta, msg in zip(metas, msgs):
         headers = {h["name"]: h["value"] for h in msg.get("payload", {}).get("headers", [])}
         results.append({
             "id":       msg_meta["id"],
@@ -100,28 +356,60 @@ def gmail_search_emails(
 
 
 @server.tool()
-def gmail_fetch_emails(
+async def gmail_fetch_emails(
     max_results: int = 5,
     unread_only: bool = False,
     all_inbox: bool = True,
-    since: Optional[str] = None   # NEW  ← "yesterday", "2025‑04‑10", "3d", None
-) -> List[Dict[str, str]]:
+    since: Optional[str] = None,   # NEW  ← "yesterday", "2025‑04‑10", "3d", None
+    cursor: Optional[str] = None,
+    ctx: Context | None = None
+) -> Dict[str, object]:
     """
-    Fetch up to `max_results` messages from Gmail.
+    Fetch up to `max_results` messages from Gmail, newest first.
 
     Args
     ----
-    max_results   : cap on returned messages
+    max_results   : cap on returned messages (any number, Gmail pages are walked as needed)
     unread_only   : only unread if True
     all_inbox     : include Social/Promotions/etc. if True
     since         : natural‑language time (e.g. "yesterday", "3d", "2025‑04‑01")
+    cursor        : `next_cursor` of a previous call: the next `max_results` messages
+                    of that same listing (the filters above are ignored)
 
     Returns
     -------
-    List[dict] with keys id, snippet, date, subject, from
+    dict with
+      emails      : List[dict] with keys id, snippet, date, subject, from
+      next_cursor : pass it back to get the messages that follow, None if there are no more
     """
-    service = gmail_service()
+    if cursor:
+        with _cursor_lock:
+            listing = _cursors.get(cursor)
+        if listing is None:
+            raise ValueError(f"Unknown or expired cursor '{cursor}', fetch again without it")
+    else:
+        listing = _new_listing(unread_only, all_inbox, since)
+        cursor = uuid.uuid4().hex
+
+    # each batch of messages is reported as it arrives, as a progress notification
+    # whose message is the JSON list of those emails
+    loop = asyncio.get_running_loop()
+    def _report(done: int, emails: List[Dict[str, str]]):
+        if ctx is not None:
+            asyncio.run_coroutine_threadsafe(ctx.report_progress(done, max_results, json.dumps(emails)), loop).result()
+
+    emails = await asyncio.to_thread(listing.take, gmail_service(), max_results, _report)
+
+    with _cursor_lock:
+        _cursors.pop(cursor, None)
+        if listing.has_more:
+            _cursors[cursor] = listing
+            while len(_cursors) > MAX_CURSORS:
+                _cursors.popitem(last=False)
+    return {"emails": emails, "next_cursor": cursor if listing.has_more else None}
+
 
+def _new_listing(unread_only: bool, all_inbox: bool, since: Optional[str]) -> "EmailListing":
     if all_inbox:
         clause = "in:inbox"
     else:
@@ -134,43 +422,80 @@ def gmail_fetch_emails(
     if unread_only:
         clause += " is:unread"
 
+    since_ms = None
     if since:
         # 2a. purely relative pattern like "3d", "12h", "90m"
         m = re.fullmatch(r"(\d+)([dhm])", since.strip().lower())
         if m:
             clause += f" newer_than:{m.group(1)}{m.group(2)}"
+            unit = {"d": "days", "h": "hours", "m": "minutes"}[m.group(2)]
+            since_ms = int((datetime.utcnow() - timedelta(**{unit: int(m.group(1))})).replace(tzinfo=timezone.utc).timestamp() * 1000)
         else:
             # 2b. parse with dateparser
             dt: datetime | None = dateparser.parse(since, settings={"TIMEZONE": "UTC"})
             if dt is None:
                 raise ValueError(f"Could not interpret `since='{since}'`")
             clause += f" after:{dt.strftime('%Y/%m/%d')}"
+            since_ms = _date_ms(since)
 
-    resp = service.users().messages().list(
-        userId="me",
-        q=clause,
-        maxResults=max_results
-    ).execute()
+    return EmailListing(
+        clause,
+        lambda limit, after: mirror.fetch(limit, unread_only=unread_only, all_inbox=all_inbox, since_ms=since_ms, after=after),
+        since_ms,
+    )
 
-    results: List[Dict[str, str]] = []
-    for meta in resp.get("messages", []):
-        msg = service.users().messages().get(
-            userId="me",
-            id=meta["id"],
-            format="metadata",
-            metadataHeaders=["Subject", "From", "Date"]
-        ).execute()
 
-        hdr = {h["name"]: h["value"] for h in msg["payload"]["headers"]}
-        results.append({
-            "id":       meta["id"],
-            "snippet":  msg.get("snippet", ""),
-            "subject":  hdr.get("Subject", ""),
-            "from":     hdr.get("From", ""),
-            "date":     hdr.get("Date", "")
-        })
+@server.tool()
+def gmail_search_text(
+    query: str,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    labels: Optional[List[str]] = None,
+    max_results: int = 10
+) -> List[Dict[str, str]]:
+    """
+    Ranked free-text search over the recent mail mirrored locally
+    (sender, subject, snippet and body), answered without the Gmail search API.
+
+    Args:
+      query:       words to look for, best matches first (all words preferred, any word otherwise).
+      after:       only messages on/after this date ("yesterday", "2025-04-01", ...).
+      before:      only messages before this date.
+      labels:      only messages carrying all these labels (e.g. ["INBOX", "UNREAD"], or user label names).
+      max_results: how many messages to return at most.
+
+    Returns:
+      A list of dicts with id, threadId, snippet, from, subject, date, labels.
+    """
+    service = gmail_service()
+    if not mirror.fts:
+        raise ValueError("Full-text search needs an SQLite build with FTS5, use gmail_search_emails")
+    try:
+        mirror.sync(service)
+    except Exception as e:
+        print("mailbox mirror sync failed, searching the last synced copy:", e)
+    if not mirror.ready:
+        raise ValueError("The local mail index is still being built, try again shortly or use gmail_search_emails")
+    rows = mirror.search_text(
+        query,
+        max_results=max_results,
+        after_ms=_date_ms(after),
+        before_ms=_date_ms(before),
+        label_ids=mirror.label_ids(service, labels) if labels else None,
+    )
+    return [{"id": r["id"], "threadId": r["thread_id"], "snippet": r["snippet"], "from": r["sender"],
+             "subject": r["subject"], "date": r["date"], "labels": r["labels"].split()} for r in rows]
+
+
+def _date_ms(value: Optional[str]) -> Optional[int]:
+    """ start of the (UTC) day described by `value`, ms since epoch """
+    if not value:
+        return None
+    dt: datetime | None = dateparser.parse(value, settings={"TIMEZONE": "UTC"})
+    if dt is None:
+        raise ValueError(f"Could not interpret date '{value}'")
+    return int(datetime(dt.year, dt.month, dt.day, tzinfo=timezone.utc).timestamp() * 1000)
 
-    return results
 
 @server.tool()
 def gmail_send_emails(
@@ -183,17 +508,64 @@ def gmail_send_emails(
     mode: str = "new",
     thread_id: str | None = None,
     message_id: str | None = None
-) -> Dict[str, str]:
+) -> Dict[str, object]:
     """
     Send (new / reply / forward) an e‑mail.
 
     Returns { id: <gmail id>, threadId: <gmail threadId> }.
     """
     svc = gmail_service()
-    me_profile = svc.users().getProfile(userId="me").execute()
-    sender_addr = me_profile["emailAddress"]
-    sender_formatted = email.utils.formataddr((sender_name, sender_addr))
+    return _send_email(svc, email.utils.formataddr((sender_name, sender_address(svc))), subject, to, cc, bcc, body,
+                       mode, thread_id, message_id)
+
+
+MAX_SEND_CONCURRENCY = 4   # sends in flight at once for gmail_send_batch, Gmail throttles bursts per user
+
+
+@server.tool()
+def gmail_send_batch(
+    sender_name: str,
+    drafts: List[Dict[str, object]],
+    max_concurrency: int = MAX_SEND_CONCURRENCY
+) -> List[Dict[str, object]]:
+    """
+    Send many e‑mails (e.g. replies to a list of messages) at once.
+
+    Args:
+      sender_name:     display name used for every draft.
+      drafts:          one dict per e‑mail with the gmail_send_emails fields:
+                       subject (required), to, cc, bcc, body, mode, thread_id, message_id.
+      max_concurrency: sends in flight at once (at most MAX_SEND_CONCURRENCY).
+
+    Returns:
+      One dict per draft, in order: the gmail_send_emails result, or { subject, error } if that draft failed.
+    """
+    svc = gmail_service()
+    sender_formatted = email.utils.formataddr((sender_name, sender_address(svc)))
+
+    def _send(draft: Dict[str, object]) -> Dict[str, object]:
+        try:
+            return _send_email(svc, sender_formatted, **draft)
+        except Exception as e:
+            return {"subject": draft.get("subject"), "error": str(e)}
 
+    workers = max(1, min(max_concurrency, MAX_SEND_CONCURRENCY, len(drafts)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gmail-send") as pool:
+        return list(pool.map(_send, drafts))
+
+
+def _send_email(
+    svc,
+    sender_formatted: str,
+    subject: str,
+    to: List[str] | None = None,
+    cc: List[str] | None = None,
+    bcc: List[str] | None = None,
+    body: str | None = None,
+    mode: str = "new",
+    thread_id: str | None = None,
+    message_id: str | None = None
+) -> Dict[str, object]:
     if mode in {"reply", "forward"} and not (thread_id or message_id):
         raise ValueError("thread_id or message_id required for reply/forward")
 
@@ -234,7 +606,6 @@ def gmail_send_emails(
     return content
 
 
-
 if __name__ == "__main__":
     gmail_service()
     if len(sys.argv) > 1 and sys.argv[1] == "auth":
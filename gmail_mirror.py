@@ -0,0 +1,406 @@
+import base64
+import html
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+
+# Gmail's inbox tabs, excluded when all_inbox is False
+CATEGORY_LABELS = ["CATEGORY_SOCIAL", "CATEGORY_PROMOTIONS", "CATEGORY_UPDATES", "CATEGORY_FORUMS"]
+# left out of every query unless asked for by label, like the Gmail API does (includeSpamTrash=False)
+SPAM_TRASH_LABELS = ["SPAM", "TRASH"]
+HEADERS = ["From", "Subject", "Date"]
+MAX_BODY_CHARS = 20000
+MAX_SYNC_BACKOFF = 15 * 60   # seconds, longest wait before retrying after failed syncs
+
+
+class MailboxMirror:
+    """
+    Local SQLite copy of the message metadata (id, threadId, headers, snippet, labels)
+    of the last `window_days` of mail, kept current with users.history.list.
+
+    The first sync lists the window on a background thread (queries go to Gmail until it is
+    done); every later sync only asks Gmail for the changes since the stored historyId (one
+    cheap call when nothing happened). If Gmail no longer has that history, the window is
+    listed again. A failed sync is not retried for min_sync_interval, doubled on every
+    consecutive failure up to MAX_SYNC_BACKOFF.
+
+    Every message newer than `covered_since` (ms since epoch) is in the mirror, so a
+    query restricted to that range, or one that finds enough rows, is answered locally.
+
+    With `index_bodies` (and an SQLite built with FTS5) sender, subject, snippet and the
+    plain-text body of every mirrored message are also kept in an FTS5 index, updated by
+    the same syncs, for ranked full-text search (search_text).
+
+    Attributes:
+        db_path (str): sqlite file
+        fts (bool): the full-text index is available
+        window_days (int): how far back the first sync goes
+        max_messages (int): cap on the first sync, covered_since moves up if it is hit
+        min_sync_interval (float): seconds during which a sync is skipped after the last attempt
+        ready (bool): the window has been listed, queries can be answered locally
+    """
+
+    def __init__(self, db_path: str, fetch_messages: Callable, window_days: int = 30, max_messages: int = 2000,
+                 min_sync_interval: float = 15, index_bodies: bool = True):
+        self.db_path = db_path
+        # get_messages(service, ids, format, headers) -> [message resource, ...]
+        self.fetch_messages = fetch_messages
+        self.window_days = window_days
+        self.max_messages = max_messages
+        self.min_sync_interval = min_sync_interval
+        self._last_sync = 0.0
+        self._failures = 0
+        self._retry_at = 0.0
+        self._bootstrap_thread: Optional[threading.Thread] = None
+        # bumped by clear(): a bootstrap started before (maybe for another account) is discarded
+        self._generation = 0
+        self._lock = threading.RLock()
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        try:
+            # mail content, readable by its owner only
+            os.chmod(db_path, 0o600)
+        except OSError:
+            pass
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id TEXT PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                subject TEXT NOT NULL,
+                date TEXT NOT NULL,
+                internal_date INTEGER NOT NULL,
+                snippet TEXT NOT NULL,
+                labels TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_internal_date ON messages (internal_date);
+            CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+        """)
+        self.fts = index_bodies and self._create_fts()
+        self._label_ids: Dict[str, str] = {}
+        self._db.commit()
+
+    def _create_fts(self) -> bool:
+        try:
+            exists = self._db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+            self._db.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                USING fts5(id UNINDEXED, sender, subject, snippet, body, tokenize = 'porter unicode61')
+            """)
+        except sqlite3.OperationalError as e:
+            print("SQLite has no FTS5, full-text mail search disabled:", e)
+            return False
+        if not exists:
+            # messages mirrored before the index existed have no body: list the window again
+            self._db.execute("DELETE FROM state WHERE key = 'history_id'")
+        return True
+
+    @property
+    def _format(self) -> str:
+        # the body is only fetched when it is indexed
+        return "full" if self.fts else "metadata"
+
+    # ─── sync ──────────────────────────────────────────────────────
+    @property
+    def ready(self) -> bool:
+        return self.covered_since is not None
+
+    def sync(self, service, force: bool = False) -> Dict[str, int]:
+        """
+        bring the mirror up to date, returns {'added', 'deleted', 'relabeled'}; {} if skipped
+        or if the window is being listed in the background. force: skip the wait, and list
+        the window in this thread ({'bootstrap': n})
+        """
+        with self._lock:
+            if self._bootstrap_thread is not None and self._bootstrap_thread.is_alive():
+                return {}
+            now = time.time()
+            if not force and (now - self._last_sync < self.min_sync_interval or now < self._retry_at):
+                return {}
+            # stamped before trying: a failing sync is not repeated on every tool call
+            self._last_sync = now
+            history_id = self._get_state("history_id")
+            try:
+                if history_id is None:
+                    return self._start_bootstrap(service, force)
+                try:
+                    counts = self._apply_history(service, history_id)
+                except HttpError as e:
+                    if e.resp.status != 404:
+                        raise
+                    # history expired (about a week), start over; Gmail answers until it is done
+                    print("gmail history expired, re-listing the mailbox window")
+                    with self._db:
+                        self._db.execute("DELETE FROM state WHERE key IN ('history_id', 'covered_since')")
+                    return self._start_bootstrap(service, force)
+            except Exception:
+                self._sync_failed()
+                raise
+            self._failures = 0
+            return counts
+
+    def _start_bootstrap(self, service, wait: bool) -> Dict[str, int]:
+        if wait:
+            try:
+                counts = self._bootstrap(service, self._generation)
+            except Exception:
+                self._sync_failed()
+                raise
+            self._failures = 0
+            return counts
+        self._bootstrap_thread = threading.Thread(target=self._run_bootstrap, args=(service, self._generation),
+                                                  daemon=True, name="gmail-mirror-bootstrap")
+        self._bootstrap_thread.start()
+        return {}
+
+    def _run_bootstrap(self, service, generation: int):
+        try:
+            counts = self._bootstrap(service, generation)
+        except Exception as e:
+            print("mailbox mirror bootstrap failed:", e)
+            with self._lock:
+                self._sync_failed()
+            return
+        print("mailbox mirror ready:", counts)
+        with self._lock:
+            self._failures = 0
+
+    def _sync_failed(self):
+        self._failures += 1
+        self._retry_at = time.time() + min(self.min_sync_interval * 2 ** self._failures, MAX_SYNC_BACKOFF)
+
+    def _bootstrap(self, service, generation: int) -> Dict[str, int]:
+        # the history id is taken first, changes made while listing show up in the next sync
+        history_id = service.users().getProfile(userId="me").execute()["historyId"]
+        since = datetime.now(timezone.utc) - timedelta(days=self.window_days)
+        ids, page_token = [], None
+        while len(ids) < self.max_messages:
+            resp = service.users().messages().list(
+                userId="me",
+                q=f"after:{since.strftime('%Y/%m/%d')}",
+                maxResults=min(500, self.max_messages - len(ids)),
+                pageToken=page_token
+            ).execute()
+            ids.extend(m["id"] for m in resp.get("messages", []))
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+
+        msgs = self.fetch_messages(service, ids, self._format, HEADERS)
+        covered_since = int(since.timestamp() * 1000)
+        if page_token and msgs:
+            # truncated by max_messages, only what is newer than the oldest fetched message is complete
+            covered_since = max(covered_since, min(int(m.get("internalDate", 0)) for m in msgs))
+        with self._lock, self._db:
+            if generation != self._generation:
+                # cleared meanwhile (credentials reset), these messages may be another account's
+                return {}
+            self._db.execute("DELETE FROM messages")
+            if self.fts:
+                self._db.execute("DELETE FROM messages_fts")
+            self._upsert(msgs)
+            self._set_state("history_id", str(history_id))
+            self._set_state("covered_since", str(covered_since))
+        return {"bootstrap": len(msgs)}
+
+    def _apply_history(self, service, history_id: str) -> Dict[str, int]:
+        added, deleted, labels = set(), set(), {}
+        page_token, latest = None, history_id
+        while True:
+            resp = service.users().history().list(
+                userId="me",
+                startHistoryId=history_id,
+                historyTypes=["messageAdded", "messageDeleted", "labelAdded", "labelRemoved"],
+                pageToken=page_token
+            ).execute()
+            for record in resp.get("history", []):
+                for item in record.get("messagesAdded", []):
+                    added.add(item["message"]["id"])
+                    deleted.discard(item["message"]["id"])
+                for item in record.get("messagesDeleted", []):
+                    deleted.add(item["message"]["id"])
+                    added.discard(item["message"]["id"])
+                    labels.pop(item["message"]["id"], None)
+                for item in record.get("labelsAdded", []) + record.get("labelsRemoved", []):
+                    # the record carries the full label set after the change
+                    labels[item["message"]["id"]] = item["message"].get("labelIds", [])
+            latest = resp.get("historyId", latest)
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                break
+
+        msgs = self.fetch_messages(service, sorted(added), self._format, HEADERS) if added else []
+        with self._db:
+            self._upsert(msgs)
+            if deleted:
+                self._db.executemany("DELETE FROM messages WHERE id = ?", [(i,) for i in deleted])
+                if self.fts:
+                    self._db.executemany("DELETE FROM messages_fts WHERE id = ?", [(i,) for i in deleted])
+            relabeled = [(" ".join(label_ids), i) for i, label_ids in labels.items() if i not in added]
+            self._db.executemany("UPDATE messages SET labels = ? WHERE id = ?", relabeled)
+            self._set_state("history_id", str(latest))
+        return {"added": len(msgs), "deleted": len(deleted), "relabeled": len(relabeled)}
+
+    def _upsert(self, msgs: List[dict]):
+        rows = []
+        for msg in msgs:
+            hdr = {h["name"]: h["value"] for h in msg.get("payload", {}).get("headers", [])}
+            rows.append((
+                msg["id"], msg.get("threadId", ""), hdr.get("From", ""), hdr.get("Subject", ""), hdr.get("Date", ""),
+                int(msg.get("internalDate", 0)), msg.get("snippet", ""), " ".join(msg.get("labelIds", [])),
+            ))
+        self._db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        if self.fts:
+            self._db.executemany("DELETE FROM messages_fts WHERE id = ?", [(row[0],) for row in rows])
+            self._db.executemany(
+                "INSERT INTO messages_fts (id, sender, subject, snippet, body) VALUES (?, ?, ?, ?, ?)",
+                [(row[0], row[2], row[3], row[6], message_text(msg.get("payload", {}))) for row, msg in zip(rows, msgs)])
+
+    # ─── queries ───────────────────────────────────────────────────
+    @property
+    def covered_since(self) -> Optional[int]:
+        value = self._get_state("covered_since")
+        return int(value) if value is not None else None
+
+    def covers(self, since_ms: Optional[int]) -> bool:
+        """ True if every message newer than since_ms is mirrored """
+        covered_since = self.covered_since
+        return covered_since is not None and since_ms is not None and since_ms >= covered_since
+
+    def fetch(self, max_results: int, unread_only: bool = False, all_inbox: bool = True, since_ms: Optional[int] = None,
+              after: Optional[Tuple[int, str]] = None) -> List[dict]:
+        """ inbox messages, newest first, with the message rows as dicts;
+            after: (internal_date, id) of the last row of the previous page, only the rows that follow it
+        """
+        where, args = ["' ' || labels || ' ' LIKE '% INBOX %'"], []
+        where.extend(f"' ' || labels || ' ' NOT LIKE '% {label} %'" for label in SPAM_TRASH_LABELS)
+        if unread_only:
+            where.append("' ' || labels || ' ' LIKE '% UNREAD %'")
+        if not all_inbox:
+            where.extend(f"' ' || labels || ' ' NOT LIKE '% {label} %'" for label in CATEGORY_LABELS)
+        if since_ms is not None:
+            where.append("internal_date >= ?")
+            args.append(since_ms)
+        if after is not None:
+            where.append("(internal_date, id) < (?, ?)")
+            args.extend(after)
+        return self._select(where, args, max_results)
+
+    def search(self, sender: Optional[str], subject: Optional[str], max_results: int) -> List[dict]:
+        """ substring match on From / Subject, newest first, spam and trash left out """
+        where = [f"' ' || labels || ' ' NOT LIKE '% {label} %'" for label in SPAM_TRASH_LABELS]
+        args = []
+        if sender:
+            where.append("sender LIKE ?")
+            args.append(f"%{sender}%")
+        if subject:
+            where.append("subject LIKE ?")
+            args.append(f"%{subject}%")
+        return self._select(where, args, max_results)
+
+    def search_text(self, query: str, max_results: int = 10, after_ms: Optional[int] = None, before_ms: Optional[int] = None,
+                    label_ids: Optional[List[str]] = None) -> List[dict]:
+        """
+        Messages matching the words of `query` (all of them, or any if no message has all),
+        best bm25 match first; a subject hit weighs more than a sender hit, more than the body.
+        Spam and trash are left out, unless label_ids asks for them.
+        """
+        words = re.findall(r"\w+", query)
+        if not self.fts or not words:
+            return []
+        where, args = [], []
+        if after_ms is not None:
+            where.append("m.internal_date >= ?")
+            args.append(after_ms)
+        if before_ms is not None:
+            where.append("m.internal_date < ?")
+            args.append(before_ms)
+        for label_id in label_ids or []:
+            where.append("' ' || m.labels || ' ' LIKE ?")
+            args.append(f"% {label_id} %")
+        where.extend(f"' ' || m.labels || ' ' NOT LIKE '% {label} %'" for label in SPAM_TRASH_LABELS if label not in (label_ids or []))
+        filters = "".join(f" AND {w}" for w in where)
+        quoted = [f'"{w}"' for w in words]
+        with self._lock:
+            for match in (" ".join(quoted), " OR ".join(quoted)):
+                cur = self._db.execute(
+                    "SELECT m.*, bm25(messages_fts, 0, 5.0, 10.0, 2.0, 1.0) AS score FROM messages_fts f "
+                    f"JOIN messages m ON m.id = f.id WHERE messages_fts MATCH ?{filters} ORDER BY score LIMIT ?",
+                    [match] + args + [max_results])
+                names = [c[0] for c in cur.description]
+                rows = [dict(zip(names, row)) for row in cur.fetchall()]
+                if rows:
+                    return rows
+        return []
+
+    def label_ids(self, service, names: List[str]) -> List[str]:
+        """ label names (or ids) -> label ids, system labels like INBOX / UNREAD / STARRED are their own id """
+        wanted = {name.lower() for name in names}
+        if any(name not in self._label_ids for name in wanted):
+            for label in service.users().labels().list(userId="me").execute().get("labels", []):
+                self._label_ids[label["name"].lower()] = label["id"]
+                self._label_ids[label["id"].lower()] = label["id"]
+        unknown = [name for name in names if name.lower() not in self._label_ids]
+        if unknown:
+            raise ValueError(f"Unknown Gmail label(s): {', '.join(unknown)}")
+        return [self._label_ids[name.lower()] for name in names]
+
+    def _select(self, where: List[str], args: list, limit: int) -> List[dict]:
+        # id breaks internal_date ties, pages keyed on (internal_date, id) follow this order exactly
+        with self._lock:
+            cur = self._db.execute(
+                f"SELECT * FROM messages WHERE {' AND '.join(where)} ORDER BY internal_date DESC, id DESC LIMIT ?",
+                args + [limit])
+            names = [c[0] for c in cur.description]
+            return [dict(zip(names, row)) for row in cur.fetchall()]
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM messages")
+            self._db.execute("DELETE FROM state")
+            if self.fts:
+                self._db.execute("DELETE FROM messages_fts")
+            self._label_ids.clear()
+            self._last_sync = 0.0
+            self._failures, self._retry_at = 0, 0.0
+            self._generation += 1
+
+    def _get_state(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_state(self, key: str, value: str):
+        self._db.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+
+def message_text(payload: dict) -> str:
+    """ plain-text body of a format="full" message payload: text/plain parts, else the text of text/html parts """
+    plain, markup = [], []
+
+    def _walk(part):
+        mime = part.get("mimeType", "")
+        data = part.get("body", {}).get("data")
+        if data and mime == "text/plain":
+            plain.append(_decode(data))
+        elif data and mime == "text/html":
+            markup.append(_decode(data))
+        for sub in part.get("parts", []):
+            _walk(sub)
+
+    _walk(payload)
+    if plain:
+        text = "\n".join(plain)
+    else:
+        text = html.unescape(re.sub(r"<(script|style).*?</\1>|<[^>]+>", " ", "\n".join(markup), flags=re.S | re.I))
+    return re.sub(r"\s+", " ", text).strip()[:MAX_BODY_CHARS]
+
+
+def _decode(data: str) -> str:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4)).decode("utf-8", errors="replace")
@@ -1,25 +1,89 @@
+import os
 import pyautogui
 import tempfile
 import mss
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
+from util.screenshot_store import ScreenshotStore
 
-def take_screenshot():
+# PNGs of take_screenshot, in a directory of this process only (other running instances have their own,
+# nobody else evicts or deletes these), deleted at exit. ChatBrain pins the last few still referenced by the chat history
+SCREENSHOT_ROOT = os.path.join(tempfile.gettempdir(), "sofia_screenshots")
+os.makedirs(SCREENSHOT_ROOT, exist_ok=True)
+SCREENSHOT_DIR = tempfile.mkdtemp(prefix=f"{os.getpid()}_", dir=SCREENSHOT_ROOT)
+screenshot_store = ScreenshotStore(directory=SCREENSHOT_DIR, max_count=50, max_bytes=256 * 2**20, max_age=3600,
+                                   max_pinned=8, remove_on_exit=True).start()
+
+# PNG persistence runs off the capture -> parse path
+_png_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="png-writer")
+
+
+class ScreenFrame:
     """
-    Capture just the primary monitor (monitors[1] in mss) and
-    return a dict with the temporary PNG path.
+    A captured screen kept in memory, handed to OP_tool.process_image as is
+    (no PNG encode / decode between capture and parse).
+
+    Attributes:
+        pixels (np.ndarray): H x W x 3 RGB uint8
+        path (Optional[str]): PNG file being written in the background, None if not persisted
     """
+
+    def __init__(self, pixels: np.ndarray, path: str = None):
+        self.pixels = pixels
+        self.path = path
+        self._save_future = None
+
+    @property
+    def size(self):
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    def to_pil(self) -> Image.Image:
+        return Image.fromarray(self.pixels)
+
+    def save_async(self, path: str):
+        """ start writing the PNG on the writer thread, wait_saved() blocks until it is on disk """
+        self.path = path
+        # fast zlib level, the file is only read back by the chat model
+        self._save_future = _png_writer.submit(self.to_pil().save, path, compress_level=1)
+        return self
+
+    def wait_saved(self, timeout: float = None):
+        if self._save_future is not None:
+            self._save_future.result(timeout)
+        return self.path
+
+    def __repr__(self):
+        return f"ScreenFrame({self.size[0]}x{self.size[1]}, path={self.path!r})"
+
+
+def capture_frame() -> ScreenFrame:
+    """ grab the primary monitor (monitors[1] in mss) into a ScreenFrame """
     with mss.mss() as sct:
         # monitors[0] = virtual desktop, monitors[1] = primary display
         mon = sct.monitors[1]                # {'left':0,'top':0,'width':..., 'height':...}
         raw = sct.grab(mon)                  # raw BGRA bytes
 
-    img = Image.frombytes("RGB", raw.size, raw.rgb)
+    # BGRA view over the mss buffer, one copy to contiguous RGB
+    bgra = np.frombuffer(raw.bgra, dtype=np.uint8).reshape(raw.height, raw.width, 4)
+    return ScreenFrame(np.ascontiguousarray(bgra[..., 2::-1]))
 
-    tmp = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
-    img.save(tmp.name)
-    tmp.close()                              # keep the file on disk
 
-    return {"path": tmp.name}
+def take_screenshot(persist: bool = True):
+    """
+    Capture just the primary monitor and return a dict with the in-memory
+    frame and, if persist, the temporary PNG path (written in the background,
+    frame.wait_saved() before reading it).
+    """
+    frame = capture_frame()
+    if not persist:
+        return {"path": None, "frame": frame}
+
+    tmp = tempfile.NamedTemporaryFile(suffix=".png", prefix="screenshot_", dir=SCREENSHOT_DIR, delete=False)
+    tmp.close()                              # keep the file on disk
+    frame.save_async(tmp.name)
+    screenshot_store.add(tmp.name)
+    return {"path": tmp.name, "frame": frame}
 
 def move_mouse(x: int, y: int):
     pyautogui.moveTo(x, y)
@@ -1,8 +1,137 @@
 from gmail_mcp import server
 from fastmcp import Client
 from fastmcp.client.transports import FastMCPTransport
-from typing import List, Dict, Optional
+from fastmcp.exceptions import ToolError
+from typing import Any, Callable, Iterable, Iterator, List, Dict, Optional
 import asyncio
+import concurrent.futures
+import json
+import atexit
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class MCPClientManager:
+    """
+    One long-lived MCP session for all the sync tool wrappers.
+
+    The event loop runs on a daemon thread and a keeper task holds the
+    `Client(FastMCPTransport(server))` context open, so a tool call is a single
+    request on an already initialized session instead of a new event loop plus
+    an MCP handshake. A session that cannot be opened is retried once. If a call
+    fails after it was sent (timeout, disconnect) the session is reopened, but the
+    call is only repeated for the `retry_safe_tools`: the server may already have
+    acted, and an e-mail must never be sent twice. A call that outlives `call_timeout`
+    is cancelled and its session closed, the next call opens a fresh one.
+    """
+
+    def __init__(self, server, call_timeout: float = 120, retry_safe_tools: Iterable[str] = ()):
+        self.server = server
+        self.call_timeout = call_timeout
+        self.retry_safe_tools = set(retry_safe_tools)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._client: Optional[Client] = None
+        self._session_task: Optional[asyncio.Task] = None
+        self._closing: Optional[asyncio.Event] = None
+        # one coroutine at a time opens / closes the session, concurrent calls share it
+        self._session_lock: Optional[asyncio.Lock] = None
+        self._lock = threading.Lock()
+
+    def call_tool(self, name: str, arguments: Dict[str, Any], progress_handler=None):
+        """ blocking call_tool on the shared session, safe to use from any thread;
+            progress_handler(progress, total, message) is awaited on the session loop
+        """
+        self._ensure_loop()
+        future = asyncio.run_coroutine_threadsafe(self._call_tool(name, arguments, progress_handler), self._loop)
+        try:
+            return future.result(self.call_timeout)
+        except concurrent.futures.TimeoutError:
+            # the request may still be pending on the session: cancel it and drop the session
+            future.cancel()
+            asyncio.run_coroutine_threadsafe(self._disconnect(), self._loop)
+            raise
+
+    def close(self):
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self._disconnect(), self._loop).result(self.call_timeout)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop, self._thread = None, None
+
+    def _ensure_loop(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._session_lock = asyncio.Lock()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True, name="mcp-client")
+                self._thread.start()
+
+    async def _call_tool(self, name: str, arguments: Dict[str, Any], progress_handler=None):
+        try:
+            client = await self._connect()
+        except Exception as e:
+            # nothing was sent yet, always safe to try again
+            logger.warning("MCP session could not be opened (%r), retrying", e)
+            await self._disconnect()
+            client = await self._connect()
+        try:
+            return await client.call_tool(name, arguments, progress_handler=progress_handler)
+        except ToolError:
+            raise
+        except Exception as e:
+            logger.warning("MCP session failed (%r), reconnecting", e)
+            await self._disconnect(client)
+            if name not in self.retry_safe_tools:
+                raise
+            client = await self._connect()
+            return await client.call_tool(name, arguments, progress_handler=progress_handler)
+
+    async def _connect(self) -> Client:
+        async with self._session_lock:
+            if self._client is not None and not self._session_task.done():
+                return self._client
+            connected = asyncio.get_running_loop().create_future()
+            closing = asyncio.Event()
+            session_task = asyncio.create_task(self._hold_session(connected, closing))
+            try:
+                self._client = await connected
+            except BaseException:
+                session_task.cancel()
+                raise
+            self._closing, self._session_task = closing, session_task
+            return self._client
+
+    async def _hold_session(self, connected: asyncio.Future, closing: asyncio.Event):
+        # the client context is entered and exited by this one task
+        try:
+            async with Client(FastMCPTransport(self.server)) as client:
+                connected.set_result(client)
+                await closing.wait()
+        except Exception as e:
+            if not connected.done():
+                connected.set_exception(e)
+            else:
+                logger.warning("MCP session closed with error: %r", e)
+
+    async def _disconnect(self, client: Optional[Client] = None):
+        """ close the session, only if it is still `client`'s when given (another call may have reopened it) """
+        async with self._session_lock:
+            if client is not None and client is not self._client:
+                return
+            if self._session_task is not None:
+                self._closing.set()
+                await asyncio.gather(self._session_task, return_exceptions=True)
+            self._client, self._session_task = None, None
+
+
+# read-only tools, repeating them after a lost answer has no side effect
+mcp_manager = MCPClientManager(server, retry_safe_tools={"gmail_search_emails", "gmail_search_text"})
+atexit.register(mcp_manager.close)
 
 def gmail_search_emails(
     sender: Optional[str] = None,
@@ -10,25 +139,39 @@ def gmail_search_emails(
     max_results: int = 10
 ) -> List[Dict[str, str]]:
 
-    async def _call():
-        async with Client(FastMCPTransport(server)) as client:
-            return await client.call_tool(
-                "gmail_search_emails",
-                {
-                    "sender": sender,
-                    "subject": subject,
-                    "max_results": max_results
-                }
-            )
-    # run the coroutine and return its result
-    return asyncio.run(_call())
+    return mcp_manager.call_tool(
+        "gmail_search_emails",
+        {
+            "sender": sender,
+            "subject": subject,
+            "max_results": max_results
+        }
+    )
+
+def gmail_search_text(
+    query: str,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    labels: Optional[List[str]] = None,
+    max_results: int = 10
+) -> List[Dict[str, str]]:
+    payload: Dict[str, object] = {"query": query, "max_results": max_results}
+    if after is not None:
+        payload["after"] = after
+    if before is not None:
+        payload["before"] = before
+    if labels:
+        payload["labels"] = labels
+    return mcp_manager.call_tool("gmail_search_text", payload)
 
 def fetch_gmail(
     max_results: int = 5,
     all_inbox: bool = True, #allows listserve emails to be fetched
     unread_only: bool = False,
-    since: Optional[str] = "yesterday"        # NEW  ← "yesterday", "3d", "2025‑04‑15", None
-) -> List[Dict[str, str]]:
+    since: Optional[str] = "yesterday",       # NEW  ← "yesterday", "3d", "2025‑04‑15", None
+    cursor: Optional[str] = None,             # next_cursor of the previous page
+    on_emails: Optional[Callable[[List[Dict[str, str]]], None]] = None
+) -> Dict[str, object]:
     # build payload, omitting None fields
     payload = {
         "max_results":  max_results,
@@ -37,14 +180,27 @@ def fetch_gmail(
     }
     if since is not None:
         payload["since"] = since
+    if cursor:
+        payload["cursor"] = cursor
 
-    async def _call():
-        async with Client(FastMCPTransport(server)) as client:
-            result = await client.call_tool("gmail_fetch_emails", payload)
-            # result.content is a list[dict]; adjust if your server wraps differently
-            return result
+    # every batch of emails arrives early as a progress message, before the whole page
+    progress_handler = None
+    if on_emails is not None:
+        async def progress_handler(progress, total, message):
+            if message:
+                on_emails(json.loads(message))
 
-    return asyncio.run(_call())
+    # structured result: {"emails": [...], "next_cursor": str | None}
+    return mcp_manager.call_tool("gmail_fetch_emails", payload, progress_handler).data
+
+def iter_gmail(page_size: int = 20, **filters) -> Iterator[Dict[str, str]]:
+    """ every email matching the fetch_gmail filters, newest first, fetching page_size at a time as consumed """
+    page = fetch_gmail(max_results=page_size, **filters)
+    while True:
+        yield from page["emails"]
+        if not page["next_cursor"]:
+            return
+        page = fetch_gmail(max_results=page_size, cursor=page["next_cursor"])
 
 def send_gmail(
     sender_name: str,
@@ -56,7 +212,7 @@ def send_gmail(
     mode: str = "new",                # "new" | "reply" | "forward"
     thread_id: Optional[str] = None,
     message_id: Optional[str] = None
-) -> Dict[str, str]:
+) -> Dict[str, object]:
 
     payload: Dict[str, object] = {
         "sender_name": sender_name,
@@ -75,11 +231,20 @@ def send_gmail(
     if message_id:
         payload["message_id"] = message_id
 
-    async def _call():
-        async with Client(FastMCPTransport(server)) as client:
-            result = await client.call_tool("gmail_send_emails", payload)
-            # For this tool result.content is already the dict we want
-            # print(result)
-            return result
+    # For this tool result.content is already the dict we want
+    return mcp_manager.call_tool("gmail_send_emails", payload)
 
-    return asyncio.run(_call())
+def send_gmail_batch(
+    sender_name: str,
+    drafts: List[Dict[str, object]],
+    max_concurrency: int = 4
+) -> List[Dict[str, object]]:
+    # drafts: [{"subject", "to", "cc", "bcc", "body", "mode", "thread_id", "message_id"}, ...]
+    return mcp_manager.call_tool(
+        "gmail_send_batch",
+        {
+            "sender_name": sender_name,
+            "drafts": drafts,
+            "max_concurrency": max_concurrency
+        }
+    )
@@ -1,44 +1,170 @@
 import requests
 import base64
+import json
+from collections.abc import Callable
 from pathlib import Path
-from tools.screen_capture import get_screenshot
+from tools.screen_capture import get_screenshot, screenshot_store
 from agent.llm_utils.utils import encode_image
 
 OUTPUT_DIR = "./tmp/outputs"
 
+class ParsedScreen(dict):
+    """
+    A parse response. Its "som_image_base64" may still be on the server (a som_image_id): it is fetched
+    from GET /som/{som_image_id} the first time it is read, a caller that never looks at it never pays for it.
+    """
+
+    def __init__(self, response_json: dict, fetch_som: Callable[[], bytes] | None = None):
+        super().__init__(response_json)
+        self._fetch_som = fetch_som
+        self._som_image_data = None
+
+    def som_image_data(self) -> bytes:
+        """ the SOM image PNG bytes, decoded from an inline som_image_base64 or fetched once """
+        if self._som_image_data is None:
+            if dict.__contains__(self, 'som_image_base64'):
+                self._som_image_data = base64.b64decode(dict.__getitem__(self, 'som_image_base64'))
+            elif self._fetch_som is not None:
+                self._som_image_data = self._fetch_som()
+            else:
+                raise KeyError('som_image_base64')
+        return self._som_image_data
+
+    def __missing__(self, key):
+        if key != 'som_image_base64' or self._fetch_som is None:
+            raise KeyError(key)
+        self[key] = base64.b64encode(self.som_image_data()).decode("utf-8")
+        return self[key]
+
 class OmniParserClient:
-    def __init__(self, 
-                 url: str) -> None:
+    def __init__(self,
+                 url: str,
+                 session_id: str | None = None,
+                 binary: bool = True,
+                 stream: bool = False,
+                 event_callback: Callable[[dict], None] | None = None,
+                 lazy_captions: bool = False,
+                 som: bool = True) -> None:
         self.url = url
+        # with a session id the server only re-parses the regions that changed since the last call
+        self.session_id = session_id
+        # send the raw PNG to /parse/binary/ instead of base64 JSON
+        self.binary = binary
+        # consume /parse/stream/: OCR text and boxes arrive before the icon captions, each event is passed to event_callback
+        self.stream = stream
+        self.event_callback = event_callback
+        # icons come back uncaptioned with a short descriptor, caption(screenshot_uuid, box_ids) fills the ones that matter
+        self.lazy_captions = lazy_captions
+        # the caller uses the SOM image (the vlm agents): it comes inline with the binary parse and is written to OUTPUT_DIR;
+        # without it only the element list comes back, the SOM is fetched if som_image_base64 is read after all
+        self.som = som
 
     def __call__(self,):
         screenshot, screenshot_path = get_screenshot()
         screenshot_path = str(screenshot_path)
-        image_base64 = encode_image(screenshot_path)
-        response = requests.post(self.url, json={"base64_image": image_base64})
-        response_json = response.json()
+        screenshot_path_uuid = Path(screenshot_path).stem.replace("screenshot_", "")
+        if self.stream:
+            response_json = self.parse_stream(screenshot_path)
+            image_base64 = encode_image(screenshot_path)
+        elif self.binary:
+            response_json = self.parse_binary(screenshot_path, screenshot_id=screenshot_path_uuid)
+            image_base64 = encode_image(screenshot_path)
+        else:
+            image_base64 = encode_image(screenshot_path)
+            response = requests.post(self.url, json={"base64_image": image_base64, "session_id": self.session_id,
+                                                     "lazy_captions": self.lazy_captions, "screenshot_id": screenshot_path_uuid})
+            response_json = ParsedScreen(response.json())
         print('omniparser latency:', response_json['latency'])
 
-        som_image_data = base64.b64decode(response_json['som_image_base64'])
-        screenshot_path_uuid = Path(screenshot_path).stem.replace("screenshot_", "")
-        som_screenshot_path = f"{OUTPUT_DIR}/screenshot_som_{screenshot_path_uuid}.png"
-        with open(som_screenshot_path, "wb") as f:
-            f.write(som_image_data)
-        
+        if self.som:
+            som_screenshot_path = f"{OUTPUT_DIR}/screenshot_som_{screenshot_path_uuid}.png"
+            with open(som_screenshot_path, "wb") as f:
+                f.write(response_json.som_image_data())
+            screenshot_store.add(som_screenshot_path)
+
         response_json['width'] = screenshot.size[0]
         response_json['height'] = screenshot.size[1]
         response_json['original_screenshot_base64'] = image_base64
         response_json['screenshot_uuid'] = screenshot_path_uuid
         response_json = self.reformat_messages(response_json)
         return response_json
-    
+
+    @property
+    def base_url(self):
+        return self.url.rstrip("/").rsplit("/parse", 1)[0]
+
+    def iter_parse_stream(self, screenshot_path: str):
+        """ yield the NDJSON events of /parse/stream/ as they arrive: 'elements', 'captions'..., 'done' """
+        with open(screenshot_path, "rb") as f:
+            image_data = f.read()
+        with requests.post(f"{self.base_url}/parse/stream/", data=image_data, headers={"Content-Type": "image/png"}, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["event"] == "error":
+                    raise RuntimeError(f"omniparser stream failed: {event['detail']}")
+                if event["event"] == "captions":
+                    event["captions"] = {int(idx): caption for idx, caption in event["captions"].items()}
+                yield event
+
+    def fetch_som(self, som_image_id: str) -> bytes:
+        """ GET the SOM image PNG of a parse """
+        som_response = requests.get(f"{self.base_url}/som/{som_image_id}")
+        som_response.raise_for_status()
+        return som_response.content
+
+    def parse_stream(self, screenshot_path: str) -> ParsedScreen:
+        """ consume the stream incrementally, returns the 'done' event; the SOM image is always fetched separately """
+        response_json = None
+        for event in self.iter_parse_stream(screenshot_path):
+            if self.event_callback is not None:
+                self.event_callback(event)
+            if event["event"] == "done":
+                response_json = event
+        if response_json is None:
+            raise RuntimeError("omniparser stream ended without a 'done' event")
+        som_image_id = response_json['som_image_id']
+        return ParsedScreen(response_json, fetch_som=lambda: self.fetch_som(som_image_id))
+
+    def parse_binary(self, screenshot_path: str, screenshot_id: str | None = None) -> ParsedScreen:
+        """ POST the PNG bytes as the request body; with som the SOM image comes in the same response,
+            otherwise it stays on the server until som_image_base64 is read
+        """
+        base_url = self.base_url
+        with open(screenshot_path, "rb") as f:
+            image_data = f.read()
+        params = {"som": "inline" if self.som else "lazy"}
+        if self.session_id:
+            params["session_id"] = self.session_id
+        if self.lazy_captions:
+            params["lazy_captions"] = "true"
+            if screenshot_id:
+                params["screenshot_id"] = screenshot_id
+        response = requests.post(f"{base_url}/parse/binary/", data=image_data, params=params, headers={"Content-Type": "image/png"})
+        response.raise_for_status()
+        response_json = response.json()
+        if 'som_image_id' not in response_json:
+            return ParsedScreen(response_json)
+        som_image_id = response_json['som_image_id']
+        return ParsedScreen(response_json, fetch_som=lambda: self.fetch_som(som_image_id))
+
+    def caption(self, screenshot_uuid: str, box_ids: list[int]) -> dict[int, str]:
+        """ caption some icons of a lazy_captions parse, returns {box_id: content} """
+        response = requests.post(f"{self.base_url}/caption/", json={"screenshot_id": screenshot_uuid, "box_ids": box_ids})
+        response.raise_for_status()
+        return {int(idx): content for idx, content in response.json()["captions"].items()}
+
     def reformat_messages(self, response_json: dict):
         screen_info = ""
         for idx, element in enumerate(response_json["parsed_content_list"]):
             element['idx'] = idx
             if element['type'] == 'text':
                 screen_info += f'ID: {idx}, Text: {element["content"]}\n'
+            elif element['type'] == 'icon' and element['content'] is None:
+                screen_info += f'ID: {idx}, Icon (not captioned): {element.get("descriptor", "")}\n'
             elif element['type'] == 'icon':
                 screen_info += f'ID: {idx}, Icon: {element["content"]}\n'
         response_json['screen_info'] = screen_info
-        return response_json
\ No newline at end of file
+        return response_json
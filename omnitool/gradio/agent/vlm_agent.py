@@ -13,6 +13,7 @@ from anthropic.types.beta import BetaMessage, BetaTextBlock, BetaToolUseBlock, B
 from agent.llm_utils.oaiclient import run_oai_interleaved
 from agent.llm_utils.groqclient import run_groq_interleaved
 from agent.llm_utils.utils import is_image_path
+from tools.screen_capture import screenshot_store
 import time
 import re
 
@@ -89,6 +90,8 @@ class VLMAgent:
                 planner_messages[-1]["content"] = [planner_messages[-1]["content"]]
             planner_messages[-1]["content"].append(f"{OUTPUT_DIR}/screenshot_{screenshot_uuid}.png")
             planner_messages[-1]["content"].append(f"{OUTPUT_DIR}/screenshot_som_{screenshot_uuid}.png")
+        # screenshots dropped from the history above may now be evicted
+        screenshot_store.retain_referenced(planner_messages)
 
         start = time.time()
         if "gpt" in self.model or "o1" in self.model or "o3-mini" in self.model:
@@ -3,6 +3,7 @@ Agentic sampling loop that calls the Anthropic API and local implenmentation of
 """
 from collections.abc import Callable
 from enum import StrEnum
+from uuid import uuid4
 
 from anthropic import APIResponse
 from anthropic.types import (
@@ -55,7 +56,9 @@ def sampling_loop_sync(
     Synchronous agentic sampling loop for the assistant/tool interaction of computer use.
     """
     print('in sampling_loop_sync, model:', model)
-    omniparser_client = OmniParserClient(url=f"http://{omniparser_url}/parse/")
+    # the anthropic loop only sends screen_info, the vlm agents also show / send the SOM image
+    omniparser_client = OmniParserClient(url=f"http://{omniparser_url}/parse/", session_id=uuid4().hex,
+                                         som=model != "claude-3-5-sonnet-20241022")
     if model == "claude-3-5-sonnet-20241022":
         # Register Actor and Executor
         actor = AnthropicActor(
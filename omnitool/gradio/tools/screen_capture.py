@@ -1,12 +1,20 @@
+import os
+import sys
 from pathlib import Path
 from uuid import uuid4
 import requests
 from PIL import Image
 from .base import BaseAnthropicTool, ToolError
 from io import BytesIO
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+sys.path.append(root_dir)
+from util.screenshot_store import ScreenshotStore
 
 OUTPUT_DIR = "./tmp/outputs"
 
+# screenshots and their SOM copies in OUTPUT_DIR, bounded; the agents pin the ones still in the message history
+screenshot_store = ScreenshotStore(directory=OUTPUT_DIR, max_count=200, max_bytes=512 * 2**20, max_age=2 * 3600).start()
+
 def get_screenshot(resize: bool = False, target_width: int = 1920, target_height: int = 1080):
     """Capture screenshot by requesting from HTTP endpoint - returns native resolution unless resized"""
     output_dir = Path(OUTPUT_DIR)
@@ -24,6 +32,7 @@ def get_screenshot(resize: bool = False, target_width: int = 1920, target_height
         if resize and screenshot.size != (target_width, target_height):
             screenshot = screenshot.resize((target_width, target_height))
         screenshot.save(path)
+        screenshot_store.add(path)
         return screenshot, path
     except Exception as e:
         raise ToolError(f"Failed to capture screenshot: {str(e)}")
\ No newline at end of file
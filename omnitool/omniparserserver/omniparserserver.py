@@ -1,12 +1,24 @@
 '''
 python -m omniparserserver --som_model_path ../../weights/icon_detect/model.pt --caption_model_name florence2 --caption_model_path ../../weights/icon_caption_florence --device cuda --BOX_TRESHOLD 0.05
+cpu only:
+python -m omniparserserver --som_model_path ../../weights/icon_detect/model.pt --som_model_backend onnx --caption_model_name florence2_int8 --caption_model_path ../../weights/icon_caption_florence --device cpu --BOX_TRESHOLD 0.05
 '''
 
 import sys
 import os
 import time
-from fastapi import FastAPI
+import asyncio
+import base64
+import binascii
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from PIL import Image
+from typing import List, Optional, Union
 import argparse
 import uvicorn
 root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -16,9 +28,19 @@ from util.omniparser import Omniparser
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Omniparser API')
     parser.add_argument('--som_model_path', type=str, default='../../weights/icon_detect/model.pt', help='Path to the som model')
-    parser.add_argument('--caption_model_name', type=str, default='florence2', help='Name of the caption model')
+    parser.add_argument('--som_model_backend', type=str, default='torch', choices=['torch', 'onnx'], help='Run the som model with PyTorch or ONNX Runtime (exported on first use)')
+    parser.add_argument('--caption_model_name', type=str, default='florence2', choices=['florence2', 'florence2_int8', 'blip2'], help='Name of the caption model, florence2_int8 is the int8 quantized cpu backend')
     parser.add_argument('--caption_model_path', type=str, default='../../weights/icon_caption_florence', help='Path to the caption model')
-    parser.add_argument('--device', type=str, default='cpu', help='Device to run the model')
+    parser.add_argument('--device', type=str, default=None, help='Device to run the models on (cpu, cuda), cuda when available if not set')
+    parser.add_argument('--ocr_engine', type=str, default='easyocr', choices=['easyocr', 'paddleocr'], help='OCR engine, only this one is loaded')
+    parser.add_argument('--ocr_tile_size', type=int, default=None, help='OCR screenshots larger than this in overlapping tiles (e.g. 1600 for 4K screens)')
+    parser.add_argument('--ocr_tile_workers', type=int, default=1, help='Processes used for tiled OCR')
+    parser.add_argument('--caption_cache_path', type=str, default=None, help='Optional sqlite file to persist icon captions across restarts')
+    parser.add_argument('--caption_cache_size', type=int, default=4096, help='Number of icon captions kept in memory')
+    parser.add_argument('--caption_batch_size', type=int, default=None, help='Icons captioned per forward pass, tuned from the available memory if not set')
+    parser.add_argument('--max_batch_size', type=int, default=4, help='Max number of concurrent /parse/ requests parsed together')
+    parser.add_argument('--max_batch_wait_ms', type=float, default=20, help='How long to wait for more requests before running a batch')
+    parser.add_argument('--max_screenshots', type=int, default=32, help='Number of lazy_captions parses kept for /caption/')
     parser.add_argument('--BOX_TRESHOLD', type=float, default=0.05, help='Threshold for box detection')
     parser.add_argument('--host', type=str, default='0.0.0.0', help='Host for the API')
     parser.add_argument('--port', type=int, default=8000, help='Port for the API')
@@ -31,21 +53,270 @@ config = vars(args)
 app = FastAPI()
 omniparser = Omniparser(config)
 
+
+class ParseBatcher:
+    """
+    Coalesces concurrent /parse/ requests: requests are queued, up to `max_batch_size` of them
+    (waiting at most `max_batch_wait_ms` for the batch to fill) are parsed together on a single
+    inference thread, so the event loop stays free and each caller's future is resolved with its own result.
+    """
+
+    def __init__(self, omniparser: Omniparser, max_batch_size: int = 4, max_batch_wait_ms: float = 20):
+        self.omniparser = omniparser
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait_ms / 1000
+        self.queue: Optional[asyncio.Queue] = None
+        # models are not thread safe, every batch runs on the same worker thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        asyncio.get_running_loop().create_task(self._worker())
+
+    async def submit(self, image: Union[str, bytes, Image.Image], session_id: Optional[str] = None, render_overlay: bool = True,
+                     lazy_captions: bool = False, screenshot_id: Optional[str] = None):
+        """ returns (som_image_base64 or None, parsed_content_list, decoded PIL image, batch size, stage timings) """
+        future = asyncio.get_running_loop().create_future()
+        options = {'session_id': session_id, 'render_overlay': render_overlay, 'lazy_captions': lazy_captions, 'screenshot_id': screenshot_id}
+        await self.queue.put((image, options, future))
+        return await future
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_batch_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                results = await loop.run_in_executor(self.executor, self._run_batch, batch)
+            except Exception as e:
+                results = [e] * len(batch)
+            # every request gets its own result, or the exception of its own parse
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _run_batch(self, batch):
+        """ one result per request: (som_image_base64 or None, parsed_content_list, image, batch size, timings), or the exception of that request """
+        print('parsing batch of', len(batch))
+        options = [options for _, options, _ in batch]
+        results = [None] * len(batch)
+        timings = [{} for _ in batch]
+        images = [None] * len(batch)
+        for i, (image, _, _) in enumerate(batch):
+            try:
+                images[i] = self.omniparser.load_image(image)
+            except Exception as e:
+                results[i] = e
+        # incremental requests depend on their session's previous frame, parse them one by one
+        for i, opts in enumerate(options):
+            if opts['session_id'] is not None and results[i] is None:
+                try:
+                    results[i] = self.omniparser.parse(images[i], timings=timings[i], **opts)
+                except Exception as e:
+                    results[i] = e
+        for lazy_captions in (False, True):
+            stateless = [i for i, opts in enumerate(options) if opts['session_id'] is None and opts['lazy_captions'] == lazy_captions and results[i] is None]
+            if not stateless:
+                continue
+            try:
+                self._parse_stateless(stateless, images, options, results, timings, lazy_captions)
+            except Exception as e:
+                if len(stateless) == 1:
+                    results[stateless[0]] = e
+                    continue
+                # find the request that broke the batch: parse them one by one, each failing on its own
+                print('batch failed, parsing its requests one by one:', e)
+                for i in stateless:
+                    try:
+                        self._parse_stateless([i], images, options, results, timings, lazy_captions)
+                    except Exception as e:
+                        results[i] = e
+        return [result if isinstance(result, Exception) else (result[0], result[1], image, len(batch), stage_timings)
+                for result, image, stage_timings in zip(results, images, timings)]
+
+    def _parse_stateless(self, indices, images, options, results, timings, lazy_captions):
+        batch_timings = {}
+        parsed = self.omniparser.parse_batch([images[i] for i in indices], render_overlay=False, timings=batch_timings,
+                                             lazy_captions=lazy_captions, screenshot_ids=[options[i]['screenshot_id'] for i in indices])
+        for i, (_, parsed_content_list) in zip(indices, parsed):
+            # the batch stages are shared by all its requests, only the overlay is per caller
+            timings[i] = dict(batch_timings)
+            try:
+                dino_labled_img = self.omniparser.render(images[i], parsed_content_list, timings=timings[i]) if options[i]['render_overlay'] else None
+                results[i] = (dino_labled_img, parsed_content_list)
+            except Exception as e:
+                results[i] = e
+
+
+batcher = ParseBatcher(omniparser, max_batch_size=args.max_batch_size, max_batch_wait_ms=args.max_batch_wait_ms)
+
+@app.on_event("startup")
+async def startup():
+    batcher.start()
+
 class ParseRequest(BaseModel):
     base64_image: str
+    session_id: Optional[str] = None # reuse the previous frame of this session, only re-parse changed regions
+    lazy_captions: bool = False # leave icons uncaptioned ('content': None + 'descriptor'), caption them later with /caption/
+    screenshot_id: Optional[str] = None # id to pass to /caption/, generated if lazy_captions and not given
+
+class CaptionRequest(BaseModel):
+    screenshot_id: str
+    box_ids: List[int]
+
+async def decode_image(data: Union[str, bytes]) -> Image.Image:
+    """ decode a base64 string / encoded image bytes off the event loop, 400 if it is not a valid image """
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, omniparser.load_image, data)
+    except (binascii.Error, ValueError, OSError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=400, detail=f"invalid image: {e}")
+
+async def decode_body(request: Request) -> Image.Image:
+    """ the image in a /parse/binary/ or /parse/stream/ body: PNG/JPEG/WebP bytes, or raw RGB pixels with
+        Content-Type application/octet-stream and the shape in the X-Image-Width / X-Image-Height headers
+    """
+    body = await request.body()
+    if not request.headers.get('content-type', '').startswith('application/octet-stream'):
+        return await decode_image(body)
+    try:
+        size = (int(request.headers['x-image-width']), int(request.headers['x-image-height']))
+        return Image.frombytes('RGB', size, body)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"raw RGB body needs a matching X-Image-Width / X-Image-Height: {e}")
 
 @app.post("/parse/")
 async def parse(parse_request: ParseRequest):
     print('start parsing...')
     start = time.time()
-    dino_labled_img, parsed_content_list = omniparser.parse(parse_request.base64_image)
+    screenshot_id = parse_request.screenshot_id or uuid4().hex
+    # a bad image fails its own request here, never the batch it would have joined
+    image = await decode_image(parse_request.base64_image)
+    dino_labled_img, parsed_content_list, _, batch_size, timings = await batcher.submit(image, session_id=parse_request.session_id,
+                                                                                        lazy_captions=parse_request.lazy_captions, screenshot_id=screenshot_id)
     latency = time.time() - start
     print('time:', latency)
-    return {"som_image_base64": dino_labled_img, "parsed_content_list": parsed_content_list, 'latency': latency}
+    response = {"som_image_base64": dino_labled_img, "parsed_content_list": parsed_content_list, 'latency': latency, 'batch_size': batch_size, 'timings': timings}
+    if parse_request.lazy_captions:
+        response['screenshot_id'] = screenshot_id
+    return response
+
+# (screenshot, parsed_content_list) of /parse/binary/ requests with som=lazy, the SOM image
+# is only drawn when it is fetched from /som/{som_id}
+som_images: "OrderedDict[str, tuple]" = OrderedDict()
+MAX_SOM_IMAGES = 32
+
+@app.post("/parse/binary/")
+async def parse_binary(request: Request, session_id: Optional[str] = None, som: str = 'lazy', lazy_captions: bool = False, screenshot_id: Optional[str] = None):
+    """
+    Body is the raw image: PNG/JPEG/WebP bytes, or raw RGB pixels with Content-Type application/octet-stream
+    and the shape in the X-Image-Width / X-Image-Height headers.
+    som: 'inline' returns som_image_base64, 'lazy' returns a som_image_id for GET /som/{som_id}, 'none' skips it
+    lazy_captions / screenshot_id: same as /parse/
+    """
+    if som not in {'inline', 'lazy', 'none'}:
+        raise HTTPException(status_code=400, detail=f"som must be one of inline, lazy, none, got {som}")
+    print('start parsing...')
+    start = time.time()
+    image = await decode_body(request)
+    screenshot_id = screenshot_id or uuid4().hex
+    dino_labled_img, parsed_content_list, image, batch_size, timings = await batcher.submit(image, session_id=session_id, render_overlay=som == 'inline',
+                                                                                            lazy_captions=lazy_captions, screenshot_id=screenshot_id)
+    latency = time.time() - start
+    print('time:', latency)
+
+    response = {"parsed_content_list": parsed_content_list, 'latency': latency, 'batch_size': batch_size, 'timings': timings}
+    if lazy_captions:
+        response['screenshot_id'] = screenshot_id
+    if som == 'inline':
+        response['som_image_base64'] = dino_labled_img
+    elif som == 'lazy':
+        som_id = uuid4().hex
+        som_images[som_id] = (image, parsed_content_list)
+        while len(som_images) > MAX_SOM_IMAGES:
+            som_images.popitem(last=False)
+        response['som_image_id'] = som_id
+    return response
+
+@app.post("/parse/stream/")
+async def parse_stream(request: Request, caption_batch_size: int = 32):
+    """
+    Same body as /parse/binary/ (encoded or raw RGB), answers with NDJSON: an 'elements' line with the boxes and OCR text
+    (icons awaiting a caption have content None), 'captions' lines as icon caption batches finish,
+    then a 'done' line with the full list, latency and a som_image_id for GET /som/{som_id}.
+    """
+    print('start stream parsing...')
+    start = time.time()
+    decoded = [await decode_body(request)]
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def _produce():
+        try:
+            for event in omniparser.parse_stream(decoded[0], caption_batch_size=caption_batch_size):
+                loop.call_soon_threadsafe(events.put_nowait, event)
+        except Exception as e:
+            loop.call_soon_threadsafe(events.put_nowait, {'event': 'error', 'detail': str(e)})
+        loop.call_soon_threadsafe(events.put_nowait, None)
+
+    # same inference thread as the batched parses, the models are never used concurrently
+    loop.run_in_executor(batcher.executor, _produce)
+
+    async def _lines():
+        while (event := await events.get()) is not None:
+            if event['event'] == 'done':
+                som_id = uuid4().hex
+                som_images[som_id] = (decoded[0], event['parsed_content_list'])
+                while len(som_images) > MAX_SOM_IMAGES:
+                    som_images.popitem(last=False)
+                event['som_image_id'] = som_id
+                event['latency'] = time.time() - start
+                print('time:', event['latency'])
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(_lines(), media_type="application/x-ndjson")
+
+@app.post("/caption/")
+async def caption(caption_request: CaptionRequest):
+    """ caption some elements of a lazy_captions parse, returns {"captions": {box_id: content}} """
+    start = time.time()
+    timings = {}
+    try:
+        # the caption model lives on the inference thread
+        captions = await asyncio.get_running_loop().run_in_executor(
+            batcher.executor, omniparser.caption, caption_request.screenshot_id, caption_request.box_ids, timings)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"screenshot {caption_request.screenshot_id} not found or evicted, parse it with lazy_captions first")
+    except IndexError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"captions": captions, 'latency': time.time() - start, 'timings': timings}
+
+@app.get("/som/{som_id}")
+async def get_som(som_id: str):
+    if som_id not in som_images:
+        raise HTTPException(status_code=404, detail=f"SOM image {som_id} not found or evicted")
+    image, parsed_content_list = som_images[som_id]
+    dino_labled_img = await asyncio.get_running_loop().run_in_executor(None, omniparser.render, image, parsed_content_list)
+    return Response(content=base64.b64decode(dino_labled_img), media_type="image/png")
+
+@app.get("/stats/")
+async def stats():
+    return {"caption_cache": omniparser.caption_cache.stats(), "caption_batch": omniparser.caption_batch_sizer.stats(), "parse_queue": batcher.queue.qsize() if batcher.queue else 0}
 
 @app.get("/probe/")
 async def root():
     return {"message": "Omniparser API ready"}
 
 if __name__ == "__main__":
-    uvicorn.run("omniparserserver:app", host=args.host, port=args.port, reload=True)
\ No newline at end of file
+    uvicorn.run("omniparserserver:app", host=args.host, port=args.port, reload=True)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the modules live at the repository root (and in util/), like the scripts that import them
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(root_dir)
@@ -0,0 +1,97 @@
+""" the cpu backends (onnx icon detector, int8 caption model) against the default ones, and their caption cache keys """
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+utils = pytest.importorskip("util.utils")
+from util.caption_cache import CaptionCache
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOM_MODEL_PATH = os.path.join(root_dir, "weights", "icon_detect", "model.pt")
+CAPTION_MODEL_PATH = os.path.join(root_dir, "weights", "icon_caption_florence")
+SCREENSHOT = os.path.join(root_dir, "images", "macos.jpg")
+needs_weights = pytest.mark.skipif(not (os.path.exists(SOM_MODEL_PATH) and os.path.isdir(CAPTION_MODEL_PATH)),
+                                   reason="needs the model weights in weights/")
+
+
+class FakeProcessor:
+    """ the bits of the Florence-2 processor caption_icon_crops uses, every caption is the backend name """
+
+    def __init__(self, caption):
+        self.caption = caption
+        self.image_processor = SimpleNamespace(size={"height": 8, "width": 8}, resample=3, rescale_factor=1 / 255,
+                                               image_mean=[0.5] * 3, image_std=[0.5] * 3)
+
+    def __call__(self, images, text, return_tensors):
+        return {"input_ids": torch.ones((1, 3), dtype=torch.long), "pixel_values": None}
+
+    def batch_decode(self, ids, skip_special_tokens):
+        return [self.caption] * len(ids)
+
+
+def fake_caption_model_processor(model_name, path="weights/icon_caption_florence"):
+    model = SimpleNamespace(config=SimpleNamespace(name_or_path=path), device=torch.device("cpu"), dtype=torch.float32,
+                            generate=lambda input_ids, pixel_values, **kwargs: torch.ones((len(pixel_values), 2), dtype=torch.long))
+    return {"model": model, "processor": FakeProcessor(model_name), "model_name": model_name}
+
+
+def test_cache_key_includes_backend():
+    cache = CaptionCache()
+    crops = [np.full((64, 64, 3), i, dtype=np.uint8) for i in range(3)]
+    # same weights, different backends: the int8 model must not get the float32 model's captions
+    assert utils.caption_icon_crops(crops, fake_caption_model_processor("florence2"), caption_cache=cache) == ["florence2"] * 3
+    assert utils.caption_icon_crops(crops, fake_caption_model_processor("florence2_int8"), caption_cache=cache) == ["florence2_int8"] * 3
+    assert utils.caption_icon_crops(crops, fake_caption_model_processor("florence2"), caption_cache=cache) == ["florence2"] * 3
+
+
+def test_no_batch_size_without_sizer():
+    crops = [np.full((64, 64, 3), i, dtype=np.uint8) for i in range(5)]
+    assert utils.caption_icon_crops(crops, fake_caption_model_processor("florence2"), batch_size=None) == ["florence2"] * 5
+
+
+def iou(a, b):
+    inter = np.clip(np.minimum(a[:, None, 2:], b[None, :, 2:]) - np.maximum(a[:, None, :2], b[None, :, :2]), 0, None).prod(-1)
+    area_a, area_b = (a[:, 2:] - a[:, :2]).prod(-1), (b[:, 2:] - b[:, :2]).prod(-1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter)
+
+
+@needs_weights
+def test_onnx_boxes_match_torch():
+    pytest.importorskip("ultralytics")
+    pytest.importorskip("onnxruntime")
+    from PIL import Image
+    image = Image.open(SCREENSHOT).convert("RGB")
+    boxes = {}
+    for backend in ["torch", "onnx"]:
+        model = utils.get_yolo_model(SOM_MODEL_PATH, backend=backend, device="cpu")
+        xyxy, _, _ = utils.predict_yolo(model, image, box_threshold=0.05, imgsz=None, scale_img=False, iou_threshold=0.1)
+        boxes[backend] = np.asarray(xyxy.cpu(), dtype=np.float64)
+    assert len(boxes["torch"]) > 0
+    # almost every box found again at (nearly) the same place, the onnx export is not bit exact
+    best = iou(boxes["torch"], boxes["onnx"]).max(axis=1)
+    assert abs(len(boxes["onnx"]) - len(boxes["torch"])) <= 0.05 * len(boxes["torch"])
+    assert (best > 0.9).mean() >= 0.95
+
+
+@needs_weights
+def test_int8_captions_match_float32():
+    pytest.importorskip("ultralytics")
+    pytest.importorskip("transformers")
+    from PIL import Image
+    image = Image.open(SCREENSHOT).convert("RGB")
+    w, h = image.size
+    model = utils.get_yolo_model(SOM_MODEL_PATH, device="cpu")
+    xyxy, _, _ = utils.predict_yolo(model, image, box_threshold=0.05, imgsz=None, scale_img=False, iou_threshold=0.1)
+    boxes = np.asarray(xyxy.cpu(), dtype=np.float64)[:64] / [w, h, w, h]
+    crops = utils.crop_icon_images(boxes, np.asarray(image))
+
+    captions = {}
+    for model_name in ["florence2", "florence2_int8"]:
+        caption_model_processor = utils.get_caption_model_processor(model_name, CAPTION_MODEL_PATH, device="cpu")
+        captions[model_name] = utils.caption_icon_crops(crops, caption_model_processor, batch_size=16)
+    # int8 rounding changes a word here and there, most captions stay the same
+    same = np.mean([a == b for a, b in zip(captions["florence2"], captions["florence2_int8"])])
+    assert same >= 0.8
@@ -0,0 +1,195 @@
+""" gmail_mcp against a local fake Gmail API: service cache, batched gets, sender identity and batch send """
+import json
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# the mirror database must not land in the user's data directory
+os.environ.setdefault("SOFIA_GMAIL_MIRROR", os.path.join(tempfile.mkdtemp(), "gmail_mirror.sqlite"))
+gmail_mcp = pytest.importorskip("gmail_mcp")
+
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest
+
+
+class FakeGmail:
+    """
+    Just enough of the Gmail REST API: messages.get (alone or in a batch), getProfile and messages.send.
+
+    Attributes:
+        batch_sizes (list): number of gets in every batch request received
+        fail (dict): message id -> list of HTTP statuses answered (one per attempt) before succeeding
+        profile_calls (int): getProfile requests
+        sent (list): raw bodies of messages.send
+    """
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.fail = {}
+        self.profile_calls = 0
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith("/gmail/v1/users/me/profile"):
+                    with fake.lock:
+                        fake.profile_calls += 1
+                    return self._json(200, {"emailAddress": "me@example.com", "historyId": "1"})
+                status, body = fake.get(re.search(r"/messages/([^?]+)", self.path).group(1))
+                self._json(status, body)
+
+            def do_POST(self):
+                data = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                if self.path.startswith("/batch/"):
+                    return self._batch(data)
+                with fake.lock:
+                    fake.in_flight += 1
+                    fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+                # not time.sleep, the fixture turns it off for the retry backoff
+                threading.Event().wait(0.05)
+                with fake.lock:
+                    fake.in_flight -= 1
+                    fake.sent.append(json.loads(data))
+                    sent_id = f"sent{len(fake.sent)}"
+                self._json(200, {"id": sent_id, "threadId": sent_id})
+
+            def _batch(self, data):
+                boundary = self.headers["Content-Type"].split("boundary=")[1].strip('"')
+                parts = [p for p in data.split("--" + boundary) if "GET " in p]
+                with fake.lock:
+                    fake.batch_sizes.append(len(parts))
+                out = ""
+                for part in reversed(parts):  # answers may come in any order
+                    content_id = re.search(r"Content-ID: <(.+?)>", part).group(1)
+                    status, body = fake.get(re.search(r"/messages/([^?\s]+)", part).group(1))
+                    out += (f"--resp\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                            f"HTTP/1.1 {status} X\r\nContent-Type: application/json\r\n\r\n{json.dumps(body)}\r\n")
+                out += "--resp--"
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/mixed; boundary=resp")
+                self.end_headers()
+                self.wfile.write(out.encode())
+
+            def _json(self, status, body):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(json.dumps(body).encode())
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def get(self, message_id):
+        with self.lock:
+            statuses = self.fail.get(message_id)
+            if statuses:
+                return statuses.pop(0), {"error": {"code": 0, "message": "fake failure"}}
+        return 200, {"id": message_id, "snippet": "snippet " + message_id,
+                     "payload": {"headers": [{"name": "Subject", "value": "subject " + message_id}]}}
+
+
+@pytest.fixture
+def fake_gmail(monkeypatch, tmp_path):
+    """ gmail_mcp wired to a fresh FakeGmail, with a valid token.json and no sleeping between retries """
+    fake = FakeGmail()
+    token_file = tmp_path / "token.json"
+    token_file.write_text("{}")
+    builds = []
+
+    def load_credentials():
+        return Credentials(token="token", expiry=datetime.utcnow() + timedelta(hours=1))
+
+    real_build = gmail_mcp.build
+
+    def build(*args, **kwargs):
+        service = real_build(*args, client_options={"api_endpoint": fake.url}, **kwargs)
+        # the discovery document's batch path ignores api_endpoint
+        service.new_batch_http_request = lambda callback=None: BatchHttpRequest(callback=callback, batch_uri=fake.url + "/batch/gmail/v1")
+        builds.append(service)
+        return service
+
+    monkeypatch.setattr(gmail_mcp, "TOKEN_FILE", str(token_file))
+    monkeypatch.setattr(gmail_mcp, "_load_credentials", load_credentials)
+    monkeypatch.setattr(gmail_mcp, "build", build)
+    monkeypatch.setattr(gmail_mcp.time, "sleep", lambda seconds: None)
+    gmail_mcp.reset_gmail_service()
+    fake.token_file, fake.builds = token_file, builds
+    yield fake
+    gmail_mcp.reset_gmail_service()
+    fake.server.shutdown()
+
+
+def test_service_is_cached_until_token_removed(fake_gmail, monkeypatch):
+    cleared = []
+    monkeypatch.setattr(gmail_mcp.mirror, "clear", lambda: cleared.append(True))
+    service = gmail_mcp.gmail_service()
+    assert gmail_mcp.gmail_service() is service
+    assert len(fake_gmail.builds) == 1
+
+    # reset_google_cred removes token.json: authorise again, drop the mirrored mail
+    fake_gmail.token_file.unlink()
+    assert gmail_mcp.gmail_service() is not service
+    assert len(fake_gmail.builds) == 2
+    assert cleared
+
+
+def test_get_messages_splits_batches(fake_gmail):
+    ids = [f"m{i}" for i in range(2 * gmail_mcp.BATCH_SIZE + 20)]
+    msgs = gmail_mcp.get_messages_metadata(gmail_mcp.gmail_service(), ids, ["Subject"])
+    assert fake_gmail.batch_sizes == [gmail_mcp.BATCH_SIZE, gmail_mcp.BATCH_SIZE, 20]
+    # in the order of ids, whatever the order of the batch answers
+    assert [m["id"] for m in msgs] == ids
+
+
+def test_get_messages_retries_rate_limited_items(fake_gmail):
+    fake_gmail.fail = {"m3": [429, 503], "m60": [500]}
+    ids = [f"m{i}" for i in range(70)]
+    msgs = gmail_mcp.get_messages(gmail_mcp.gmail_service(), ids)
+    assert [m["id"] for m in msgs] == ids
+    # only the failed items are sent again
+    assert fake_gmail.batch_sizes == [50, 20, 2, 1]
+
+
+def test_get_messages_raises_item_error(fake_gmail):
+    fake_gmail.fail = {"m1": [404]}
+    with pytest.raises(HttpError) as error:
+        gmail_mcp.get_messages(gmail_mcp.gmail_service(), ["m0", "m1", "m2"])
+    assert error.value.resp.status == 404
+
+
+def test_sender_identity_cached_per_credential(fake_gmail):
+    gmail_mcp.gmail_send_emails("Alex", "one", to=["a@example.com"])
+    gmail_mcp.gmail_send_emails("Alex", "two", to=["a@example.com"])
+    assert fake_gmail.profile_calls == 1
+    assert len(fake_gmail.sent) == 2
+
+    # a new credential asks again
+    fake_gmail.token_file.unlink()
+    gmail_mcp.gmail_send_emails("Alex", "three", to=["a@example.com"])
+    assert fake_gmail.profile_calls == 2
+
+
+def test_send_batch(fake_gmail):
+    drafts = [{"subject": f"re {i}", "to": ["a@example.com"], "body": "ok"} for i in range(10)]
+    drafts.insert(3, {"subject": "bad", "mode": "reply"})   # reply without thread_id / message_id
+    results = gmail_mcp.gmail_send_batch("Alex", drafts)
+
+    assert [r["subject"] for r in results] == [d["subject"] for d in drafts]
+    assert "error" in results[3] and all("id" in r for i, r in enumerate(results) if i != 3)
+    assert len(fake_gmail.sent) == 10
+    assert fake_gmail.profile_calls == 1
+    assert 1 < fake_gmail.max_in_flight <= gmail_mcp.MAX_SEND_CONCURRENCY
@@ -0,0 +1,42 @@
+""" MailboxMirror queries over a local database, no Gmail involved """
+import pytest
+
+gmail_mirror = pytest.importorskip("gmail_mirror")
+
+
+def message(msg_id, labels, subject="quarterly report", internal_date=None):
+    return {"id": msg_id, "threadId": msg_id, "labelIds": labels, "snippet": "numbers inside",
+            "internalDate": str(internal_date or 1700000000000 + int(msg_id[1:])),
+            "payload": {"mimeType": "text/plain", "headers": [
+                {"name": "From", "value": "Alex <alex@example.com>"}, {"name": "Subject", "value": subject}]}}
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    mirror = gmail_mirror.MailboxMirror(str(tmp_path / "mirror.sqlite"), fetch_messages=None)
+    with mirror._db:
+        mirror._upsert([
+            message("m1", ["INBOX", "UNREAD"]),
+            message("m2", ["TRASH"]),
+            message("m3", ["SPAM", "UNREAD"]),
+            message("m4", ["INBOX", "CATEGORY_PROMOTIONS"]),
+        ])
+    return mirror
+
+
+def test_search_leaves_out_spam_and_trash(mirror):
+    assert [r["id"] for r in mirror.search("alex", None, 10)] == ["m4", "m1"]
+    assert [r["id"] for r in mirror.search(None, "quarterly", 10)] == ["m4", "m1"]
+
+
+def test_fetch_leaves_out_spam_and_trash(mirror):
+    assert [r["id"] for r in mirror.fetch(10)] == ["m4", "m1"]
+    assert [r["id"] for r in mirror.fetch(10, all_inbox=False)] == ["m1"]
+
+
+def test_search_text_leaves_out_spam_and_trash_unless_asked(mirror):
+    if not mirror.fts:
+        pytest.skip("SQLite without FTS5")
+    assert sorted(r["id"] for r in mirror.search_text("quarterly report")) == ["m1", "m4"]
+    assert [r["id"] for r in mirror.search_text("quarterly", label_ids=["TRASH"])] == ["m2"]
+    assert [r["id"] for r in mirror.search_text("quarterly", label_ids=["UNREAD"])] == ["m1"]
@@ -0,0 +1,55 @@
+""" the batched crop path (crop_icon_images + icon_pixel_values) against the per-crop cv2 / PIL processor path it replaced """
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+cv2 = pytest.importorskip("cv2")
+pytest.importorskip("transformers")
+utils = pytest.importorskip("util.utils")
+
+try:
+    # transformers >= 5: CLIPImageProcessor is the torchvision one, the PIL one has its own class
+    from transformers.models.clip.image_processing_pil_clip import CLIPImageProcessorPil as CLIPImageProcessor
+except ImportError:
+    from transformers import CLIPImageProcessor
+
+
+def crop_icon_images_reference(boxes, image_source, size=64):
+    # one cv2.resize per crop, how the crops were made before
+    h, w = image_source.shape[:2]
+    crops = []
+    for box in boxes:
+        xmin, ymin, xmax, ymax = (np.asarray(box) * [w, h, w, h]).astype(int)
+        crops.append(cv2.resize(image_source[ymin:max(ymax, ymin + 1), xmin:max(xmax, xmin + 1)], (size, size)))
+    return torch.from_numpy(np.stack(crops)).permute(0, 3, 1, 2)
+
+
+def test_crops_match_cv2():
+    rng = np.random.default_rng(0)
+    image = cv2.GaussianBlur(rng.integers(0, 256, (300, 400, 3), dtype=np.uint8), (0, 0), 3)
+    corners = rng.random((200, 2)) * 0.9
+    boxes = np.concatenate([corners, corners + rng.random((200, 2)) * 0.1], axis=1)
+
+    crops = utils.crop_icon_images(boxes, image)
+    diff = (crops.int() - crop_icon_images_reference(boxes, image).int()).abs()
+    assert crops.shape == (200, 3, 64, 64) and crops.dtype == torch.uint8
+    assert diff.max() <= 8 and diff.float().mean() < 0.5
+
+
+def test_no_boxes():
+    assert utils.crop_icon_images([], np.zeros((10, 10, 3), dtype=np.uint8)).shape == (0, 3, 64, 64)
+
+
+@pytest.mark.parametrize("size", [{"height": 768, "width": 768}, {"height": 40, "width": 96}])
+def test_pixel_values_match_processor(size):
+    processor = CLIPImageProcessor(size=size, do_center_crop=False, resample=3, do_convert_rgb=False,
+                                   image_mean=[0.485, 0.456, 0.406], image_std=[0.229, 0.224, 0.225])
+    rng = np.random.default_rng(0)
+    crops = torch.from_numpy(rng.integers(0, 256, (4, 3, 64, 48), dtype=np.uint8))
+
+    expected = np.asarray(processor([crop.permute(1, 2, 0).numpy() for crop in crops], return_tensors="np")["pixel_values"])
+    pixel_values = utils.icon_pixel_values(crops, processor).numpy()
+    assert pixel_values.shape == expected.shape
+    # torch rounds its fixed point weights a little differently from PIL: a level or two on a few pixels, 2 / 255 / std < 0.05
+    diff = np.abs(pixel_values - expected)
+    assert diff.max() < 0.05 and diff.mean() < 1e-3
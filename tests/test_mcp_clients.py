@@ -0,0 +1,88 @@
+""" MCPClientManager against a small in-process MCP server: one shared session, timeouts, retries """
+import os
+import tempfile
+import threading
+import time
+
+import pytest
+
+# the mirror database must not land in the user's data directory
+os.environ.setdefault("SOFIA_GMAIL_MIRROR", os.path.join(tempfile.mkdtemp(), "gmail_mirror.sqlite"))
+mcp_clients = pytest.importorskip("mcp_clients")
+
+from fastmcp import FastMCP
+
+
+@pytest.fixture
+def manager():
+    server = FastMCP("test-tools")
+    calls = []
+
+    @server.tool()
+    async def echo(text: str, delay: float = 0.0) -> str:
+        import asyncio
+        calls.append(text)
+        await asyncio.sleep(delay)
+        return text
+
+    manager = mcp_clients.MCPClientManager(server, call_timeout=5)
+    sessions = []
+    hold_session = manager._hold_session
+
+    async def counting_hold_session(connected, closing):
+        sessions.append(connected)
+        await hold_session(connected, closing)
+
+    manager._hold_session = counting_hold_session
+    manager.calls, manager.sessions = calls, sessions
+    yield manager
+    manager.close()
+
+
+def test_concurrent_calls_share_one_session(manager):
+    results = [None] * 8
+
+    def call(i):
+        results[i] = manager.call_tool("echo", {"text": str(i), "delay": 0.05}).data
+
+    threads = [threading.Thread(target=call, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [str(i) for i in range(8)]
+    assert len(manager.sessions) == 1
+
+
+def test_timeout_cancels_call_and_drops_session(manager):
+    manager.call_timeout = 0.2
+    with pytest.raises(TimeoutError):
+        manager.call_tool("echo", {"text": "slow", "delay": 3})
+    deadline = time.time() + 2
+    while manager._client is not None and time.time() < deadline:
+        time.sleep(0.01)
+    assert manager._client is None
+
+    manager.call_timeout = 5
+    assert manager.call_tool("echo", {"text": "fast"}).data == "fast"
+    assert len(manager.sessions) == 2
+
+
+def test_failed_call_only_repeated_for_retry_safe_tools(manager):
+    manager.call_tool("echo", {"text": "warm"})
+
+    def break_session():
+        # the session dies under the next call
+        async def failing_call_tool(*args, **kwargs):
+            raise ConnectionError("lost")
+        manager._client.call_tool = failing_call_tool
+
+    break_session()
+    with pytest.raises(ConnectionError):
+        manager.call_tool("echo", {"text": "once"})
+    assert "once" not in manager.calls
+
+    manager.retry_safe_tools = {"echo"}
+    manager.call_tool("echo", {"text": "warm again"})
+    break_session()
+    assert manager.call_tool("echo", {"text": "twice"}).data == "twice"
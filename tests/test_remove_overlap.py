@@ -0,0 +1,116 @@
+""" remove_overlap_new (vectorized) must give exactly the results of the original pairwise loops """
+import random
+from typing import List
+
+import pytest
+
+utils = pytest.importorskip("util.utils")
+
+
+def remove_overlap_reference(boxes, iou_threshold, ocr_bbox=None):
+    # the original implementation, kept verbatim as the reference
+    assert ocr_bbox is None or isinstance(ocr_bbox, List)
+
+    def box_area(box):
+        return (box[2] - box[0]) * (box[3] - box[1])
+
+    def intersection_area(box1, box2):
+        x1 = max(box1[0], box2[0])
+        y1 = max(box1[1], box2[1])
+        x2 = min(box1[2], box2[2])
+        y2 = min(box1[3], box2[3])
+        return max(0, x2 - x1) * max(0, y2 - y1)
+
+    def IoU(box1, box2):
+        intersection = intersection_area(box1, box2)
+        union = box_area(box1) + box_area(box2) - intersection + 1e-6
+        if box_area(box1) > 0 and box_area(box2) > 0:
+            ratio1 = intersection / box_area(box1)
+            ratio2 = intersection / box_area(box2)
+        else:
+            ratio1, ratio2 = 0, 0
+        return max(intersection / union, ratio1, ratio2)
+
+    def is_inside(box1, box2):
+        intersection = intersection_area(box1, box2)
+        ratio1 = intersection / box_area(box1)
+        return ratio1 > 0.80
+
+    filtered_boxes = []
+    if ocr_bbox:
+        filtered_boxes.extend(ocr_bbox)
+    for i, box1_elem in enumerate(boxes):
+        box1 = box1_elem['bbox']
+        is_valid_box = True
+        for j, box2_elem in enumerate(boxes):
+            # keep the smaller box
+            box2 = box2_elem['bbox']
+            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
+                is_valid_box = False
+                break
+        if is_valid_box:
+            if ocr_bbox:
+                # keep yolo boxes + prioritize ocr label
+                box_added = False
+                ocr_labels = ''
+                for box3_elem in ocr_bbox:
+                    if not box_added:
+                        box3 = box3_elem['bbox']
+                        if is_inside(box3, box1): # ocr inside icon
+                            try:
+                                # gather all ocr labels
+                                ocr_labels += box3_elem['content'] + ' '
+                                filtered_boxes.remove(box3_elem)
+                            except:
+                                continue
+                        elif is_inside(box1, box3): # icon inside ocr
+                            box_added = True
+                            break
+                        else:
+                            continue
+                if not box_added:
+                    if ocr_labels:
+                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
+                    else:
+                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
+            else:
+                filtered_boxes.append(box1)
+    return filtered_boxes
+
+
+def random_box(rng, inside=None):
+    """ a ratio xyxy box, sometimes nested in `inside` so containment cases are frequent """
+    if inside is not None and rng.random() < 0.5:
+        x1, y1, x2, y2 = inside
+        ax, bx = sorted(rng.uniform(x1, x2) for _ in range(2))
+        ay, by = sorted(rng.uniform(y1, y2) for _ in range(2))
+        return [ax, ay, bx, by]
+    x, y = rng.random(), rng.random()
+    return [x, y, min(x + rng.uniform(0, 0.3), 1), min(y + rng.uniform(0, 0.3), 1)]
+
+
+def random_case(rng):
+    boxes = []
+    for _ in range(rng.randint(0, 25)):
+        bbox = random_box(rng, rng.choice(boxes)['bbox'] if boxes else None)
+        if bbox[2] - bbox[0] <= 0 or bbox[3] - bbox[1] <= 0:
+            # the reference divides by the icon area
+            continue
+        boxes.append({'type': 'icon', 'bbox': bbox, 'interactivity': True, 'content': None})
+    ocr_bbox = None
+    if rng.random() < 0.8:
+        ocr_bbox = []
+        for k in range(rng.randint(0, 15)):
+            inside = rng.choice(boxes)['bbox'] if boxes and rng.random() < 0.6 else None
+            bbox = random_box(rng, inside)
+            if bbox[2] - bbox[0] <= 0 or bbox[3] - bbox[1] <= 0:
+                continue
+            ocr_bbox.append({'type': 'text', 'bbox': bbox, 'interactivity': False, 'content': f'text {k}', 'source': 'box_ocr_content_ocr'})
+    return boxes, rng.choice([0.1, 0.5, 0.7, 0.9]), ocr_bbox
+
+
+@pytest.mark.parametrize("seed", range(3000))
+def test_matches_reference(seed):
+    boxes, iou_threshold, ocr_bbox = random_case(random.Random(seed))
+    expected = remove_overlap_reference(boxes, iou_threshold, list(ocr_bbox) if ocr_bbox is not None else None)
+    assert utils.remove_overlap_new(boxes, iou_threshold, ocr_bbox) == expected
@@ -0,0 +1,44 @@
+""" ScreenshotStore: pinning, eviction and the exit cleanup of a per-process directory """
+import os
+import tempfile
+
+from util.screenshot_store import ScreenshotStore
+
+
+def write_png(directory, name):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"png")
+    return path
+
+
+def test_evicts_unpinned_oldest_first(tmp_path):
+    store = ScreenshotStore(directory=str(tmp_path), max_count=2, min_age=0, max_pinned=1)
+    paths = [store.add(write_png(tmp_path, f"screenshot_{i}.png")) for i in range(2)]
+    store.retain_referenced([{"role": "user", "content": [{"image": paths[0]}]}])
+    paths.append(store.add(write_png(tmp_path, "screenshot_2.png")))
+    # screenshot_0 is referenced by the history, screenshot_1 goes instead
+    assert [os.path.exists(p) for p in paths] == [True, False, True]
+
+
+def test_stop_removes_only_its_own_directory(tmp_path):
+    # two instances, each with its own directory under the shared root like gui_tools
+    first = ScreenshotStore(directory=tempfile.mkdtemp(dir=tmp_path), remove_on_exit=True)
+    second = ScreenshotStore(directory=tempfile.mkdtemp(dir=tmp_path), remove_on_exit=True).start()
+    first.start()
+    mine = first.add(write_png(first.directory, "screenshot_a.png"))
+    theirs = second.add(write_png(second.directory, "screenshot_b.png"))
+
+    first.stop()
+    assert not os.path.exists(mine) and not os.path.exists(first.directory)
+    assert os.path.exists(theirs)
+    second.stop()
+    assert not os.path.exists(second.directory)
+
+
+def test_stop_keeps_untracked_files(tmp_path):
+    store = ScreenshotStore(directory=str(tmp_path), remove_on_exit=True)
+    store.add(write_png(tmp_path, "screenshot_a.png"))
+    other = write_png(tmp_path, "notes.txt")
+    store.stop()
+    assert os.path.exists(other) and os.listdir(tmp_path) == ["notes.txt"]
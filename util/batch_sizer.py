@@ -0,0 +1,169 @@
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import torch
+
+
+def is_oom_error(e: BaseException) -> bool:
+    """ cuda OOM, or the cpu allocator failing to allocate a batch """
+    if isinstance(e, MemoryError):
+        return True
+    cuda_oom = getattr(torch.cuda, 'OutOfMemoryError', None)
+    if cuda_oom is not None and isinstance(e, cuda_oom):
+        return True
+    message = str(e).lower()
+    return isinstance(e, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+class CaptionBatchSizer:
+    """
+    Picks the icon caption batch size from the memory one item actually costs on this machine.
+
+    The first batch runs at `probe_batch_size`; its peak memory per item and the free VRAM (cuda)
+    or free RAM (cpu) give the batch size used from then on. An out of memory error halves the
+    size and caps it there, the failed batch is retried instead of failing the parse.
+
+    Attributes:
+        device (str): 'cuda' or 'cpu', where the caption model runs
+        fixed_batch_size (Optional[int]): if set, never tuned (except by OOM back-off)
+        min_batch_size (int): never go below, an OOM at this size is raised
+        max_batch_size (int): never go above
+        memory_fraction (float): share of the free memory a batch may use
+        per_item_bytes (Optional[float]): peak memory of one item measured on the probe batch
+        throughput (float): items per second, moving average over the recent batches
+        ooms (int): number of out of memory back-offs
+    """
+
+    def __init__(self, device: str = 'cpu', batch_size: Optional[int] = None, min_batch_size: int = 1, max_batch_size: int = 256,
+                 probe_batch_size: int = 8, memory_fraction: float = 0.7, cpu_default_batch_size: int = 32):
+        self.device = device
+        self.fixed_batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.probe_batch_size = probe_batch_size
+        self.memory_fraction = memory_fraction
+        # used on cpu when the probe could not see the peak (already reached by an earlier allocation)
+        self.cpu_default_batch_size = cpu_default_batch_size
+        self.per_item_bytes: Optional[float] = None
+        self.throughput = 0.0
+        self.ooms = 0
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+
+    @property
+    def batch_size(self) -> int:
+        if self._batch_size is None:
+            return self.probe_batch_size
+        return self._batch_size
+
+    @property
+    def calibrated(self) -> bool:
+        return self._batch_size is not None
+
+    @contextmanager
+    def measure(self, n: int):
+        """ wrap the forward pass of an n item batch: records throughput, and calibrates on the first batch;
+            only errors of the wrapped batch are raised, never the bookkeeping's
+        """
+        try:
+            base = self._memory_in_use()
+        except Exception as e:
+            print('caption batch memory probe failed:', e)
+            base = None
+        start = time.time()
+        yield
+        seconds = time.time() - start
+        with self._lock:
+            if seconds > 0:
+                rate = n / seconds
+                self.throughput = rate if not self.throughput else 0.8 * self.throughput + 0.2 * rate
+            if not self.calibrated:
+                try:
+                    self._calibrate(n, self._peak_memory() - base if base is not None else 0)
+                except Exception as e:
+                    print('caption batch calibration failed, using the default size:', e)
+                    self._calibrate(n, 0)
+
+    def back_off(self, failed_batch_size: Optional[int] = None):
+        """ call after an out of memory error on a batch of failed_batch_size items (default: the current size),
+            returns False if the batch size cannot go lower
+        """
+        with self._lock:
+            failed_batch_size = min(failed_batch_size or self.batch_size, self.batch_size)
+            if failed_batch_size <= self.min_batch_size:
+                return False
+            self.ooms += 1
+            self._batch_size = max(failed_batch_size // 2, self.min_batch_size)
+            # the tuned size proved too big, never grow past what just failed
+            self.max_batch_size = self._batch_size
+            print(f'caption batch out of memory, batch size -> {self._batch_size}')
+        if self.device == 'cuda':
+            torch.cuda.empty_cache()
+        return True
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'batch_size': self.batch_size,
+            'calibrated': self.calibrated,
+            'per_item_mb': self.per_item_bytes / 2**20 if self.per_item_bytes else None,
+            'throughput': self.throughput,
+            'ooms': self.ooms,
+        }
+
+    def _calibrate(self, n: int, peak_bytes: float):
+        free = self._free_memory() if peak_bytes > 0 else None
+        if free:
+            self.per_item_bytes = peak_bytes / n
+            batch_size = int(free * self.memory_fraction / self.per_item_bytes)
+        elif self.device == 'cuda':
+            batch_size = self.max_batch_size
+        else:
+            batch_size = self.cpu_default_batch_size
+        self._batch_size = min(max(batch_size, self.min_batch_size), self.max_batch_size)
+        print(f'caption batch size: {self._batch_size} (per item {self.per_item_bytes or 0:.0f} bytes)')
+
+    def _memory_in_use(self) -> float:
+        if self.device == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+            return torch.cuda.memory_allocated()
+        return self._peak_memory()
+
+    def _peak_memory(self) -> float:
+        """ peak memory of the process so far, 0 if it cannot be measured here """
+        if self.device == 'cuda':
+            return torch.cuda.max_memory_allocated()
+        try:
+            import resource  # unix only
+        except ImportError:
+            psutil = _psutil()
+            if psutil is None:
+                return 0
+            info = psutil.Process().memory_info()
+            # peak working set on windows
+            return getattr(info, 'peak_wset', info.rss)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # bytes on macOS, kilobytes on linux
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+    def _free_memory(self) -> Optional[float]:
+        """ free memory of the device, None if it cannot be measured here """
+        if self.device == 'cuda':
+            return torch.cuda.mem_get_info()[0]
+        try:
+            # linux only
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            psutil = _psutil()
+            return psutil.virtual_memory().available if psutil is not None else None
+
+
+def _psutil():
+    try:
+        import psutil
+        return psutil
+    except ImportError:
+        return None
@@ -85,6 +85,8 @@ class BoxAnnotator:
             ```
         """
         font = cv2.FONT_HERSHEY_SIMPLEX
+        # built once per call, label placement only checks the detections near each candidate position
+        spatial_index = BoxSpatialIndex(detections.xyxy) if self.avoid_overlap and not skip_label else None
         for i in range(len(detections)):
             x1, y1, x2, y2 = detections.xyxy[i].astype(int)
             class_id = (
@@ -135,7 +137,7 @@ class BoxAnnotator:
                 # text_background_x2 = x1
                 # text_background_y2 = y1 + 2 * self.text_padding + text_height
             else:
-                text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2 = get_optimal_label_pos(self.text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size)
+                text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2 = get_optimal_label_pos(self.text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size, spatial_index=spatial_index)
 
             cv2.rectangle(
                 img=scene,
@@ -186,77 +188,98 @@ def IoU(box1, box2, return_max=True):
         return intersection / union
 
 
-def get_optimal_label_pos(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size):
+class BoxSpatialIndex:
+    """
+    Uniform grid over the detection boxes, used to find the boxes a label rectangle can overlap
+    without scanning every detection.
+
+    Attributes:
+        xyxy (np.ndarray): (N, 4) int boxes
+        cell_size (int): grid cell size in pixels, defaults to twice the median box side
+    """
+
+    def __init__(self, xyxy: np.ndarray, cell_size: Optional[int] = None, max_cells_per_box: int = 64):
+        self.xyxy = np.asarray(xyxy).astype(int).reshape(-1, 4)
+        self.area = (self.xyxy[:, 2] - self.xyxy[:, 0]) * (self.xyxy[:, 3] - self.xyxy[:, 1])
+        if cell_size is None:
+            sides = np.maximum(self.xyxy[:, 2] - self.xyxy[:, 0], self.xyxy[:, 3] - self.xyxy[:, 1])
+            cell_size = int(2 * np.median(sides)) if len(sides) else 64
+        self.cell_size = max(cell_size, 16)
+        self.cells = {}
+        # boxes spanning many cells (windows, panels) are always checked instead of being copied into every cell
+        large = []
+        for i, (x1, y1, x2, y2) in enumerate(self.xyxy):
+            cx1, cy1, cx2, cy2 = self._cell_range(x1, y1, x2, y2)
+            if (cx2 - cx1 + 1) * (cy2 - cy1 + 1) > max_cells_per_box:
+                large.append(i)
+                continue
+            for cx in range(cx1, cx2 + 1):
+                for cy in range(cy1, cy2 + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+        self.large = np.array(large, dtype=int)
+
+    def _cell_range(self, x1, y1, x2, y2):
+        c = self.cell_size
+        return int(x1) // c, int(y1) // c, int(x2) // c, int(y2) // c
+
+    def query(self, x1, y1, x2, y2) -> np.ndarray:
+        """ indices of the boxes that may intersect the rectangle """
+        cx1, cy1, cx2, cy2 = self._cell_range(x1, y1, x2, y2)
+        found = [self.large]
+        for cx in range(cx1, cx2 + 1):
+            for cy in range(cy1, cy2 + 1):
+                if (cx, cy) in self.cells:
+                    found.append(np.array(self.cells[(cx, cy)], dtype=int))
+        return np.unique(np.concatenate(found))
+
+    def max_iou(self, rect) -> float:
+        """ max over nearby boxes of IoU(rect, box) with return_max=True, 0 if nothing is nearby """
+        idx = self.query(*rect)
+        if not len(idx):
+            return 0.0
+        boxes, area2 = self.xyxy[idx], self.area[idx]
+        area1 = (rect[2] - rect[0]) * (rect[3] - rect[1])
+        intersection = np.maximum(0, np.minimum(rect[2], boxes[:, 2]) - np.maximum(rect[0], boxes[:, 0])) * \
+            np.maximum(0, np.minimum(rect[3], boxes[:, 3]) - np.maximum(rect[1], boxes[:, 1]))
+        union = area1 + area2 - intersection
+        positive = (area1 > 0) & (area2 > 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio1 = np.where(positive, intersection / area1, 0)
+            ratio2 = np.where(positive, intersection / area2, 0)
+            iou = np.maximum(np.maximum(intersection / union, ratio1), ratio2)
+        return float(np.max(iou))
+
+
+def get_optimal_label_pos(text_padding, text_width, text_height, x1, y1, x2, y2, detections, image_size, spatial_index=None):
     """ check overlap of text and background detection box, and get_optimal_label_pos, 
-        pos: str, position of the text, must be one of 'top left', 'top right', 'outer left', 'outer right' TODO: if all are overlapping, return the last one, i.e. outer right
+        pos: str, position of the text, must be one of 'top left', 'outer left', 'outer right', 'top right' TODO: if all are overlapping, return the last one, i.e. top right
         Threshold: default to 0.3
+        spatial_index: BoxSpatialIndex over detections.xyxy, build it once per frame when placing many labels
     """
+    if spatial_index is None:
+        spatial_index = BoxSpatialIndex(detections.xyxy)
 
-    def get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size):
-        is_overlap = False
-        for i in range(len(detections)):
-            detection = detections.xyxy[i].astype(int)
-            if IoU([text_background_x1, text_background_y1, text_background_x2, text_background_y2], detection) > 0.3:
-                is_overlap = True
-                break
+    def get_is_overlap(text_background_x1, text_background_y1, text_background_x2, text_background_y2):
         # check if the text is out of the image
         if text_background_x1 < 0 or text_background_x2 > image_size[0] or text_background_y1 < 0 or text_background_y2 > image_size[1]:
-            is_overlap = True
-        return is_overlap
-    
-    # if pos == 'top left':
-    text_x = x1 + text_padding
-    text_y = y1 - text_padding
-
-    text_background_x1 = x1
-    text_background_y1 = y1 - 2 * text_padding - text_height
-
-    text_background_x2 = x1 + 2 * text_padding + text_width
-    text_background_y2 = y1
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-    
-    # elif pos == 'outer left':
-    text_x = x1 - text_padding - text_width
-    text_y = y1 + text_padding + text_height
-
-    text_background_x1 = x1 - 2 * text_padding - text_width
-    text_background_y1 = y1
-
-    text_background_x2 = x1
-    text_background_y2 = y1 + 2 * text_padding + text_height
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-    
-
-    # elif pos == 'outer right':
-    text_x = x2 + text_padding
-    text_y = y1 + text_padding + text_height
-
-    text_background_x1 = x2
-    text_background_y1 = y1
-
-    text_background_x2 = x2 + 2 * text_padding + text_width
-    text_background_y2 = y1 + 2 * text_padding + text_height
-
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-
-    # elif pos == 'top right':
-    text_x = x2 - text_padding - text_width
-    text_y = y1 - text_padding
-
-    text_background_x1 = x2 - 2 * text_padding - text_width
-    text_background_y1 = y1 - 2 * text_padding - text_height
-
-    text_background_x2 = x2
-    text_background_y2 = y1
-
-    is_overlap = get_is_overlap(detections, text_background_x1, text_background_y1, text_background_x2, text_background_y2, image_size)
-    if not is_overlap:
-        return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
-
-    return text_x, text_y, text_background_x1, text_background_y1, text_background_x2, text_background_y2
+            return True
+        return spatial_index.max_iou((text_background_x1, text_background_y1, text_background_x2, text_background_y2)) > 0.3
+
+    candidates = [
+        # 'top left'
+        (x1 + text_padding, y1 - text_padding,
+         x1, y1 - 2 * text_padding - text_height, x1 + 2 * text_padding + text_width, y1),
+        # 'outer left'
+        (x1 - text_padding - text_width, y1 + text_padding + text_height,
+         x1 - 2 * text_padding - text_width, y1, x1, y1 + 2 * text_padding + text_height),
+        # 'outer right'
+        (x2 + text_padding, y1 + text_padding + text_height,
+         x2, y1, x2 + 2 * text_padding + text_width, y1 + 2 * text_padding + text_height),
+        # 'top right'
+        (x2 - text_padding - text_width, y1 - text_padding,
+         x2 - 2 * text_padding - text_width, y1 - 2 * text_padding - text_height, x2, y1),
+    ]
+    for candidate in candidates:
+        if not get_is_overlap(*candidate[2:]):
+            return candidate
+    return candidates[-1]
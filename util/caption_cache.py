@@ -0,0 +1,96 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class CaptionCache:
+    """
+    Cache of icon captions keyed by the resized icon crop, the caption model and the prompt.
+
+    Taskbar / toolbar / menu icons are pixel identical from one screenshot to the next, so the
+    caption model only has to run on crops it has never seen before.
+
+    Attributes:
+        max_size (int): number of captions kept in the in-memory LRU
+        db_path (Optional[str]): optional sqlite file, captions persist across processes
+        hits (int): number of lookups answered from the cache
+        misses (int): number of lookups that had to run the caption model
+    """
+
+    def __init__(self, max_size: int = 4096, db_path: Optional[str] = None):
+        self.max_size = max_size
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS captions (key TEXT PRIMARY KEY, caption TEXT NOT NULL)")
+            self._db.commit()
+
+    @staticmethod
+    def make_key(crop: np.ndarray, model_name: str, prompt: str) -> str:
+        """ exact hash of the resized crop pixels + caption model + prompt """
+        h = hashlib.sha1()
+        h.update(f"{model_name}|{prompt}|{crop.shape}|".encode())
+        h.update(np.ascontiguousarray(crop).tobytes())
+        return h.hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+            missing = [key for key in set(keys) if key not in found]
+            if self._db is not None and missing:
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i+500]
+                    rows = self._db.execute(
+                        f"SELECT key, caption FROM captions WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                    ).fetchall()
+                    for key, caption in rows:
+                        found[key] = caption
+                        self._remember(key, caption)
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, items: Dict[str, str]):
+        with self._lock:
+            for key, caption in items.items():
+                self._remember(key, caption)
+            if self._db is not None and items:
+                self._db.executemany("INSERT OR REPLACE INTO captions (key, caption) VALUES (?, ?)", list(items.items()))
+                self._db.commit()
+
+    def _remember(self, key: str, caption: str):
+        self._lru[key] = caption
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._lru),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self.hits, self.misses = 0, 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM captions")
+                self._db.commit()
@@ -1,32 +1,329 @@
-from util.utils import get_som_labeled_img, get_caption_model_processor, get_yolo_model, check_ocr_box
+from util.utils import get_som_labeled_img, get_caption_model_processor, get_yolo_model, check_ocr_box, detect_and_ocr, add_timing, preload_ocr_engines, predict_yolo_batch, get_filtered_elements, crop_icon_images, caption_icon_crops, fill_icon_content, draw_som_overlay, describe_icon_boxes
+from util.caption_cache import CaptionCache
+from util.batch_sizer import CaptionBatchSizer
 import torch
+import cv2
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from PIL import Image
 import io
 import base64
-from typing import Dict
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
 class Omniparser(object):
     def __init__(self, config: Dict):
         self.config = config
-        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        device = config.get('device') or ('cuda' if torch.cuda.is_available() else 'cpu')
 
-        self.som_model = get_yolo_model(model_path=config['som_model_path'])
+        self.som_model = get_yolo_model(model_path=config['som_model_path'], backend=config.get('som_model_backend', 'torch'), device=device)
         self.caption_model_processor = get_caption_model_processor(model_name=config['caption_model_name'], model_name_or_path=config['caption_model_path'], device=device)
+        # only the engine this parser uses is loaded
+        self.ocr_engine = config.get('ocr_engine', 'easyocr')
+        preload_ocr_engines(self.ocr_engine)
+        # caption batch size tuned on the first batch from the measured memory per icon, unless caption_batch_size is set
+        self.caption_batch_sizer = CaptionBatchSizer(device=self.caption_model_processor['model'].device.type, batch_size=config.get('caption_batch_size'))
+        self.caption_cache = CaptionCache(max_size=config.get('caption_cache_size', 4096), db_path=config.get('caption_cache_path'))
+        # previous frame + parsed elements per session, for incremental parsing
+        self.sessions: "OrderedDict[str, Dict]" = OrderedDict()
+        # screenshot + parsed elements of lazy-caption parses, icons are captioned on demand by caption()
+        self.screenshots: "OrderedDict[str, Dict]" = OrderedDict()
         print('Omniparser initialized!!!')
 
-    def parse(self, image_base64: str):
-        image_bytes = base64.b64decode(image_base64)
-        image = Image.open(io.BytesIO(image_bytes))
+    def parse(self, image_base64: Union[str, bytes, Image.Image], session_id: Optional[str] = None, render_overlay: bool = True, timings: Optional[Dict] = None,
+              lazy_captions: bool = False, screenshot_id: Optional[str] = None):
+        """ render_overlay=False skips drawing the SOM image (returned as None), see render()
+            timings: optional dict, filled with the seconds spent in each stage (ocr, yolo, filter, caption, render)
+            lazy_captions: icons are not captioned, they keep 'content': None and get a cheap 'descriptor';
+                with a screenshot_id the parse is kept so caption(screenshot_id, box_ids) can caption some of them later
+        """
+        start = time.time()
+        image = self.load_image(image_base64)
+        add_timing(timings, 'decode', start)
         print('image size:', image.size)
-        
+
+        if session_id is None:
+            dino_labled_img, parsed_content_list = self._parse_image(image, render_overlay=render_overlay, timings=timings, lazy_captions=lazy_captions)
+        else:
+            dino_labled_img, parsed_content_list = self._parse_incremental(image, session_id, render_overlay=render_overlay, timings=timings, lazy_captions=lazy_captions)
+        if lazy_captions and screenshot_id is not None:
+            self.remember_screenshot(screenshot_id, image, parsed_content_list)
+        return dino_labled_img, parsed_content_list
+
+    def remember_screenshot(self, screenshot_id: str, image: Image.Image, parsed_content_list: List[Dict]):
+        """ keep a lazy-caption parse around for caption(), the oldest ones are dropped past max_screenshots """
+        self.screenshots[screenshot_id] = {'image': np.asarray(image), 'parsed_content_list': parsed_content_list}
+        self.screenshots.move_to_end(screenshot_id)
+        while len(self.screenshots) > self.config.get('max_screenshots', 32):
+            self.screenshots.popitem(last=False)
+
+    def caption(self, screenshot_id: str, box_ids: List[int], timings: Optional[Dict] = None):
+        """ caption the given elements of a lazy-caption parse, returns {box_id: content}
+
+        Captions are written into the stored parsed_content_list, so asking twice for a box is free.
+        Raises KeyError if the screenshot was never parsed with lazy_captions or has been evicted,
+        IndexError for a box id that does not exist.
+        """
+        screenshot = self.screenshots[screenshot_id]
+        self.screenshots.move_to_end(screenshot_id)
+        elements = screenshot['parsed_content_list']
+        for idx in box_ids:
+            if not 0 <= idx < len(elements):
+                raise IndexError(f"box {idx} out of range, screenshot {screenshot_id} has {len(elements)} elements")
+
+        todo = sorted({idx for idx in box_ids if elements[idx]['content'] is None})
+        if todo:
+            start = time.time()
+            crops = crop_icon_images([elements[idx]['bbox'] for idx in todo], screenshot['image'])
+            captions = caption_icon_crops(crops, self.caption_model_processor, batch_size=None, caption_cache=self.caption_cache, batch_sizer=self.caption_batch_sizer)
+            for idx, caption in zip(todo, captions):
+                elements[idx]['content'] = caption
+            add_timing(timings, 'caption', start)
+        return {idx: elements[idx]['content'] for idx in box_ids}
+
+    def render(self, image: Union[str, bytes, Image.Image], parsed_content_list: List[Dict], timings: Optional[Dict] = None):
+        """ draw the SOM overlay of a parse result on demand, returns the base64 PNG """
+        start = time.time()
+        image = self.load_image(image)
+        dino_labled_img, _ = draw_som_overlay(image, parsed_content_list, draw_bbox_config=self._draw_bbox_config(image))
+        add_timing(timings, 'render', start)
+        return dino_labled_img
+
+    def parse_batch(self, images_base64: List[Union[str, bytes, Image.Image]], render_overlay: bool = True, timings: Optional[Dict] = None,
+                    lazy_captions: bool = False, screenshot_ids: Optional[List[Optional[str]]] = None):
+        """ parse several screenshots at once: yolo runs on the whole batch and the icon crops
+            of all screenshots are captioned together, returns [(som_image_base64, parsed_content_list), ...]
+            lazy_captions / screenshot_ids: as in parse(), one id (or None) per image
+        """
+        start = time.time()
+        images = [self.load_image(image_base64) for image_base64 in images_base64]
+        add_timing(timings, 'decode', start)
+        print('batch image sizes:', [image.size for image in images])
+
+        def _ocr_all():
+            ocr_start = time.time()
+            ocr_results = [check_ocr_box(image, **self._ocr_args())[0] for image in images]
+            add_timing(timings, 'ocr', ocr_start)
+            return ocr_results
+
+        # ocr on a worker thread while yolo runs on this one
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            ocr_future = pool.submit(_ocr_all)
+            yolo_start = time.time()
+            detections = predict_yolo_batch(self.som_model, images, box_threshold=self.config['BOX_TRESHOLD'], iou_threshold=0.1)
+            add_timing(timings, 'yolo', yolo_start)
+            ocr_results = ocr_future.result()
+        add_timing(timings, 'ocr_yolo_wall', start)
+
+        start = time.time()
+        parsed, all_crops = [], []
+        for image, (text, ocr_bbox), (xyxy, logits, _) in zip(images, ocr_results, detections):
+            w, h = image.size
+            image_np = np.asarray(image)
+            filtered_boxes_elem, filtered_boxes, starting_idx = get_filtered_elements(xyxy, w, h, ocr_bbox=ocr_bbox, ocr_text=text, iou_threshold=0.7)
+            if lazy_captions:
+                describe_icon_boxes(filtered_boxes_elem, image_np)
+                crops = []
+            else:
+                crops = crop_icon_images(filtered_boxes[starting_idx:] if starting_idx else filtered_boxes, image_np)
+            all_crops.extend(crops)
+            parsed.append((image, text, filtered_boxes_elem, len(crops)))
+        add_timing(timings, 'filter', start)
+
+        start = time.time()
+        captions = caption_icon_crops(all_crops, self.caption_model_processor, batch_size=None, caption_cache=self.caption_cache, batch_sizer=self.caption_batch_sizer)
+        add_timing(timings, 'caption', start)
+
+        results = []
+        for i, (image, text, filtered_boxes_elem, n_crops) in enumerate(parsed):
+            if lazy_captions:
+                if screenshot_ids and screenshot_ids[i] is not None:
+                    self.remember_screenshot(screenshot_ids[i], image, filtered_boxes_elem)
+            else:
+                fill_icon_content(filtered_boxes_elem, captions[:n_crops], text)
+                captions = captions[n_crops:]
+            dino_labled_img = self.render(image, filtered_boxes_elem, timings=timings) if render_overlay else None
+            results.append((dino_labled_img, filtered_boxes_elem))
+        return results
+
+    def parse_stream(self, image_base64: Union[str, bytes, Image.Image], caption_batch_size: int = 32):
+        """ generator version of parse(): yields the ocr text / detection boxes before any icon is captioned,
+            then the icon captions batch by batch
+
+        Yields:
+            {'event': 'elements', 'parsed_content_list': [...], 'pending': [idx, ...]}   icons in pending have 'content': None
+            {'event': 'captions', 'captions': {idx: caption, ...}}                       one per caption batch
+            {'event': 'done', 'parsed_content_list': [...], 'timings': {...}}
+        """
+        timings = {}
+        start = time.time()
+        image = self.load_image(image_base64)
+        add_timing(timings, 'decode', start)
+        (text, ocr_bbox), (xyxy, _, _) = detect_and_ocr(image, self.som_model, BOX_TRESHOLD=self.config['BOX_TRESHOLD'], ocr_args=self._ocr_args(), scale_img=False, timings=timings)
+
+        start = time.time()
+        w, h = image.size
+        filtered_boxes_elem, filtered_boxes, starting_idx = get_filtered_elements(xyxy, w, h, ocr_bbox=ocr_bbox, ocr_text=text, iou_threshold=0.7)
+        pending = [i for i, elem in enumerate(filtered_boxes_elem) if elem['content'] is None]
+        add_timing(timings, 'filter', start)
+        yield {'event': 'elements', 'parsed_content_list': [dict(elem) for elem in filtered_boxes_elem], 'pending': pending}
+
+        if pending:
+            # elements needing a caption are sorted last, their crops come in the same order
+            crops = crop_icon_images(filtered_boxes[starting_idx:] if starting_idx else filtered_boxes, np.asarray(image))
+            for i in range(0, len(crops), caption_batch_size):
+                start = time.time()
+                captions = caption_icon_crops(crops[i:i+caption_batch_size], self.caption_model_processor, batch_size=caption_batch_size, caption_cache=self.caption_cache, batch_sizer=self.caption_batch_sizer)
+                add_timing(timings, 'caption', start)
+                batch_captions = {}
+                for idx, caption in zip(pending[i:i+caption_batch_size], captions):
+                    filtered_boxes_elem[idx]['content'] = caption
+                    batch_captions[idx] = caption
+                yield {'event': 'captions', 'captions': batch_captions}
+
+        yield {'event': 'done', 'parsed_content_list': filtered_boxes_elem, 'timings': timings}
+
+    @staticmethod
+    def load_image(image: Union[str, bytes, Image.Image]):
+        """ accepts a base64 string, encoded image bytes (PNG/JPEG/WebP) or a decoded PIL image """
+        if isinstance(image, str):
+            image = base64.b64decode(image)
+        if isinstance(image, bytes):
+            image = Image.open(io.BytesIO(image))
+        return image.convert('RGB')
+
+    def _draw_bbox_config(self, image: Image.Image):
         box_overlay_ratio = max(image.size) / 3200
-        draw_bbox_config = {
+        return {
             'text_scale': 0.8 * box_overlay_ratio,
             'text_thickness': max(int(2 * box_overlay_ratio), 1),
             'text_padding': max(int(3 * box_overlay_ratio), 1),
             'thickness': max(int(3 * box_overlay_ratio), 1),
         }
 
-        (text, ocr_bbox), _ = check_ocr_box(image, display_img=False, output_bb_format='xyxy', easyocr_args={'text_threshold': 0.8}, use_paddleocr=False)
-        dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(image, self.som_model, BOX_TRESHOLD = self.config['BOX_TRESHOLD'], output_coord_in_ratio=True, ocr_bbox=ocr_bbox,draw_bbox_config=draw_bbox_config, caption_model_processor=self.caption_model_processor, ocr_text=text,use_local_semantics=True, iou_threshold=0.7, scale_img=False, batch_size=128)
+    def _ocr_args(self):
+        return {'display_img': False, 'output_bb_format': 'xyxy', 'easyocr_args': {'text_threshold': 0.8}, 'ocr_engine': self.ocr_engine,
+                'tile_size': self.config.get('ocr_tile_size'), 'tile_workers': self.config.get('ocr_tile_workers', 1)}
+
+    def _parse_image(self, image: Image.Image, render_overlay: bool = True, timings: Optional[Dict] = None, lazy_captions: bool = False):
+        draw_bbox_config = self._draw_bbox_config(image)
+        (text, ocr_bbox), detections = detect_and_ocr(image, self.som_model, BOX_TRESHOLD=self.config['BOX_TRESHOLD'], ocr_args=self._ocr_args(), scale_img=False, timings=timings)
+        dino_labled_img, label_coordinates, parsed_content_list = get_som_labeled_img(image, self.som_model, BOX_TRESHOLD = self.config['BOX_TRESHOLD'], output_coord_in_ratio=True, ocr_bbox=ocr_bbox,draw_bbox_config=draw_bbox_config, caption_model_processor=self.caption_model_processor, ocr_text=text,use_local_semantics=not lazy_captions, iou_threshold=0.7, scale_img=False, batch_size=None, caption_cache=self.caption_cache, batch_sizer=self.caption_batch_sizer, render_overlay=render_overlay, detections=detections, timings=timings)
+        if lazy_captions:
+            describe_icon_boxes(parsed_content_list, np.asarray(image))
+
+        return dino_labled_img, parsed_content_list
+
+    def _parse_incremental(self, image: Image.Image, session_id: str, render_overlay: bool = True, timings: Optional[Dict] = None, lazy_captions: bool = False):
+        """ re-parse only the regions that changed since the previous frame of this session,
+            unchanged elements are kept (in order) and new ones are appended
+        """
+        frame = np.asarray(image)
+        prev = self.sessions.pop(session_id, None)
+
+        regions = None
+        if prev is not None and prev['frame'].shape == frame.shape:
+            start = time.time()
+            regions = self._dirty_regions(prev['frame'], frame)
+            add_timing(timings, 'diff', start)
+
+        if regions is None:
+            print('incremental parse: full frame')
+            dino_labled_img, parsed_content_list = self._parse_image(image, render_overlay=render_overlay, timings=timings, lazy_captions=lazy_captions)
+        elif not regions:
+            print('incremental parse: no change')
+            dino_labled_img, parsed_content_list = prev['som_image_base64'], prev['parsed_content_list']
+        else:
+            print('incremental parse: dirty regions', regions)
+            w, h = image.size
+            regions = self._grow_regions(regions, prev['parsed_content_list'], w, h)
+            parsed_content_list = [elem for elem in prev['parsed_content_list'] if not any(self._overlaps(self._bbox_px(elem, w, h), r) for r in regions)]
+            for x1, y1, x2, y2 in regions:
+                crop = image.crop((x1, y1, x2, y2))
+                _, crop_content_list = self._parse_image(crop, render_overlay=False, timings=timings, lazy_captions=lazy_captions)
+                cw, ch = crop.size
+                for elem in crop_content_list:
+                    bx1, by1, bx2, by2 = elem['bbox']
+                    elem['bbox'] = [(bx1 * cw + x1) / w, (by1 * ch + y1) / h, (bx2 * cw + x1) / w, (by2 * ch + y1) / h]
+                    parsed_content_list.append(elem)
+            if lazy_captions:
+                # the descriptors of the re-parsed elements were computed in crop coordinates
+                describe_icon_boxes(parsed_content_list, frame)
+            dino_labled_img = None
+        if render_overlay and dino_labled_img is None:
+            dino_labled_img = self.render(image, parsed_content_list, timings=timings)
+
+        self.sessions[session_id] = {'frame': frame, 'parsed_content_list': parsed_content_list, 'som_image_base64': dino_labled_img}
+        while len(self.sessions) > self.config.get('max_sessions', 16):
+            self.sessions.popitem(last=False)
+        return dino_labled_img, parsed_content_list
+
+    def _dirty_regions(self, prev_frame: np.ndarray, frame: np.ndarray):
+        """ block-wise pixel diff, returns a list of xyxy pixel rects around changed tiles,
+            or None if so much changed that a full parse is cheaper
+        """
+        tile = self.config.get('incremental_tile_size', 32)
+        h, w = frame.shape[:2]
+        diff = cv2.absdiff(prev_frame, frame).max(axis=2)
+        th, tw = -(-h // tile), -(-w // tile)
+        diff = np.pad(diff, ((0, th * tile - h), (0, tw * tile - w)))
+        dirty = diff.reshape(th, tile, tw, tile).max(axis=(1, 3)) > self.config.get('incremental_pixel_threshold', 16)
+        if not dirty.any():
+            return []
+        if dirty.mean() > self.config.get('incremental_max_dirty_ratio', 0.3):
+            return None
+
+        # merge tiles that are close to each other into one region
+        dirty = cv2.dilate(dirty.astype(np.uint8), np.ones((3, 3), np.uint8))
+        n, _, stats, _ = cv2.connectedComponentsWithStats(dirty, connectivity=8)
+        regions = []
+        for left, top, width, height, _ in stats[1:n]:
+            regions.append([int(left * tile), int(top * tile), int(min((left + width) * tile, w)), int(min((top + height) * tile, h))])
+        return regions
+
+    def _grow_regions(self, regions: List[List[int]], elements: List[Dict], w: int, h: int):
+        """ extend the regions to fully cover the previous elements they touch, so those get re-detected whole,
+            until no region grows any more; overlapping or adjacent regions are merged, each area is parsed once
+        """
+        boxes = [self._bbox_px(elem, w, h) for elem in elements]
+        regions = self._merge_regions([list(r) for r in regions])
+        while True:
+            grown = []
+            for x1, y1, x2, y2 in regions:
+                for box in boxes:
+                    # a grown region can touch elements the first pass missed, hence the fixed point
+                    if self._overlaps(box, [x1, y1, x2, y2]):
+                        x1, y1, x2, y2 = min(x1, box[0]), min(y1, box[1]), max(x2, box[2]), max(y2, box[3])
+                grown.append([max(x1, 0), max(y1, 0), min(x2, w), min(y2, h)])
+            grown = self._merge_regions(grown)
+            if grown == regions:
+                return regions
+            regions = grown
+
+    @staticmethod
+    def _merge_regions(regions: List[List[int]]):
+        """ union of the regions that overlap or touch, repeated until they are disjoint """
+        merged = True
+        while merged:
+            merged = False
+            out = []
+            for region in regions:
+                for other in out:
+                    if region[0] <= other[2] and other[0] <= region[2] and region[1] <= other[3] and other[1] <= region[3]:
+                        other[:] = [min(region[0], other[0]), min(region[1], other[1]), max(region[2], other[2]), max(region[3], other[3])]
+                        merged = True
+                        break
+                else:
+                    out.append(region)
+            regions = out
+        return sorted(regions)
+
+    @staticmethod
+    def _bbox_px(elem: Dict, w: int, h: int):
+        x1, y1, x2, y2 = elem['bbox']
+        return [int(x1 * w), int(y1 * h), int(np.ceil(x2 * w)), int(np.ceil(y2 * h))]
 
-        return dino_labled_img, parsed_content_list
\ No newline at end of file
+    @staticmethod
+    def _overlaps(box1, box2):
+        return box1[0] < box2[2] and box2[0] < box1[2] and box1[1] < box2[3] and box2[1] < box1[3]
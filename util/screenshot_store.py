@@ -0,0 +1,216 @@
+import atexit
+import fnmatch
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+
+class ScreenshotStore:
+    """
+    Keeps the screenshots written during an agent run within a retention policy.
+
+    Files are tracked oldest first and evicted (deleted) once there are more than `max_count`,
+    they weigh more than `max_bytes` or they are older than `max_age` seconds. A file is never
+    evicted while it is pinned: acquire()d and not yet release()d, or still referenced by the
+    message history passed to retain_referenced() (only the `max_pinned` most recent ones if set, so a
+    history that is never trimmed cannot pin everything), or younger than `min_age` seconds (just written,
+    not referenced yet). Eviction runs on add() when a limit is
+    exceeded and every `sweep_interval` seconds on a background thread once start()ed.
+    With `remove_on_exit` every tracked file (and `directory`, once empty) is deleted when the process exits.
+
+    Attributes:
+        directory (Optional[str]): files matching `pattern` already in it are adopted on start()
+        max_count (int): number of files kept
+        max_bytes (int): total size of the files kept
+        max_age (float): seconds a file is kept
+        min_age (float): seconds a new file is safe from the count / size limits
+        max_pinned (Optional[int]): number of the most recently referenced files retain_referenced() pins
+        remove_on_exit (bool): delete the tracked files at exit, only for a directory no other process uses
+        evicted (int): number of files deleted so far
+    """
+
+    def __init__(self, directory: Optional[str] = None, max_count: int = 200, max_bytes: int = 1 << 30, max_age: float = 2 * 3600,
+                 min_age: float = 60, sweep_interval: float = 30, pattern: str = "*.png", max_pinned: Optional[int] = None,
+                 remove_on_exit: bool = False):
+        self.directory = directory
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_age = min_age
+        self.sweep_interval = sweep_interval
+        self.pattern = pattern
+        self.max_pinned = max_pinned
+        self.remove_on_exit = remove_on_exit
+        self.evicted = 0
+        # path -> time added
+        self._files: "OrderedDict[str, float]" = OrderedDict()
+        self._refcounts: Dict[str, int] = {}
+        self._referenced: set = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, path) -> str:
+        """ track a screenshot file, returns its path as a str """
+        path = _key(path)
+        with self._lock:
+            self._files[path] = time.time()
+            self._files.move_to_end(path)
+            over = len(self._files) > self.max_count
+        if over:
+            self.sweep()
+        return path
+
+    def acquire(self, path):
+        """ pin a file until the matching release() """
+        path = _key(path)
+        with self._lock:
+            self._refcounts[path] = self._refcounts.get(path, 0) + 1
+
+    def release(self, path):
+        path = _key(path)
+        with self._lock:
+            count = self._refcounts.get(path, 0) - 1
+            if count > 0:
+                self._refcounts[path] = count
+            else:
+                self._refcounts.pop(path, None)
+
+    def retain_referenced(self, messages) -> int:
+        """ pin exactly the files (matching `pattern`) whose path appears as a string, at any depth, in messages
+            (the last max_pinned of them in message order), returns how many are pinned
+        """
+        # insertion ordered, a path referenced again moves to the end
+        ordered: Dict[str, None] = {}
+        for s in _strings(messages):
+            if len(s) < 4096 and fnmatch.fnmatch(os.path.basename(s), self.pattern):
+                key = _key(s)
+                ordered.pop(key, None)
+                ordered[key] = None
+        referenced = list(ordered)
+        if self.max_pinned is not None:
+            referenced = referenced[len(referenced) - self.max_pinned:] if self.max_pinned > 0 else []
+        referenced = set(referenced)
+        with self._lock:
+            self._referenced = referenced
+        return len(referenced)
+
+    def sweep(self) -> List[str]:
+        """ delete the files that fall outside the retention policy, oldest first, returns their paths """
+        now = time.time()
+        with self._lock:
+            pinned = self._referenced | set(self._refcounts)
+            candidates = [(path, added) for path, added in self._files.items() if path not in pinned and now - added >= self.min_age]
+            count = len(self._files)
+        sizes = {path: _file_size(path) for path in self._files_snapshot()}
+        total = sum(sizes.values())
+
+        removed = []
+        for path, added in candidates:
+            if count <= self.max_count and total <= self.max_bytes and now - added <= self.max_age:
+                # candidates are oldest first, the rest is within every limit
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"could not evict screenshot {path}: {e}")
+                continue
+            removed.append(path)
+            count -= 1
+            total -= sizes.get(path, 0)
+
+        with self._lock:
+            for path in removed:
+                self._files.pop(path, None)
+            self.evicted += len(removed)
+        return removed
+
+    def start(self):
+        """ adopt the files already in `directory` and sweep in the background """
+        if self.directory:
+            existing = sorted(glob.glob(os.path.join(self.directory, self.pattern)), key=_mtime)
+            with self._lock:
+                for path in map(_key, existing):
+                    if path not in self._files:
+                        self._files[path] = _mtime(path)
+                self._files = OrderedDict(sorted(self._files.items(), key=lambda item: item[1]))
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True, name="screenshot-store")
+            self._thread.start()
+            atexit.register(self.stop)
+        return self
+
+    def stop(self):
+        """ stop the background sweeps, and delete every tracked file (then the empty directory) if remove_on_exit """
+        self._stop.set()
+        if self.remove_on_exit:
+            for path in self._files_snapshot():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            with self._lock:
+                self._files.clear()
+            if self.directory:
+                try:
+                    os.rmdir(self.directory)
+                except OSError:
+                    # not empty: files this store does not track are left alone
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        files = self._files_snapshot()
+        with self._lock:
+            pinned = len((self._referenced | set(self._refcounts)) & set(files))
+        return {
+            'count': len(files),
+            'bytes': sum(_file_size(path) for path in files),
+            'pinned': pinned,
+            'evicted': self.evicted,
+        }
+
+    def _files_snapshot(self) -> List[str]:
+        with self._lock:
+            return list(self._files)
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print("screenshot sweep failed:", e)
+
+
+def _strings(obj) -> Iterable[str]:
+    if isinstance(obj, str):
+        yield obj
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _strings(value)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from _strings(value)
+
+
+def _key(path) -> str:
+    # "./tmp/outputs/x.png" in a message and Path("./tmp/outputs") / "x.png" are the same file
+    return os.path.abspath(str(path))
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def _mtime(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return 0.0
@@ -17,34 +17,71 @@ import cv2
 import numpy as np
 # %matplotlib inline
 from matplotlib import pyplot as plt
-import easyocr
-from paddleocr import PaddleOCR
-reader = easyocr.Reader(['en'])
-paddle_ocr = PaddleOCR(
-    lang='en',  # other lang also available
-    use_angle_cls=False,
-    use_gpu=False,  # using cuda will conflict with pytorch in the same process
-    show_log=False,
-    max_batch_size=1024,
-    use_dilation=True,  # improves accuracy
-    det_db_score_mode='slow',  # improves accuracy
-    rec_batch_num=1024)
+import atexit
+import threading
 import time
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import base64
 
 import os
 import ast
 import torch
 from typing import Tuple, List, Union
-from torchvision.ops import box_convert
+from torchvision.ops import box_convert, roi_align
 import re
 from torchvision.transforms import ToPILImage
 import supervision as sv
 import torchvision.transforms as T
 from util.box_annotator import BoxAnnotator
+from util.batch_sizer import is_oom_error
+
+
+def _load_easyocr():
+    import easyocr
+    return easyocr.Reader(['en'])
+
+
+def _load_paddleocr():
+    from paddleocr import PaddleOCR
+    return PaddleOCR(
+        lang='en',  # other lang also available
+        use_angle_cls=False,
+        use_gpu=False,  # using cuda will conflict with pytorch in the same process
+        show_log=False,
+        max_batch_size=1024,
+        use_dilation=True,  # improves accuracy
+        det_db_score_mode='slow',  # improves accuracy
+        rec_batch_num=1024)
+
+
+# ocr engines are only loaded the first time they are used (or preloaded), each process pays for the one it needs
+OCR_ENGINE_LOADERS = {'easyocr': _load_easyocr, 'paddleocr': _load_paddleocr}
+_ocr_engines = {}
+_ocr_engines_lock = threading.Lock()
+
+
+def get_ocr_engine(name):
+    if name not in OCR_ENGINE_LOADERS:
+        raise ValueError(f"Unknown ocr engine {name}, expected one of {list(OCR_ENGINE_LOADERS)}")
+    with _ocr_engines_lock:
+        if name not in _ocr_engines:
+            start = time.time()
+            _ocr_engines[name] = OCR_ENGINE_LOADERS[name]()
+            print(f'loaded ocr engine {name} in {time.time()-start:.2f}s')
+        return _ocr_engines[name]
+
+
+def preload_ocr_engines(*names):
+    for name in names:
+        get_ocr_engine(name)
 
 
 def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2-opt-2.7b", device=None):
+    """ model_name: 'blip2' | 'florence2' | 'florence2_int8'
+        florence2_int8 is the CPU backend: Florence-2 with torch dynamic int8 quantization of every nn.Linear
+        (encoder and decoder), noticeably faster and smaller than float32 on CPU-only machines
+    """
     if not device:
         device = "cuda" if torch.cuda.is_available() else "cpu"
     if model_name == "blip2":
@@ -65,63 +102,187 @@ def get_caption_model_processor(model_name, model_name_or_path="Salesforce/blip2
             model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32, trust_remote_code=True)
         else:
             model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float16, trust_remote_code=True).to(device)
-    return {'model': model.to(device), 'processor': processor}
+    elif model_name == "florence2_int8":
+        from transformers import AutoProcessor, AutoModelForCausalLM
+        if device != 'cpu':
+            print(f'florence2_int8 only runs on cpu, ignoring device={device}')
+            device = 'cpu'
+        processor = AutoProcessor.from_pretrained("microsoft/Florence-2-base", trust_remote_code=True)
+        model = AutoModelForCausalLM.from_pretrained(model_name_or_path, torch_dtype=torch.float32, trust_remote_code=True)
+        model = torch.quantization.quantize_dynamic(model.eval(), {torch.nn.Linear}, dtype=torch.qint8)
+    else:
+        raise ValueError(f"Unknown caption model {model_name}, expected blip2, florence2 or florence2_int8")
+    # the backend is part of the caption cache key: florence2 and florence2_int8 load the same weights
+    return {'model': model.to(device), 'processor': processor, 'model_name': model_name}
 
 
-def get_yolo_model(model_path):
+def get_yolo_model(model_path, backend='torch', device=None):
+    """ backend: 'torch' runs the ultralytics PyTorch weights, 'onnx' runs them through ONNX Runtime,
+        exporting <model_path stem>.onnx next to the weights the first time
+        device: where predict() runs ('cpu', 'cuda', ...), ultralytics picks cuda when available if not set
+    """
     from ultralytics import YOLO
-    # Load the model.
-    model = YOLO(model_path)
+    if backend == 'onnx':
+        onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+        if not os.path.exists(onnx_path):
+            print(f'exporting {model_path} to {onnx_path}')
+            # dynamic axes: screenshots are predicted at their native size
+            onnx_path = YOLO(model_path).export(format='onnx', dynamic=True, simplify=True)
+        model = YOLO(onnx_path, task='detect')
+    elif backend == 'torch':
+        # Load the model.
+        model = YOLO(model_path)
+    else:
+        raise ValueError(f"Unknown yolo backend {backend}, expected torch or onnx")
+    if device:
+        # every predict() call starts from the model's overrides
+        model.overrides['device'] = device
     return model
 
 
-@torch.inference_mode()
-def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128):
-    # Number of samples per batch, --> 128 roughly takes 4 GB of GPU memory for florence v2 model
-    to_pil = ToPILImage()
-    if starting_idx:
-        non_ocr_boxes = filtered_boxes[starting_idx:]
-    else:
-        non_ocr_boxes = filtered_boxes
-    croped_pil_image = []
-    for i, coord in enumerate(non_ocr_boxes):
-        try:
-            xmin, xmax = int(coord[0]*image_source.shape[1]), int(coord[2]*image_source.shape[1])
-            ymin, ymax = int(coord[1]*image_source.shape[0]), int(coord[3]*image_source.shape[0])
-            cropped_image = image_source[ymin:ymax, xmin:xmax, :]
-            cropped_image = cv2.resize(cropped_image, (64, 64))
-            croped_pil_image.append(to_pil(cropped_image))
-        except:
-            continue
-
-    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+def get_caption_prompt(caption_model_processor, prompt=None):
     if not prompt:
-        if 'florence' in model.config.name_or_path:
+        if 'florence' in caption_model_processor['model'].config.name_or_path:
             prompt = "<CAPTION>"
         else:
             prompt = "The image shows"
+    return prompt
+
+
+def crop_icon_images(non_ocr_boxes, image_source, size=64):
+    """ crop every box (xyxy ratio) from image_source (np.ndarray HxWx3) and resize it to the size x size caption input,
+        all boxes are sampled at once by one roi_align over the screenshot tensor: one bilinear sample per output pixel
+        at the crop's pixel centres, like cv2.resize of each crop (except that the outer half pixel of crops smaller
+        than size blends in the neighbouring screenshot pixels instead of repeating the crop border)
+
+    Returns:
+        torch.Tensor: uint8 N x 3 x size x size, one crop per box in order
+    """
+    h, w = image_source.shape[:2]
+    boxes = (np.asarray(non_ocr_boxes, dtype=np.float64).reshape(-1, 4) * [w, h, w, h]).astype(int)
+    if len(boxes) == 0:
+        return torch.zeros((0, 3, size, size), dtype=torch.uint8)
+    # degenerate boxes still get a one pixel crop so the crops stay aligned with the boxes
+    boxes[:, [0, 1]] = np.clip(boxes[:, [0, 1]], 0, [w - 1, h - 1])
+    boxes[:, [2, 3]] = np.clip(np.maximum(boxes[:, [2, 3]], boxes[:, [0, 1]] + 1), 1, [w, h])
+    image = torch.from_numpy(np.ascontiguousarray(image_source.transpose(2, 0, 1), dtype=np.float32))[None]
+    rois = torch.cat([torch.zeros((len(boxes), 1)), torch.from_numpy(boxes).float()], dim=1)
+    crops = roi_align(image, rois, output_size=size, spatial_scale=1.0, sampling_ratio=1, aligned=True)
+    return crops.round_().clamp_(0, 255).to(torch.uint8)
+
+
+def get_prompt_inputs(caption_model_processor, prompt):
+    """ tokenized prompt (input_ids, attention_mask, ...) of a single sample, computed once per prompt:
+        every icon gets the same prompt so the batch just repeats it
+    """
+    prompt_inputs = caption_model_processor.setdefault('prompt_inputs', {})
+    if prompt not in prompt_inputs:
+        inputs = caption_model_processor['processor'](images=[Image.new('RGB', (64, 64))], text=[prompt], return_tensors="pt")
+        prompt_inputs[prompt] = {k: v for k, v in inputs.items() if k != 'pixel_values'}
+    return prompt_inputs[prompt]
+
+
+# PIL resample filter -> interpolate mode, torch's antialiased kernels are PIL's (bicubic with a = -0.5)
+RESAMPLE_MODES = {Image.BILINEAR: 'bilinear', Image.BICUBIC: 'bicubic'}
+
+
+def icon_pixel_values(crops, image_processor, resize=True):
+    """ uint8 N x 3 x H x W crops -> normalized pixel_values, the processor's rescale / normalize done on the batch tensor
+        resize: resize the whole batch to the processor's input size (unless do_resize=False) in one antialiased uint8
+            interpolate with the processor's PIL resample filter, within a level of the processor's own pixels
+    """
+    if resize:
+        size = image_processor.size
+        height, width = (size['height'], size['width']) if 'height' in size else (size['shortest_edge'], size['shortest_edge'])
+        mode = RESAMPLE_MODES[getattr(image_processor, 'resample', Image.BICUBIC)]
+        crops = torch.nn.functional.interpolate(crops, size=(height, width), mode=mode, antialias=True, align_corners=False)
+    # (x * rescale - mean) / std in place, the batch is N x 3 x 768 x 768 floats on the cpu path
+    mean = torch.tensor(image_processor.image_mean).view(1, -1, 1, 1)
+    std = torch.tensor(image_processor.image_std).view(1, -1, 1, 1)
+    return crops.float().mul_(image_processor.rescale_factor / std).sub_(mean / std)
+
+
+def _stack_crops(croped_images):
+    """ accepts the N x 3 x H x W uint8 tensor of crop_icon_images, or a list of 3 x H x W tensors / H x W x 3 arrays """
+    if isinstance(croped_images, torch.Tensor):
+        return croped_images
+    if len(croped_images) == 0:
+        return torch.zeros((0, 3, 64, 64), dtype=torch.uint8)
+    return torch.stack([img if isinstance(img, torch.Tensor) else torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1) for img in croped_images])
+
+
+@torch.inference_mode()
+def caption_icon_crops(croped_images, caption_model_processor, prompt=None, batch_size=128, caption_cache=None, batch_sizer=None):
+    """ caption icon crops (see crop_icon_images), the crops may come from several screenshots
+        caption_cache: optional CaptionCache, only crops that were never captioned before go through the model
+        batch_size: crops per forward pass, None for all of them in one (without batch_sizer)
+        batch_sizer: optional CaptionBatchSizer, picks the batch size (batch_size is then only an upper bound, None for none)
+            and retries a batch with a smaller size on out of memory
+    """
+    model, processor = caption_model_processor['model'], caption_model_processor['processor']
+    prompt = get_caption_prompt(caption_model_processor, prompt)
+    crops = _stack_crops(croped_images)
+
+    if caption_cache is not None:
+        # keyed on the HWC pixels, like the crops were before batching, and on the backend as well as the weights
+        model_name = f"{caption_model_processor.get('model_name', '')}:{model.config.name_or_path}"
+        cache_keys = [caption_cache.make_key(img.permute(1, 2, 0).numpy(), model_name, prompt) for img in crops]
+        cached = caption_cache.get_many(cache_keys)
+        to_caption = crops[[i for i, key in enumerate(cache_keys) if key not in cached]]
+    else:
+        to_caption = crops
 
     generated_texts = []
     device = model.device
-    for i in range(0, len(croped_pil_image), batch_size):
-        start = time.time()
-        batch = croped_pil_image[i:i+batch_size]
-        t1 = time.time()
-        if model.device.type == 'cuda':
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt", do_resize=False).to(device=device, dtype=torch.float16)
-        else:
-            inputs = processor(images=batch, text=[prompt]*len(batch), return_tensors="pt").to(device=device)
-        if 'florence' in model.config.name_or_path:
-            generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=inputs["pixel_values"],max_new_tokens=20,num_beams=1, do_sample=False)
-        else:
-            generated_ids = model.generate(**inputs, max_length=100, num_beams=5, no_repeat_ngram_size=2, early_stopping=True, num_return_sequences=1) # temperature=0.01, do_sample=True,
+    prompt_inputs = get_prompt_inputs(caption_model_processor, prompt)
+    i = 0
+    while i < len(to_caption):
+        # no batch size and no sizer: one batch
+        size = batch_size or len(to_caption)
+        if batch_sizer is not None:
+            size = min(batch_sizer.batch_size, batch_size) if batch_size else batch_sizer.batch_size
+        batch = to_caption[i:i+size]
+        n = len(batch)
+        # the gpu path feeds the 64x64 crops as is, the cpu path lets them be resized to the processor size
+        pixel_values = icon_pixel_values(batch, processor.image_processor, resize=model.device.type != 'cuda').to(device=device, dtype=model.dtype)
+        inputs = {k: v.repeat(n, *[1] * (v.dim() - 1)).to(device) for k, v in prompt_inputs.items()}
+        try:
+            with batch_sizer.measure(n) if batch_sizer is not None else nullcontext():
+                if 'florence' in model.config.name_or_path:
+                    generated_ids = model.generate(input_ids=inputs["input_ids"],pixel_values=pixel_values,max_new_tokens=20,num_beams=1, do_sample=False)
+                else:
+                    generated_ids = model.generate(**inputs, pixel_values=pixel_values, max_length=100, num_beams=5, no_repeat_ngram_size=2, early_stopping=True, num_return_sequences=1) # temperature=0.01, do_sample=True,
+        except (RuntimeError, MemoryError) as e:
+            if batch_sizer is None or not is_oom_error(e):
+                raise
+            del pixel_values, inputs
+            if not batch_sizer.back_off(n):
+                raise
+            continue
+        i += n
         generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)
         generated_text = [gen.strip() for gen in generated_text]
         generated_texts.extend(generated_text)
 
+    if caption_cache is not None:
+        # merge fresh captions back in crop order and remember them
+        fresh = iter(generated_texts)
+        generated_texts = [cached[key] if key in cached else next(fresh) for key in cache_keys]
+        caption_cache.put_many({key: txt for key, txt in zip(cache_keys, generated_texts) if key not in cached})
+
     return generated_texts
 
 
+def get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=None, batch_size=128, caption_cache=None, batch_sizer=None):
+    # Number of samples per batch, --> 128 roughly takes 4 GB of GPU memory for florence v2 model
+    if starting_idx:
+        non_ocr_boxes = filtered_boxes[starting_idx:]
+    else:
+        non_ocr_boxes = filtered_boxes
+    croped_images = crop_icon_images(non_ocr_boxes, image_source)
+    return caption_icon_crops(croped_images, caption_model_processor, prompt=prompt, batch_size=batch_size, caption_cache=caption_cache, batch_sizer=batch_sizer)
+
+
 
 def get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor):
     to_pil = ToPILImage()
@@ -228,84 +389,74 @@ def remove_overlap(boxes, iou_threshold, ocr_bbox=None):
     return torch.tensor(filtered_boxes)
 
 
+def pairwise_box_area(boxes):
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def pairwise_intersection_area(boxes1, boxes2):
+    """ intersection area of every box in boxes1 (N, 4) with every box in boxes2 (M, 4), xyxy format -> (N, M)
+    """
+    x1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    y1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    x2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    y2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    return np.maximum(0, x2 - x1) * np.maximum(0, y2 - y1)
+
+
 def remove_overlap_new(boxes, iou_threshold, ocr_bbox=None):
     '''
     ocr_bbox format: [{'type': 'text', 'bbox':[x,y], 'interactivity':False, 'content':str }, ...]
     boxes format: [{'type': 'icon', 'bbox':[x,y], 'interactivity':True, 'content':None }, ...]
 
+    IoU / containment between all box pairs is computed at once as (N, N) and (N, M) matrices,
+    only the ocr label gathering still walks the surviving icon boxes in order.
     '''
     assert ocr_bbox is None or isinstance(ocr_bbox, List)
 
-    def box_area(box):
-        return (box[2] - box[0]) * (box[3] - box[1])
-
-    def intersection_area(box1, box2):
-        x1 = max(box1[0], box2[0])
-        y1 = max(box1[1], box2[1])
-        x2 = min(box1[2], box2[2])
-        y2 = min(box1[3], box2[3])
-        return max(0, x2 - x1) * max(0, y2 - y1)
-
-    def IoU(box1, box2):
-        intersection = intersection_area(box1, box2)
-        union = box_area(box1) + box_area(box2) - intersection + 1e-6
-        if box_area(box1) > 0 and box_area(box2) > 0:
-            ratio1 = intersection / box_area(box1)
-            ratio2 = intersection / box_area(box2)
+    yolo_xyxy = np.array([elem['bbox'] for elem in boxes], dtype=np.float64).reshape(-1, 4)
+    yolo_area = pairwise_box_area(yolo_xyxy)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # IoU(box1, box2) = max(iou, intersection / area1, intersection / area2), keep the smaller box
+        intersection = pairwise_intersection_area(yolo_xyxy, yolo_xyxy)
+        union = yolo_area[:, None] + yolo_area[None, :] - intersection + 1e-6
+        positive = (yolo_area[:, None] > 0) & (yolo_area[None, :] > 0)
+        ratio1 = np.where(positive, intersection / yolo_area[:, None], 0)
+        ratio2 = np.where(positive, intersection / yolo_area[None, :], 0)
+        iou = np.maximum(np.maximum(intersection / union, ratio1), ratio2)
+    suppressed = (iou > iou_threshold) & (yolo_area[:, None] > yolo_area[None, :])
+    np.fill_diagonal(suppressed, False)
+    is_valid_box = ~suppressed.any(axis=1)
+
+    if not ocr_bbox:
+        return [boxes[i]['bbox'] for i in np.flatnonzero(is_valid_box)]
+
+    ocr_xyxy = np.array([elem['bbox'] for elem in ocr_bbox], dtype=np.float64).reshape(-1, 4)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        intersection = pairwise_intersection_area(yolo_xyxy, ocr_xyxy)
+        ocr_inside_icon = intersection / pairwise_box_area(ocr_xyxy)[None, :] > 0.80
+        icon_inside_ocr = intersection / yolo_area[:, None] > 0.80
+
+    # keep yolo boxes + prioritize ocr label
+    ocr_removed = np.zeros(len(ocr_bbox), dtype=bool)
+    icon_boxes = []
+    for i in np.flatnonzero(is_valid_box):
+        # icon inside ocr: don't add this icon box, ocr boxes gathered before it are still consumed
+        stop = np.flatnonzero(icon_inside_ocr[i] & ~ocr_inside_icon[i])
+        gathered = ocr_inside_icon[i, :stop[0]] if stop.size else ocr_inside_icon[i]
+        gathered = np.flatnonzero(gathered)
+        # gather all ocr labels inside the icon and delete them from the ocr boxes
+        ocr_labels = ''.join(ocr_bbox[k]['content'] + ' ' for k in gathered)
+        ocr_removed[gathered] = True
+        if stop.size:
+            continue
+        if ocr_labels:
+            icon_boxes.append({'type': 'icon', 'bbox': boxes[i]['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
         else:
-            ratio1, ratio2 = 0, 0
-        return max(intersection / union, ratio1, ratio2)
+            icon_boxes.append({'type': 'icon', 'bbox': boxes[i]['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
 
-    def is_inside(box1, box2):
-        # return box1[0] >= box2[0] and box1[1] >= box2[1] and box1[2] <= box2[2] and box1[3] <= box2[3]
-        intersection = intersection_area(box1, box2)
-        ratio1 = intersection / box_area(box1)
-        return ratio1 > 0.80
-
-    # boxes = boxes.tolist()
-    filtered_boxes = []
-    if ocr_bbox:
-        filtered_boxes.extend(ocr_bbox)
-    # print('ocr_bbox!!!', ocr_bbox)
-    for i, box1_elem in enumerate(boxes):
-        box1 = box1_elem['bbox']
-        is_valid_box = True
-        for j, box2_elem in enumerate(boxes):
-            # keep the smaller box
-            box2 = box2_elem['bbox']
-            if i != j and IoU(box1, box2) > iou_threshold and box_area(box1) > box_area(box2):
-                is_valid_box = False
-                break
-        if is_valid_box:
-            if ocr_bbox:
-                # keep yolo boxes + prioritize ocr label
-                box_added = False
-                ocr_labels = ''
-                for box3_elem in ocr_bbox:
-                    if not box_added:
-                        box3 = box3_elem['bbox']
-                        if is_inside(box3, box1): # ocr inside icon
-                            # box_added = True
-                            # delete the box3_elem from ocr_bbox
-                            try:
-                                # gather all ocr labels
-                                ocr_labels += box3_elem['content'] + ' '
-                                filtered_boxes.remove(box3_elem)
-                            except:
-                                continue
-                            # break
-                        elif is_inside(box1, box3): # icon inside ocr, don't added this icon box, no need to check other ocr bbox bc no overlap between ocr bbox, icon can only be in one ocr box
-                            box_added = True
-                            break
-                        else:
-                            continue
-                if not box_added:
-                    if ocr_labels:
-                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': ocr_labels, 'source':'box_yolo_content_ocr'})
-                    else:
-                        filtered_boxes.append({'type': 'icon', 'bbox': box1_elem['bbox'], 'interactivity': True, 'content': None, 'source':'box_yolo_content_yolo'})
-            else:
-                filtered_boxes.append(box1)
+    filtered_boxes = [elem for k, elem in enumerate(ocr_bbox) if not ocr_removed[k]]
+    filtered_boxes.extend(icon_boxes)
     return filtered_boxes # torch.tensor(filtered_boxes)
 
 
@@ -398,17 +549,76 @@ def predict_yolo(model, image, box_threshold, imgsz, scale_img, iou_threshold=0.
 
     return boxes, conf, phrases
 
+def predict_yolo_batch(model, images, box_threshold, iou_threshold=0.7):
+    """ run the yolo detector once over a list of images, returns [(boxes, conf, phrases), ...] in image order
+    """
+    results = model.predict(
+        source=images,
+        conf=box_threshold,
+        iou=iou_threshold, # default 0.7
+        )
+    outputs = []
+    for result in results:
+        boxes = result.boxes.xyxy # in pixel space
+        outputs.append((boxes, result.boxes.conf, [str(i) for i in range(len(boxes))]))
+    return outputs
+
 def int_box_area(box, w, h):
     x1, y1, x2, y2 = box
     int_box = [int(x1*w), int(y1*h), int(x2*w), int(y2*h)]
     area = (int_box[2] - int_box[0]) * (int_box[3] - int_box[1])
     return area
 
-def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_TRESHOLD=0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None, scale_img=False, imgsz=None, batch_size=128):
+def add_timing(timings, stage, start):
+    """ accumulate the seconds since start under timings[stage], no-op if timings is None """
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.time() - start
+
+
+def detect_and_ocr(image_source: Union[str, Image.Image], model, BOX_TRESHOLD=0.01, ocr_args=None, scale_img=False, imgsz=None, timings=None):
+    """ run check_ocr_box and predict_yolo concurrently, they are independent until the overlap removal.
+        OCR runs on a worker thread while yolo runs on the calling one (both release the GIL in native code).
+
+    Returns:
+        (text, ocr_bbox), (xyxy, logits, phrases): feed them to get_som_labeled_img(ocr_text=text, ocr_bbox=ocr_bbox, detections=...)
+    """
+    if isinstance(image_source, str):
+        image_source = Image.open(image_source)
+    image_source = image_source.convert("RGB")
+    w, h = image_source.size
+    if not imgsz:
+        imgsz = (h, w)
+    ocr_args = dict(ocr_args or {})
+    ocr_args.setdefault('display_img', False)
+    ocr_args.setdefault('output_bb_format', 'xyxy')
+
+    def _ocr():
+        start = time.time()
+        result, _ = check_ocr_box(image_source, **ocr_args)
+        add_timing(timings, 'ocr', start)
+        return result
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        ocr_future = pool.submit(_ocr)
+        yolo_start = time.time()
+        detections = predict_yolo(model=model, image=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img, iou_threshold=0.1)
+        add_timing(timings, 'yolo', yolo_start)
+        ocr_result = ocr_future.result()
+    add_timing(timings, 'ocr_yolo_wall', start)
+    return ocr_result, detections
+
+
+def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_TRESHOLD=0.01, output_coord_in_ratio=False, ocr_bbox=None, text_scale=0.4, text_padding=5, draw_bbox_config=None, caption_model_processor=None, ocr_text=[], use_local_semantics=True, iou_threshold=0.9,prompt=None, scale_img=False, imgsz=None, batch_size=128, caption_cache=None, render_overlay=True, detections=None, timings=None, batch_sizer=None):
     """Process either an image path or Image object
 
     Args:
         image_source: Either a file path (str) or PIL Image object
+        detections: optional (xyxy, logits, phrases) from predict_yolo, e.g. computed concurrently with ocr by detect_and_ocr
+        timings: optional dict, the seconds spent in each stage are added to it
+        batch_sizer: optional CaptionBatchSizer for the icon captions, see caption_icon_crops
+        render_overlay: if False skip drawing / PNG encoding the SOM image, encoded_image and label_coordinates are None,
+            use draw_som_overlay(image, parsed_content_list) later if the picture is needed
         ...
     """
     if isinstance(image_source, str):
@@ -418,12 +628,52 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     if not imgsz:
         imgsz = (h, w)
     # print('image size:', w, h)
-    xyxy, logits, phrases = predict_yolo(model=model, image=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img, iou_threshold=0.1)
+    if detections is None:
+        start = time.time()
+        detections = predict_yolo(model=model, image=image_source, box_threshold=BOX_TRESHOLD, imgsz=imgsz, scale_img=scale_img, iou_threshold=0.1)
+        add_timing(timings, 'yolo', start)
+    xyxy, logits, phrases = detections
     #print(xyxy)
-    xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
     image_source = np.asarray(image_source)
     phrases = [str(i) for i in range(len(phrases))]
 
+    start = time.time()
+    filtered_boxes_elem, filtered_boxes, starting_idx = get_filtered_elements(xyxy, w, h, ocr_bbox=ocr_bbox, ocr_text=ocr_text, iou_threshold=iou_threshold)
+    add_timing(timings, 'filter', start)
+    # get parsed icon local semantics
+    time1 = time.time()
+    if use_local_semantics:
+        caption_model = caption_model_processor['model']
+        if 'phi3_v' in caption_model.config.model_type:
+            parsed_content_icon = get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor)
+        else:
+            parsed_content_icon = get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt,batch_size=batch_size, caption_cache=caption_cache, batch_sizer=batch_sizer)
+        parsed_content_merged = fill_icon_content(filtered_boxes_elem, parsed_content_icon, ocr_text)
+    else:
+        ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
+        parsed_content_merged = ocr_text
+    print('time to get parsed content:', time.time()-time1)
+    add_timing(timings, 'caption', time1)
+
+    if not render_overlay:
+        return None, None, filtered_boxes_elem
+    start = time.time()
+    encoded_image, label_coordinates = render_som_image(image_source, filtered_boxes, logits=logits, draw_bbox_config=draw_bbox_config, text_scale=text_scale, text_padding=text_padding, output_coord_in_ratio=output_coord_in_ratio)
+    add_timing(timings, 'render', start)
+
+    return encoded_image, label_coordinates, filtered_boxes_elem
+
+
+def get_filtered_elements(xyxy, w, h, ocr_bbox=None, ocr_text=[], iou_threshold=0.9):
+    """ merge yolo boxes (pixel xyxy tensor) and ocr boxes (pixel xyxy list) into the parsed element list
+
+    Returns:
+        filtered_boxes_elem: element dicts, elements that still need a caption ('content': None) at the end
+        filtered_boxes (torch.Tensor): xyxy ratio boxes of filtered_boxes_elem
+        starting_idx (int): index of the first element that needs a caption, -1 if none
+    """
+    xyxy = xyxy / torch.Tensor([w, h, w, h]).to(xyxy.device)
+
     # annotate the image with labels
     if ocr_bbox:
         ocr_bbox = torch.tensor(ocr_bbox) / torch.Tensor([w, h, w, h])
@@ -442,30 +692,43 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
     starting_idx = next((i for i, box in enumerate(filtered_boxes_elem) if box['content'] is None), -1)
     filtered_boxes = torch.tensor([box['bbox'] for box in filtered_boxes_elem])
     print('len(filtered_boxes):', len(filtered_boxes), starting_idx)
-    # get parsed icon local semantics
-    time1 = time.time()
-    if use_local_semantics:
-        caption_model = caption_model_processor['model']
-        if 'phi3_v' in caption_model.config.model_type:
-            parsed_content_icon = get_parsed_content_icon_phi3v(filtered_boxes, ocr_bbox, image_source, caption_model_processor)
-        else:
-            parsed_content_icon = get_parsed_content_icon(filtered_boxes, starting_idx, image_source, caption_model_processor, prompt=prompt,batch_size=batch_size)
-        ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
-        icon_start = len(ocr_text)
-        parsed_content_icon_ls = []
-        # fill the filtered_boxes_elem None content with parsed_content_icon in order
-        for i, box in enumerate(filtered_boxes_elem):
-            if box['content'] is None:
-                box['content'] = parsed_content_icon.pop(0)
-        for i, txt in enumerate(parsed_content_icon):
-            parsed_content_icon_ls.append(f"Icon Box ID {str(i+icon_start)}: {txt}")
-        parsed_content_merged = ocr_text + parsed_content_icon_ls
-    else:
-        ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
-        parsed_content_merged = ocr_text
-    print('time to get parsed content:', time.time()-time1)
+    return filtered_boxes_elem, filtered_boxes, starting_idx
+
+
+def fill_icon_content(filtered_boxes_elem, parsed_content_icon, ocr_text):
+    """ fill the 'content': None elements with the icon captions in order, returns the merged text/icon description lines """
+    ocr_text = [f"Text Box ID {i}: {txt}" for i, txt in enumerate(ocr_text)]
+    icon_start = len(ocr_text)
+    parsed_content_icon_ls = []
+    # fill the filtered_boxes_elem None content with parsed_content_icon in order
+    for i, box in enumerate(filtered_boxes_elem):
+        if box['content'] is None:
+            box['content'] = parsed_content_icon.pop(0)
+    for i, txt in enumerate(parsed_content_icon):
+        parsed_content_icon_ls.append(f"Icon Box ID {str(i+icon_start)}: {txt}")
+    return ocr_text + parsed_content_icon_ls
+
+
+def describe_icon_boxes(filtered_boxes_elem, image_source):
+    """ give every uncaptioned element ('content': None) a cheap 'descriptor': pixel size, center and mean color,
+        enough for a planner to pick the boxes worth captioning with caption_icon_crops
+    """
+    h, w = image_source.shape[:2]
+    for elem in filtered_boxes_elem:
+        if elem['content'] is not None:
+            continue
+        x1, y1, x2, y2 = elem['bbox']
+        crop = image_source[int(y1*h):max(int(y2*h), int(y1*h)+1), int(x1*w):max(int(x2*w), int(x1*w)+1)]
+        r, g, b = (int(c) for c in crop.reshape(-1, 3).mean(axis=0))
+        elem['descriptor'] = f"{int((x2-x1)*w)}x{int((y2-y1)*h)}px icon at ({(x1+x2)/2:.2f}, {(y1+y2)/2:.2f}), color #{r:02x}{g:02x}{b:02x}"
+    return filtered_boxes_elem
 
+
+def render_som_image(image_source: np.ndarray, filtered_boxes: torch.Tensor, logits=None, draw_bbox_config=None, text_scale=0.4, text_padding=5, output_coord_in_ratio=False):
+    """ draw the numbered boxes (xyxy ratio) on a copy of image_source, returns the base64 PNG and label coordinates """
+    h, w = image_source.shape[:2]
     #filtered_boxes = box_convert(boxes=filtered_boxes, in_fmt="xyxy", out_fmt="cxcywh")
+    filtered_boxes = filtered_boxes.reshape(-1, 4)
 
     phrases = [i for i in range(len(filtered_boxes))]
 
@@ -483,7 +746,19 @@ def get_som_labeled_img(image_source: Union[str, Image.Image], model=None, BOX_T
         label_coordinates = {k: [v[0]/w, v[1]/h, v[2]/w, v[3]/h] for k, v in label_coordinates.items()}
         assert w == annotated_frame.shape[1] and h == annotated_frame.shape[0]
 
-    return encoded_image, label_coordinates, filtered_boxes_elem
+    return encoded_image, label_coordinates
+
+
+def draw_som_overlay(image_source: Union[str, Image.Image, np.ndarray], parsed_content_list, draw_bbox_config=None, text_scale=0.4, text_padding=5, output_coord_in_ratio=False):
+    """ render the SOM overlay on demand from a parsed_content_list (elements with xyxy ratio 'bbox'),
+        same picture as get_som_labeled_img draws, returns the base64 PNG and label coordinates
+    """
+    if isinstance(image_source, str):
+        image_source = Image.open(image_source)
+    if isinstance(image_source, Image.Image):
+        image_source = np.asarray(image_source.convert("RGB"))
+    filtered_boxes = torch.tensor([elem['bbox'] for elem in parsed_content_list])
+    return render_som_image(image_source, filtered_boxes, draw_bbox_config=draw_bbox_config, text_scale=text_scale, text_padding=text_padding, output_coord_in_ratio=output_coord_in_ratio)
 
 
 def get_xywh(input):
@@ -501,28 +776,117 @@ def get_xywh_yolo(input):
     x, y, w, h = int(x), int(y), int(w), int(h)
     return x, y, w, h
 
-def check_ocr_box(image_source: Union[str, Image.Image], display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False):
-    if isinstance(image_source, str):
-        image_source = Image.open(image_source)
-    if image_source.mode == 'RGBA':
-        # Convert RGBA to RGB to avoid alpha channel issues
-        image_source = image_source.convert('RGB')
-    image_np = np.array(image_source)
-    w, h = image_source.size
-    if use_paddleocr:
+def run_ocr_engine(ocr_engine, image_np, easyocr_args=None):
+    """ run one ocr engine on an RGB array, returns (coord, text), coord: 4 corner points per text box """
+    if ocr_engine == 'paddleocr':
         if easyocr_args is None:
             text_threshold = 0.5
         else:
             text_threshold = easyocr_args['text_threshold']
-        result = paddle_ocr.ocr(image_np, cls=False)[0]
+        result = get_ocr_engine('paddleocr').ocr(image_np, cls=False)[0] or []
         coord = [item[0] for item in result if item[1][1] > text_threshold]
         text = [item[1][0] for item in result if item[1][1] > text_threshold]
     else:  # EasyOCR
         if easyocr_args is None:
             easyocr_args = {}
-        result = reader.readtext(image_np, **easyocr_args)
+        result = get_ocr_engine(ocr_engine).readtext(image_np, **easyocr_args)
         coord = [item[0] for item in result]
         text = [item[1] for item in result]
+    return coord, text
+
+
+def _ocr_tile(ocr_engine, tile_np, x0, y0, easyocr_args):
+    coord, text = run_ocr_engine(ocr_engine, tile_np, easyocr_args)
+    coord = [[[float(p[0]) + x0, float(p[1]) + y0] for p in pts] for pts in coord]
+    return coord, text
+
+
+# tile_workers -> process pool, created on first use and shut down at exit
+_ocr_tile_pools = {}
+_ocr_tile_pools_lock = threading.Lock()
+
+
+def _ocr_tile_pool(tile_workers):
+    with _ocr_tile_pools_lock:
+        if tile_workers not in _ocr_tile_pools:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            if not _ocr_tile_pools:
+                atexit.register(_shutdown_ocr_tile_pools)
+            # spawn, never fork: the pool is created from a worker thread while torch / cuda threads are running
+            _ocr_tile_pools[tile_workers] = ProcessPoolExecutor(max_workers=tile_workers, mp_context=multiprocessing.get_context("spawn"))
+        return _ocr_tile_pools[tile_workers]
+
+
+def _shutdown_ocr_tile_pools():
+    with _ocr_tile_pools_lock:
+        for pool in _ocr_tile_pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+        _ocr_tile_pools.clear()
+
+
+def _tile_starts(length, tile_size, tile_overlap):
+    if length <= tile_size:
+        return [0]
+    step = tile_size - tile_overlap
+    starts = list(range(0, length - tile_size, step))
+    starts.append(length - tile_size)
+    return starts
+
+
+def run_tiled_ocr(ocr_engine, image_np, easyocr_args=None, tile_size=1600, tile_overlap=64, tile_workers=1):
+    """ ocr on overlapping tiles of at most tile_size x tile_size, so memory does not grow with the screen size.
+        Text cut by a tile seam is found whole in the neighbouring tile (if shorter than tile_overlap),
+        duplicates across tiles are dropped keeping the larger box.
+        tile_workers > 1 runs the tiles in a process pool, each worker loads its own ocr engine.
+    """
+    assert tile_size > tile_overlap
+    h, w = image_np.shape[:2]
+    tiles = [(x0, y0) for y0 in _tile_starts(h, tile_size, tile_overlap) for x0 in _tile_starts(w, tile_size, tile_overlap)]
+    jobs = [(ocr_engine, np.ascontiguousarray(image_np[y0:y0+tile_size, x0:x0+tile_size]), x0, y0, easyocr_args) for x0, y0 in tiles]
+    if tile_workers > 1 and len(jobs) > 1:
+        results = list(_ocr_tile_pool(tile_workers).map(_ocr_tile, *zip(*jobs)))
+    else:
+        results = [_ocr_tile(*job) for job in jobs]
+
+    coord, text, tile_id = [], [], []
+    for i, (tile_coord, tile_text) in enumerate(results):
+        coord.extend(tile_coord)
+        text.extend(tile_text)
+        tile_id.extend([i] * len(tile_coord))
+    if not coord:
+        return [], []
+
+    xyxy = np.array([[min(p[0] for p in pts), min(p[1] for p in pts), max(p[0] for p in pts), max(p[1] for p in pts)] for pts in coord])
+    area = pairwise_box_area(xyxy)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covered = pairwise_intersection_area(xyxy, xyxy) / np.minimum(area[:, None], area[None, :]) > 0.5
+    tile_id = np.array(tile_id)
+    keep = []
+    for i in np.argsort(-area, kind='stable'):
+        if not any(covered[i, k] and tile_id[i] != tile_id[k] for k in keep):
+            keep.append(i)
+    # reading order
+    keep.sort(key=lambda i: (xyxy[i, 1], xyxy[i, 0]))
+    return [coord[i] for i in keep], [text[i] for i in keep]
+
+
+def check_ocr_box(image_source: Union[str, Image.Image], display_img = True, output_bb_format='xywh', goal_filtering=None, easyocr_args=None, use_paddleocr=False, ocr_engine=None, tile_size=None, tile_overlap=64, tile_workers=1):
+    # ocr_engine: 'easyocr' | 'paddleocr', overrides use_paddleocr
+    # tile_size: if set, images larger than tile_size are ocr-ed in overlapping tiles, see run_tiled_ocr
+    if ocr_engine is None:
+        ocr_engine = 'paddleocr' if use_paddleocr else 'easyocr'
+    if isinstance(image_source, str):
+        image_source = Image.open(image_source)
+    if image_source.mode == 'RGBA':
+        # Convert RGBA to RGB to avoid alpha channel issues
+        image_source = image_source.convert('RGB')
+    image_np = np.array(image_source)
+    w, h = image_source.size
+    if tile_size and max(w, h) > tile_size:
+        coord, text = run_tiled_ocr(ocr_engine, image_np, easyocr_args, tile_size=tile_size, tile_overlap=tile_overlap, tile_workers=tile_workers)
+    else:
+        coord, text = run_ocr_engine(ocr_engine, image_np, easyocr_args)
     if display_img:
         opencv_img = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
         bb = []